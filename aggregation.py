@@ -0,0 +1,261 @@
+from lazy_imports import lazy_module
+from metadata_catalog import catalog
+from sharding import shard_router
+from cold_storage import cold_storage
+from models import Snapshot, Metric, DeviceMetricType, Device
+from sqlalchemy import Integer, and_, cast, func, or_, select
+from datetime import datetime
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+pd = lazy_module('pandas')
+np = lazy_module('numpy')
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+DURATION_PATTERN = re.compile(r'^(\d+)([smhdw]?)$')
+# Past this many buckets a request is almost certainly a mistake
+MAX_BUCKETS = 100000
+
+
+def parse_duration(value):
+    """Seconds in a bucket width such as 300, '15m', '1h' or '1d'"""
+    match = DURATION_PATTERN.match(str(value).strip().lower())
+    if not match:
+        raise ValueError(f"Invalid bucket width {value!r}, expected e.g. 300, 15m, 1h or 1d")
+    seconds = int(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+    if seconds <= 0:
+        raise ValueError("Bucket width must be positive")
+    return seconds
+
+
+def parse_time(value):
+    """Epoch seconds from an epoch number or an ISO 8601 string"""
+    if value is None or value == '':
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise ValueError(f"Invalid time {value!r}, expected epoch seconds or ISO 8601")
+
+
+def parse_percentiles(values):
+    """Percentiles given as 0-100, returned sorted and de-duplicated"""
+    percentiles = set()
+    for value in values:
+        for part in str(value).split(','):
+            if part.strip():
+                percentile = float(part)
+                if not 0 <= percentile <= 100:
+                    raise ValueError(f"Percentile {percentile} is not between 0 and 100")
+                percentiles.add(percentile)
+    return sorted(percentiles)
+
+
+def percentile_label(percentile):
+    return f"p{percentile:g}".replace('.', '_')
+
+
+def resolve_aggregator_ids(values):
+    """Catalog ids for aggregators given by id, guid or name"""
+    ids = []
+    for value in values:
+        value = str(value)
+        aggregator_id = catalog.get_aggregator_id(value)
+        if aggregator_id is None and value.isdigit() and int(value) in catalog.aggregators:
+            aggregator_id = int(value)
+        if aggregator_id is None:
+            aggregator_id = next(
+                (entry.aggregator_id for entry in catalog.aggregator_list() if entry.name == value), None)
+        if aggregator_id is None:
+            raise ValueError(f"Unknown aggregator {value!r}")
+        ids.append(aggregator_id)
+    return ids
+
+
+def aggregate_metrics(session, metric_names, aggregators=(), start=None, end=None,
+                      bucket_seconds=3600, percentiles=()):
+    """Per-bucket statistics of each metric for each aggregator.
+
+    Count, min, max, mean and the sums for the standard deviation come from
+    one GROUP BY. Percentiles use a window query that returns, per group,
+    only the (at most two) ranked values each percentile interpolates
+    between; pandas then does the interpolation for all groups at once.
+    """
+    if not metric_names:
+        raise ValueError("At least one metric name is required")
+    if start is not None and end is not None:
+        if end < start:
+            raise ValueError("end is before start")
+        if (end - start) / bucket_seconds > MAX_BUCKETS:
+            raise ValueError(f"More than {MAX_BUCKETS} buckets requested, use a wider bucket")
+
+    catalog.sync(session)
+    aggregator_ids = resolve_aggregator_ids(aggregators) or [None]
+    metric_type_ids = sorted({
+        metric_type_id
+        for name in metric_names
+        for aggregator_id in aggregator_ids
+        for metric_type_id in catalog.metric_type_ids(name, aggregator_id)
+    })
+    result = {'bucket_seconds': bucket_seconds, 'start': start, 'end': end, 'series': []}
+    if not metric_type_ids:
+        return result
+
+    if shard_router.enabled:
+        # A series lives on a single shard, so the shards' results just add up
+        frames = shard_router.fan_out(
+            lambda session, ids: bucket_statistics(session, ids, start, end, bucket_seconds, percentiles),
+            {shard: (ids,) for shard, ids in shard_router.shards_for_metric_types(metric_type_ids).items()})
+        frames = [frame for frame in frames if not frame.empty]
+        stats = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    else:
+        stats = bucket_statistics(session, metric_type_ids, start, end, bucket_seconds, percentiles)
+    if stats.empty:
+        return result
+
+    value_columns = ['count', 'min', 'max', 'mean', 'stddev'] + [percentile_label(p) for p in percentiles]
+    for (metric, aggregator_id), group in stats.groupby(['metric', 'aggregator_id'], sort=True):
+        aggregator = catalog.aggregators.get(aggregator_id)
+        buckets = group[['bucket'] + value_columns].rename(columns={'bucket': 'start'})
+        result['series'].append({
+            'metric': metric,
+            'aggregator_id': int(aggregator_id),
+            'aggregator': aggregator.name if aggregator else None,
+            'aggregator_guid': aggregator.guid if aggregator else None,
+            # Through JSON so numpy types become plain numbers and NaN becomes None
+            'buckets': json.loads(buckets.to_json(orient='records', double_precision=15)),
+        })
+    return result
+
+
+def bucket_statistics(session, metric_type_ids, start, end, bucket_seconds, percentiles):
+    """One row per (metric, aggregator_id, bucket) with the statistics columns"""
+    bucket = ((Snapshot.client_timestamp_epoch // bucket_seconds) * bucket_seconds).label('bucket')
+    group_columns = [DeviceMetricType.name.label('metric'), Device.aggregator_id.label('aggregator_id'), bucket]
+    conditions = [Metric.device_metric_type_id.in_(metric_type_ids)]
+    if start is not None:
+        conditions.append(Snapshot.client_timestamp_epoch >= start)
+    if end is not None:
+        conditions.append(Snapshot.client_timestamp_epoch < end)
+
+    def joined(query):
+        return query.select_from(Metric)\
+            .join(Snapshot, Snapshot.snapshot_id == Metric.snapshot_id)\
+            .join(DeviceMetricType, DeviceMetricType.device_metric_type_id == Metric.device_metric_type_id)\
+            .join(Device, Device.device_id == DeviceMetricType.device_id)\
+            .where(and_(*conditions))
+
+    stats_query = joined(select(
+        *group_columns,
+        func.count(Metric.value).label('count'),
+        func.min(Metric.value).label('min'),
+        func.max(Metric.value).label('max'),
+        func.sum(Metric.value).label('sum'),
+        func.sum(Metric.value * Metric.value).label('sum_squares'),
+    )).group_by(*group_columns).order_by('metric', 'aggregator_id', 'bucket')
+    stats = pd.DataFrame(session.execute(stats_query).all(),
+                         columns=['metric', 'aggregator_id', 'bucket', 'count', 'min', 'max', 'sum', 'sum_squares'])
+    if not stats.empty:
+        stats['mean'] = stats['sum'] / stats['count']
+        variance = (stats['sum_squares'] - stats['sum'] ** 2 / stats['count']) / (stats['count'] - 1)
+        stats['stddev'] = np.sqrt(variance.clip(lower=0)).where(stats['count'] > 1)
+
+        if percentiles:
+            stats = add_percentiles(session, stats, joined, group_columns, percentiles)
+
+    cold = cold_storage.points(session, metric_type_ids, start, end)
+    if cold:
+        stats = add_cold_statistics(session, stats, cold, start, end, bucket_seconds, percentiles)
+    return stats
+
+
+def add_cold_statistics(session, stats, cold, start, end, bucket_seconds, percentiles):
+    """`stats` with the buckets that have packed points recomputed from their packed and raw values.
+
+    Those buckets are usually old enough to hold no raw rows at all, so
+    doing them in pandas costs little; the rest keep the SQL results.
+    """
+    points = pd.DataFrame(cold, columns=['timestamp', 'value', 'metric_type_id'])
+    points['bucket'] = points['timestamp'] // bucket_seconds * bucket_seconds
+    cold_ids = points['metric_type_id'].unique().tolist()
+    raw_start = int(points['bucket'].min())
+    raw_end = int(points['bucket'].max()) + bucket_seconds
+    if start is not None:
+        raw_start = max(raw_start, start)
+    if end is not None:
+        raw_end = min(raw_end, end)
+    raw = pd.DataFrame(session.execute(
+        select(Snapshot.client_timestamp_epoch, Metric.value, Metric.device_metric_type_id)
+        .join(Snapshot, Snapshot.snapshot_id == Metric.snapshot_id)
+        .where(Metric.device_metric_type_id.in_(cold_ids),
+               Snapshot.client_timestamp_epoch >= raw_start,
+               Snapshot.client_timestamp_epoch < raw_end)
+    ).all(), columns=['timestamp', 'value', 'metric_type_id'])
+    raw['bucket'] = raw['timestamp'] // bucket_seconds * bucket_seconds
+    # Only raw values in the buckets being recomputed
+    raw = raw.merge(points[['metric_type_id', 'bucket']].drop_duplicates(), on=['metric_type_id', 'bucket'])
+    values = pd.concat([points, raw], ignore_index=True) if not raw.empty else points
+    metric_types = {metric_type_id: catalog.metric_types[metric_type_id] for metric_type_id in cold_ids}
+    values['metric'] = values['metric_type_id'].map(
+        {metric_type_id: entry.name for metric_type_id, entry in metric_types.items()})
+    values['aggregator_id'] = values['metric_type_id'].map(
+        {metric_type_id: entry.aggregator_id for metric_type_id, entry in metric_types.items()})
+
+    grouped = values.groupby(['metric', 'aggregator_id', 'bucket'])['value']
+    recomputed = grouped.agg(['count', 'min', 'max', 'mean', 'std']).rename(columns={'std': 'stddev'})
+    for percentile in percentiles:
+        recomputed[percentile_label(percentile)] = grouped.quantile(percentile / 100)
+    recomputed = recomputed.reset_index()
+
+    if not stats.empty:
+        keys = ['metric', 'aggregator_id', 'bucket']
+        replaced = stats.set_index(keys).index.isin(recomputed.set_index(keys).index)
+        stats = pd.concat([stats[~replaced], recomputed], ignore_index=True)
+    else:
+        stats = recomputed
+    return stats.sort_values(['metric', 'aggregator_id', 'bucket'], ignore_index=True)
+
+
+def add_percentiles(session, stats, joined, group_columns, percentiles):
+    """Linearly interpolated percentiles (numpy's default) as p<N> columns of `stats`"""
+    partition = [column.element if hasattr(column, 'element') else column for column in group_columns]
+    ranked = joined(select(
+        *group_columns,
+        Metric.value.label('value'),
+        (func.row_number().over(partition_by=partition, order_by=Metric.value) - 1).label('value_rank'),
+        func.count().over(partition_by=partition).label('n'),
+    )).subquery()
+
+    # Only the ranks each percentile interpolates between leave the database
+    wanted = []
+    for percentile in percentiles:
+        lower = cast(percentile / 100 * (ranked.c.n - 1), Integer)
+        wanted.append(ranked.c.value_rank == lower)
+        wanted.append(ranked.c.value_rank == lower + 1)
+    rows = session.execute(
+        select(ranked.c.metric, ranked.c.aggregator_id, ranked.c.bucket, ranked.c.value_rank, ranked.c.value)
+        .where(or_(*wanted))
+    ).all()
+    ranks = pd.DataFrame(rows, columns=['metric', 'aggregator_id', 'bucket', 'rank', 'value'])
+    keys = ['metric', 'aggregator_id', 'bucket']
+    ranks = ranks.set_index(keys + ['rank'])['value']
+
+    counts = stats.set_index(keys)['count']
+    for percentile in percentiles:
+        position = percentile / 100 * (counts - 1)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, counts - 1)
+        lower_values = ranks.reindex(pd.MultiIndex.from_arrays(
+            [counts.index.get_level_values(key) for key in keys] + [lower.values], names=keys + ['rank'])).values
+        upper_values = ranks.reindex(pd.MultiIndex.from_arrays(
+            [counts.index.get_level_values(key) for key in keys] + [upper.values], names=keys + ['rank'])).values
+        fraction = (position - lower).values
+        stats[percentile_label(percentile)] = lower_values + fraction * (upper_values - lower_values)
+    return stats
@@ -1,65 +1,235 @@
 from models import *
+from metadata_catalog import catalog
+from instrumentation import record_ingest
+from alerts import alert_engine
+from sharding import shard_router
 from datetime import timezone, datetime
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+import time
 import logging
 
 logger = logging.getLogger(__name__)
+
+def new_entities():
+    """Entities created by a batch, handed to catalog.register once committed"""
+    return {'aggregators': [], 'devices': [], 'metric_types': []}
+
+# Rows the resolve_* functions may create concurrently are written with an
+# insert that does nothing on a unique key conflict, then selected: whichever
+# request inserted the row, both end up with its id.
+INSERT_RETRIES = 3
+
+def insert_or_ignore(session, model, values, key_columns):
+    """Id of the row with `values`' key, inserting it unless it already exists"""
+    dialect = session.get_bind(mapper=model.__mapper__).dialect.name
+    key = {column: values[column] for column in key_columns}
+    id_column = model.__mapper__.primary_key[0]
+    for _ in range(INSERT_RETRIES):
+        if dialect in ('sqlite', 'postgresql'):
+            dialect_insert = sqlite_insert if dialect == 'sqlite' else postgresql_insert
+            session.execute(dialect_insert(model).values(**values).on_conflict_do_nothing(index_elements=key_columns))
+        else:
+            try:
+                with session.begin_nested():
+                    session.execute(insert(model).values(**values))
+            except IntegrityError:
+                pass
+        row_id = session.execute(select(id_column).filter_by(**key)).scalar()
+        if row_id is not None:
+            return row_id
+        # The conflicting row was rolled back between the insert and the select
+        logger.debug(f"Retrying insert of {model.__tablename__} {key}")
+    raise RuntimeError(f"Could not create {model.__tablename__} {key}")
+
+# The resolve_* functions look an id up in the catalog, then in `pending`
+# (created earlier in this batch, not committed yet), and only then go to
+# the database.
+
+def resolve_aggregator_id(session, guid, name, pending, created):
+    key = ('aggregator', str(guid))
+    aggregator_id = catalog.get_aggregator_id(guid) or pending.get(key)
+    if aggregator_id is None:
+        logger.debug("Aggregator not in the catalog, creating it if needed")
+        aggregator_id = insert_or_ignore(session, Aggregator, {'guid': str(guid), 'name': name}, ['guid'])
+        created['aggregators'].append((aggregator_id, str(guid), name))
+        pending[key] = aggregator_id
+    return aggregator_id
+
+def resolve_device_id(session, aggregator_id, name, pending, created):
+    key = ('device', aggregator_id, name)
+    device_id = catalog.get_device_id(aggregator_id, name) or pending.get(key)
+    if device_id is None:
+        device_id = insert_or_ignore(
+            session, Device, {'aggregator_id': aggregator_id, 'name': name}, ['aggregator_id', 'name'])
+        created['devices'].append((device_id, aggregator_id, name))
+        pending[key] = device_id
+    return device_id
+
+def resolve_metric_type_id(session, device_id, name, pending, created):
+    key = ('metric_type', device_id, name)
+    metric_type_id = catalog.get_metric_type_id(device_id, name) or pending.get(key)
+    if metric_type_id is None:
+        metric_type_id = insert_or_ignore(
+            session, DeviceMetricType, {'device_id': device_id, 'name': name}, ['device_id', 'name'])
+        created['metric_types'].append((metric_type_id, device_id, name))
+        pending[key] = metric_type_id
+    return metric_type_id
+
+def commit_metadata_first(session, created):
+    """With sharded storage, commit the entities a batch created before its snapshots.
+
+    The metadata is in the main database and the snapshots are in a shard
+    that attaches it. In WAL mode a transaction across attached databases
+    is only atomic per file, so a crash between the two file commits could
+    leave shard metrics pointing at metric types that were never
+    committed. Committing the metadata on its own first makes unused
+    metadata the worst case. Returns the entities still to register.
+    """
+    if not shard_router.enabled or not any(created.values()):
+        return created
+    session.commit()
+    catalog.register(**created)
+    return new_entities()
+
+# Attempts at an ingest transaction that keeps failing with "database is
+# locked", i.e. waited out the whole busy timeout
+LOCKED_RETRIES = 3
+
+def is_locked_error(error):
+    return 'database is locked' in str(error.orig)
+
 #session = db.session
 def map_dto_to_model(aggregator_dto, session):
     logger.info(f"Beginning Mapping DTO to Model")
-    
+    catalog.sync(session)
+
+    for attempt in range(1, LOCKED_RETRIES + 1):
+        try:
+            created, metric_rows, ingest_lags = add_aggregator_dto(aggregator_dto, session)
+            break
+        except OperationalError as e:
+            session.rollback()
+            if attempt == LOCKED_RETRIES or not is_locked_error(e):
+                raise
+            logger.warning(f"Database locked, retrying ingest for {aggregator_dto.name} (attempt {attempt})")
+            time.sleep(0.1 * attempt)
+
+    catalog.register(**created)
+    record_ingest(aggregator_dto.name, metric_rows, ingest_lags)
+    session.close()
+
+def add_aggregator_dto(aggregator_dto, session):
+    """Write one DTO in a single transaction; nothing outside the session changes until it commits"""
+    pending = {}
+    created = new_entities()
+    # For the ingest metrics: rows written and capture-to-receipt lag per snapshot
+    metric_rows = 0
+    ingest_lags = []
+    # (metric type, client timestamp, value) in arrival order, for the alert rules
+    alert_samples = []
+
     # Check if the aggregator already exists
-    aggregator_model = session.query(Aggregator).filter_by(guid=aggregator_dto.guid).first()
-    if not aggregator_model:
-        logger.debug("Aggregator does not exist. Creating new aggregator")
-        aggregator_model = Aggregator(
-            guid=aggregator_dto.guid,
-            name=aggregator_dto.name
-        )
-        session.add(aggregator_model)
-        session.flush()
-        logger.debug("Aggregator created")
-    
+    aggregator_id = resolve_aggregator_id(session, aggregator_dto.guid, aggregator_dto.name, pending, created)
+    if shard_router.enabled:
+        for device_dto in aggregator_dto.devices:
+            device_id = resolve_device_id(session, aggregator_id, device_dto.name, pending, created)
+            for snapshot_dto in device_dto.snapshots:
+                for metric_dto in snapshot_dto.metrics:
+                    resolve_metric_type_id(session, device_id, metric_dto.name, pending, created)
+        created = commit_metadata_first(session, created)
+
     for device_dto in aggregator_dto.devices:
         # Check if the device already exists
-        device_model = session.query(Device).filter_by(name=device_dto.name, aggregator=aggregator_model).first()
-        if not device_model:
-            device_model = Device(
-                name=device_dto.name,
-                aggregator=aggregator_model
-            )
-            session.add(device_model)
-            session.flush()
-        
+        device_id = resolve_device_id(session, aggregator_id, device_dto.name, pending, created)
+
         for snapshot_dto in device_dto.snapshots:
             snapshot_model = Snapshot(
-                device=device_model,
+                device_id=device_id,
                 client_timestamp_epoch=int(snapshot_dto.timestamp_capture.timestamp()),
                 client_timezon_mins=snapshot_dto.timezone_mins,
                 server_timestamp_epoch=int(datetime.now(timezone.utc).timestamp()),
                 server_timezone_mins=datetime.now(timezone.utc).utcoffset().total_seconds() // 60
             )
             session.add(snapshot_model)
-            session.flush()
-            
+            ingest_lags.append(snapshot_model.server_timestamp_epoch - snapshot_model.client_timestamp_epoch)
+            metric_rows += len(snapshot_dto.metrics)
+
             for metric_dto in snapshot_dto.metrics:
                 # Check if the metric type already exists
-                metric_type_model = session.query(DeviceMetricType).filter_by(name=metric_dto.name, device=device_model).first()
-                if not metric_type_model:
-                    metric_type_model = DeviceMetricType(
-                        name=metric_dto.name,
-                        device=device_model
-                    )
-                    session.add(metric_type_model)
-                    session.flush()
-                    
+                metric_type_id = resolve_metric_type_id(session, device_id, metric_dto.name, pending, created)
+
                 metric_model = Metric(
                     snapshot=snapshot_model,
                     value=metric_dto.value,
-                    device_metric_type=metric_type_model
+                    device_metric_type_id=metric_type_id
                 )
-                
+
                 session.add(metric_model)
+                alert_samples.append((metric_type_id, snapshot_model.client_timestamp_epoch, metric_dto.value))
+
+    # Alert events are committed together with the metrics that caused
+    # them. The flush comes first so the batch holds the write lock before
+    # the alert engine holds its series, see AlertEngine
+    session.flush()
+    alert_batch = alert_engine.evaluate(
+        session, alert_samples, int(datetime.now(timezone.utc).timestamp()), created)
+    try:
+        session.add_all(alert_batch.events)
+        session.commit()
+    except Exception:
+        alert_engine.discard(alert_batch)
+        raise
+    alert_engine.commit(alert_batch)
+    return created, metric_rows, ingest_lags
+
+def bulk_insert_snapshots(snapshots, session):
+    """Insert already validated snapshots with one executemany per table and commit.
+
+    Each snapshot is a (guid, aggregator_name, device_name,
+    client_timestamp_epoch, timezone_mins, [(metric_name, value), ...])
+    tuple. Used for backfills, where building ORM objects per metric would
+    dominate; returns the number of snapshots and metrics written.
+    """
+    catalog.sync(session)
+    pending = {}
+    created = new_entities()
+    server_timestamp = int(datetime.now(timezone.utc).timestamp())
+
+    snapshot_rows = []
+    metric_types = []
+    for guid, aggregator_name, device_name, client_timestamp, timezone_mins, metrics in snapshots:
+        aggregator_id = resolve_aggregator_id(session, guid, aggregator_name, pending, created)
+        device_id = resolve_device_id(session, aggregator_id, device_name, pending, created)
+        snapshot_rows.append({
+            'device_id': device_id,
+            'client_timestamp_epoch': client_timestamp,
+            'client_timezon_mins': timezone_mins,
+            'server_timestamp_epoch': server_timestamp,
+            'server_timezone_mins': 0,
+        })
+        metric_types.append([
+            (resolve_metric_type_id(session, device_id, name, pending, created), value)
+            for name, value in metrics
+        ])
+
+    created = commit_metadata_first(session, created)
+    metric_rows = []
+    if snapshot_rows:
+        # Ids come back in the order of snapshot_rows, so metrics can point at them
+        snapshot_ids = session.execute(
+            insert(Snapshot).returning(Snapshot.snapshot_id, sort_by_parameter_order=True),
+            snapshot_rows
+        ).scalars().all()
+        for snapshot_id, metrics in zip(snapshot_ids, metric_types):
+            metric_rows.extend(
+                {'snapshot_id': snapshot_id, 'value': value, 'device_metric_type_id': metric_type_id}
+                for metric_type_id, value in metrics
+            )
+        if metric_rows:
+            session.execute(insert(Metric), metric_rows)
     session.commit()
-    session.close()
-    
-    
\ No newline at end of file
+    catalog.register(**created)
+    return len(snapshot_rows), len(metric_rows)
@@ -0,0 +1,319 @@
+from dataclasses import dataclass
+from typing import Optional
+from metadata_catalog import catalog
+from models import AlertEvent
+from sqlalchemy import func, select
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONDITIONS = ('threshold', 'sustained', 'rate_of_change')
+FIRED = 'fired'
+RESOLVED = 'resolved'
+
+
+@dataclass(frozen=True)
+class AlertRule:
+    """One rule from the "alerts" section of config.json.
+
+    threshold       fires while a sample is above `above` / below `below`
+    sustained       fires once `samples` consecutive samples breach
+    rate_of_change  fires while the change per `per_seconds` between two
+                    consecutive samples is above `above` / below `below`
+
+    A rule applies to every series of `metric`, or only to those of
+    `aggregator` (guid or name) if given.
+    """
+    name: str
+    metric: str
+    condition: str = 'threshold'
+    above: Optional[float] = None
+    below: Optional[float] = None
+    samples: int = 1
+    per_seconds: float = 60.0
+    aggregator: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, config):
+        try:
+            rule = cls(**config)
+        except TypeError as e:
+            raise ValueError(f"Invalid alert rule {config!r}: {e}")
+        if rule.condition not in CONDITIONS:
+            raise ValueError(f"Alert rule {rule.name}: unknown condition {rule.condition!r}, expected one of {CONDITIONS}")
+        if rule.above is None and rule.below is None:
+            raise ValueError(f"Alert rule {rule.name}: needs 'above' or 'below'")
+        if rule.samples < 1 or rule.per_seconds <= 0:
+            raise ValueError(f"Alert rule {rule.name}: 'samples' and 'per_seconds' must be positive")
+        return rule
+
+    def breached(self, value):
+        return (self.above is not None and value > self.above) or \
+            (self.below is not None and value < self.below)
+
+    def applies_to(self, metric_name, aggregator):
+        """Whether the rule covers a series of `metric_name` on `aggregator` ((guid, name) or None)"""
+        if metric_name != self.metric:
+            return False
+        if self.aggregator is None:
+            return True
+        return aggregator is not None and self.aggregator in aggregator
+
+
+@dataclass
+class SeriesState:
+    """Everything a rule remembers about one series, whatever its length"""
+    firing: bool = False
+    streak: int = 0
+    last_timestamp: Optional[int] = None
+    last_value: Optional[float] = None
+
+
+@dataclass
+class AlertBatch:
+    """What evaluate() found for one ingest batch, until commit() or discard()"""
+    events: list
+    states: dict
+    locks: list
+
+
+class AlertEngine:
+    """Evaluates the configured rules against each ingested batch.
+
+    Samples are checked as they arrive, so detecting a breach never needs
+    a query over stored metrics. State is kept per series (rule and metric
+    type). Streaks and the last sample are kept per process. The firing
+    flag is read from the series' latest stored event in every batch, so
+    neither a restart nor another worker process firing or resolving in
+    between leads to a duplicate event.
+
+    evaluate() must run after the batch's rows are flushed, and holds the
+    batch's series until commit() (after the ingest transaction has been
+    committed) or discard() (after it failed). A concurrent batch for the
+    same series therefore starts from the state this one leaves. Because
+    the series are taken after the batch's writes, a SQLite batch already
+    holds the database write lock, and nothing waits on it while holding a
+    series.
+    """
+
+    def __init__(self):
+        self.rules = []
+        self._states = {}
+        self._series_locks = {}
+        self._rules_by_metric_type = {}
+        self._catalog_version = None
+        self._lock = threading.Lock()
+
+    def configure(self, rule_configs):
+        rules = [AlertRule.from_config(config) for config in rule_configs]
+        names = [rule.name for rule in rules]
+        if len(names) != len(set(names)):
+            raise ValueError("Alert rule names must be unique")
+        with self._lock:
+            self.rules = rules
+            self._states = {}
+            self._rules_by_metric_type = {}
+        logger.info(f"{len(rules)} alert rules configured")
+
+    def reset(self):
+        with self._lock:
+            self._states = {}
+            self._rules_by_metric_type = {}
+
+    def _rules_for(self, metric_type_id, created):
+        """Rules covering a metric type, also one created by the batch being ingested"""
+        if self._catalog_version != catalog.version:
+            self._rules_by_metric_type = {}
+            self._catalog_version = catalog.version
+        rules = self._rules_by_metric_type.get(metric_type_id)
+        if rules is not None:
+            return rules
+        metric_type = catalog.metric_types.get(metric_type_id)
+        if metric_type is not None:
+            aggregator = catalog.aggregators.get(metric_type.aggregator_id)
+            rules = [rule for rule in self.rules if rule.applies_to(
+                metric_type.name, (aggregator.guid, aggregator.name) if aggregator else None)]
+            self._rules_by_metric_type[metric_type_id] = rules
+            return rules
+        # Not committed yet, so not cached either: the id is only taken if
+        # the ingest commits
+        metric_name, aggregator = describe_created(metric_type_id, created)
+        return [rule for rule in self.rules if rule.applies_to(metric_name, aggregator)]
+
+    def _load_firing(self, session, rule, metric_type_id):
+        latest = session.execute(
+            select(AlertEvent.state)
+            .where(AlertEvent.rule == rule.name, AlertEvent.device_metric_type_id == metric_type_id)
+            .order_by(AlertEvent.alert_event_id.desc())
+            .limit(1)
+        ).scalar()
+        return latest == FIRED
+
+    def _series_lock(self, key):
+        with self._lock:
+            return self._series_locks.setdefault(key, threading.Lock())
+
+    def evaluate(self, session, samples, server_timestamp, created=None):
+        """Check (device_metric_type_id, client_timestamp, value) samples, in order.
+
+        `created` are the entities the batch created (see
+        aggregator_mapping.new_entities), so a new series is evaluated
+        from its first batch. Returns an AlertBatch: add its events to the
+        session, then pass it to commit() or discard().
+        """
+        if not self.rules:
+            return AlertBatch([], {}, [])
+        created = created or {}
+        rules_by_metric_type = {}
+        for metric_type_id, _, _ in samples:
+            if metric_type_id not in rules_by_metric_type:
+                rules_by_metric_type[metric_type_id] = self._rules_for(metric_type_id, created)
+        series = {(rule.name, metric_type_id): rule
+                  for metric_type_id, rules in rules_by_metric_type.items() for rule in rules}
+        # Always taken in the same order, so two batches can't deadlock
+        locks = [self._series_lock(key) for key in sorted(series)]
+        for lock in locks:
+            lock.acquire()
+        batch = AlertBatch([], {}, locks)
+        try:
+            for key, rule in series.items():
+                current = self._states.get(key) or SeriesState()
+                state = batch.states[key] = SeriesState(**vars(current))
+                # Another process may have fired or resolved since
+                state.firing = self._load_firing(session, rule, key[1])
+            for metric_type_id, timestamp, value in samples:
+                for rule in rules_by_metric_type[metric_type_id]:
+                    event = self._step(rule, batch.states[(rule.name, metric_type_id)], metric_type_id,
+                                       timestamp, value, server_timestamp, created)
+                    if event is not None:
+                        batch.events.append(event)
+        except Exception:
+            self.discard(batch)
+            raise
+        return batch
+
+    def commit(self, batch):
+        """Apply the states of a batch whose transaction has committed, and release its series"""
+        with self._lock:
+            self._states.update(batch.states)
+        self.discard(batch)
+
+    def discard(self, batch):
+        """Release the series of a batch, keeping the states from before it"""
+        while batch.locks:
+            batch.locks.pop().release()
+
+    def _step(self, rule, state, metric_type_id, timestamp, value, server_timestamp, created):
+        if rule.condition == 'rate_of_change':
+            observed = None
+            if state.last_timestamp is not None and timestamp > state.last_timestamp:
+                observed = (value - state.last_value) / (timestamp - state.last_timestamp) * rule.per_seconds
+            state.last_timestamp, state.last_value = timestamp, value
+            if observed is None:
+                return None
+            breached = rule.breached(observed)
+        else:
+            observed = value
+            breached = rule.breached(value)
+
+        state.streak = state.streak + 1 if breached else 0
+        required = rule.samples if rule.condition == 'sustained' else 1
+        if not state.firing and state.streak >= required:
+            state.firing = True
+            return self._event(rule, FIRED, metric_type_id, timestamp, value, server_timestamp, observed, created)
+        if state.firing and not breached:
+            state.firing = False
+            return self._event(rule, RESOLVED, metric_type_id, timestamp, value, server_timestamp, observed, created)
+        return None
+
+    def _event(self, rule, event_state, metric_type_id, timestamp, value, server_timestamp, observed, created):
+        metric_type = catalog.metric_types.get(metric_type_id)
+        if metric_type is not None:
+            aggregator = catalog.aggregators.get(metric_type.aggregator_id)
+            aggregator_name = aggregator.name if aggregator else None
+        else:
+            _, aggregator = describe_created(metric_type_id, created)
+            aggregator_name = aggregator[1] if aggregator else None
+        subject = f"{rule.metric} on {aggregator_name or 'unknown aggregator'}"
+        if rule.condition == 'rate_of_change':
+            detail = f"changing by {observed:.4g} per {rule.per_seconds:g}s"
+        elif rule.condition == 'sustained':
+            detail = f"{value:.4g} for {rule.samples} samples"
+        else:
+            detail = f"{value:.4g}"
+        limits = " and ".join(
+            f"{word} {limit:g}" for word, limit in (('above', rule.above), ('below', rule.below)) if limit is not None)
+        message = f"{rule.name}: {subject} is {detail} ({limits})" if event_state == FIRED \
+            else f"{rule.name}: {subject} back to normal at {value:.4g}"
+        if event_state == FIRED:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        return AlertEvent(
+            rule=rule.name,
+            device_metric_type_id=metric_type_id,
+            state=event_state,
+            value=value,
+            client_timestamp_epoch=timestamp,
+            server_timestamp_epoch=server_timestamp,
+            message=message
+        )
+
+
+def describe_created(metric_type_id, created):
+    """(metric name, (aggregator guid, name)) of a metric type created by the batch being ingested.
+
+    Its device and aggregator may be new too, or already in the catalog.
+    """
+    metric_type = next((entry for entry in created.get('metric_types', ()) if entry[0] == metric_type_id), None)
+    if metric_type is None:
+        return None, None
+    _, device_id, metric_name = metric_type
+    device = catalog.devices.get(device_id)
+    if device is not None:
+        aggregator_id = device.aggregator_id
+    else:
+        aggregator_id = next((entry[1] for entry in created.get('devices', ()) if entry[0] == device_id), None)
+    aggregator = catalog.aggregators.get(aggregator_id)
+    if aggregator is not None:
+        return metric_name, (aggregator.guid, aggregator.name)
+    aggregator = next((entry for entry in created.get('aggregators', ()) if entry[0] == aggregator_id), None)
+    return metric_name, (aggregator[1], aggregator[2]) if aggregator else None
+
+
+def list_alert_events(session, rule=None, state=None, since=None, active=False, limit=100):
+    """Stored events, newest first; with `active`, the latest event of each series that is still firing"""
+    query = select(AlertEvent)
+    if active:
+        latest = select(func.max(AlertEvent.alert_event_id))\
+            .group_by(AlertEvent.rule, AlertEvent.device_metric_type_id)
+        query = query.where(AlertEvent.alert_event_id.in_(latest), AlertEvent.state == FIRED)
+    if rule:
+        query = query.where(AlertEvent.rule == rule)
+    if state:
+        query = query.where(AlertEvent.state == state)
+    if since is not None:
+        query = query.where(AlertEvent.client_timestamp_epoch >= since)
+    query = query.order_by(AlertEvent.alert_event_id.desc()).limit(limit)
+
+    events = []
+    for event in session.execute(query).scalars():
+        metric_type = catalog.metric_types.get(event.device_metric_type_id)
+        aggregator = catalog.aggregators.get(metric_type.aggregator_id) if metric_type else None
+        events.append({
+            'id': event.alert_event_id,
+            'rule': event.rule,
+            'state': event.state,
+            'metric': metric_type.name if metric_type else None,
+            'aggregator': aggregator.name if aggregator else None,
+            'aggregator_guid': aggregator.guid if aggregator else None,
+            'value': event.value,
+            'client_timestamp_epoch': event.client_timestamp_epoch,
+            'server_timestamp_epoch': event.server_timestamp_epoch,
+            'message': event.message,
+        })
+    return events
+
+
+alert_engine = AlertEngine()
@@ -0,0 +1,211 @@
+from models import db, Snapshot, Metric
+from sharding import shard_router
+from cold_storage import cold_storage, merge_history
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('sqlalchemy', 'duckdb')
+DUCKDB_MODES = ('attach', 'export')
+
+
+class SqlAlchemyBackend:
+    """The default: history scans run against the app database through the ORM session"""
+
+    name = 'sqlalchemy'
+
+    def metric_history(self, metric_type_ids):
+        return self.query(db.session, metric_type_ids)
+
+    @staticmethod
+    def query(session, metric_type_ids):
+        rows = [
+            tuple(row) for row in session.query(
+                Snapshot.client_timestamp_epoch, Metric.value, Metric.device_metric_type_id
+            )
+            .select_from(Snapshot)
+            .join(Metric, Snapshot.snapshot_id == Metric.snapshot_id)
+            .filter(Metric.device_metric_type_id.in_(metric_type_ids))
+            .order_by(Snapshot.client_timestamp_epoch, Metric.metric_id)
+            .all()
+        ]
+        return merge_history(rows, cold_storage.points(session, metric_type_ids))
+
+
+class ShardedBackend:
+    """History scans run on every shard holding the series, in parallel, and merged by time"""
+
+    name = 'sharded'
+
+    def metric_history(self, metric_type_ids):
+        # Ties between shards keep shard order; within a shard, insertion order
+        return shard_router.metric_rows(SqlAlchemyBackend.query, metric_type_ids, key=lambda row: row[0])
+
+
+class DuckDBBackend:
+    """History scans run by embedded DuckDB over the SQLite database file.
+
+    In 'attach' mode DuckDB reads the SQLite file directly (read only) on
+    every query. In 'export' mode the joined (timestamp, value, metric type)
+    rows are copied into a Parquet file, sorted by time, and queries read
+    that; the copy is refreshed on first use after `export_interval`
+    seconds, so results can lag ingest by up to that much.
+    """
+
+    name = 'duckdb'
+
+    def __init__(self, sqlite_path, mode='attach', export_path='analytics/metrics.parquet', export_interval=300.0):
+        import duckdb
+        self._duckdb = duckdb
+        self.sqlite_path = sqlite_path
+        self.mode = mode
+        self.export_path = os.path.abspath(export_path)
+        self.export_interval = export_interval
+        self._connection = None
+        self._connection_pid = None
+        self._connect_lock = threading.Lock()
+        self._exported_at = None
+        self._export_lock = threading.Lock()
+
+    @staticmethod
+    def _quote(value):
+        return str(value).replace("'", "''")
+
+    def _cursor(self):
+        with self._connect_lock:
+            # Opened lazily, and again in a forked worker: the connection
+            # must not be inherited from the parent process
+            if self._connection is None or self._connection_pid != os.getpid():
+                connection = self._duckdb.connect()
+                connection.execute("INSTALL sqlite")
+                connection.execute("LOAD sqlite")
+                connection.execute(f"ATTACH '{self._quote(self.sqlite_path)}' AS metrics_db (TYPE SQLITE, READ_ONLY)")
+                self._connection = connection
+                self._connection_pid = os.getpid()
+        # A DuckDB connection must not be shared between threads, a cursor
+        # is a separate connection to the same database
+        return self._connection.cursor()
+
+    def _source(self):
+        if self.mode == 'export':
+            self.refresh_export()
+            return f"read_parquet('{self._quote(self.export_path)}')"
+        return (
+            "(SELECT s.client_timestamp_epoch, m.value, m.device_metric_type_id, m.metric_id "
+            "FROM metrics_db.snapshots s JOIN metrics_db.metrics m ON s.snapshot_id = m.snapshot_id)"
+        )
+
+    def refresh_export(self, force=False):
+        """Rewrite the Parquet copy if it is older than `export_interval`"""
+        if not force and self._exported_at is not None \
+                and time.monotonic() - self._exported_at < self.export_interval:
+            return
+        with self._export_lock:
+            if not force and self._exported_at is not None \
+                    and time.monotonic() - self._exported_at < self.export_interval:
+                return
+            started = time.perf_counter()
+            os.makedirs(os.path.dirname(self.export_path), exist_ok=True)
+            temp_path = self.export_path + '.tmp'
+            cursor = self._cursor()
+            try:
+                cursor.execute(
+                    "COPY (SELECT s.client_timestamp_epoch, m.value, m.device_metric_type_id, m.metric_id "
+                    "FROM metrics_db.snapshots s JOIN metrics_db.metrics m ON s.snapshot_id = m.snapshot_id "
+                    "ORDER BY s.client_timestamp_epoch, m.metric_id) "
+                    f"TO '{self._quote(temp_path)}' (FORMAT PARQUET)"
+                )
+            finally:
+                cursor.close()
+            os.replace(temp_path, self.export_path)
+            self._exported_at = time.monotonic()
+            logger.info(f"Exported metrics to {self.export_path} in {time.perf_counter() - started:.1f}s")
+
+    def check(self):
+        cursor = self._cursor()
+        try:
+            cursor.execute("SELECT count(*) FROM metrics_db.device_metric_types").fetchall()
+        finally:
+            cursor.close()
+
+    def metric_history(self, metric_type_ids):
+        if not metric_type_ids:
+            return []
+        cursor = self._cursor()
+        try:
+            rows = [tuple(row) for row in cursor.execute(
+                "SELECT client_timestamp_epoch, value, device_metric_type_id "
+                f"FROM {self._source()} "
+                "WHERE list_contains(?, device_metric_type_id) "
+                "ORDER BY client_timestamp_epoch, metric_id",
+                [list(metric_type_ids)]
+            ).fetchall()]
+        finally:
+            cursor.close()
+        # Chunks are decoded in Python, DuckDB only scans the raw rows. A
+        # Parquet copy made before a packing run still holds what it packed,
+        # and packing goes oldest first, so only chunks older than the
+        # copy's first row are added
+        end = rows[0][0] if rows and self.mode == 'export' else None
+        return merge_history(rows, cold_storage.points(db.session, metric_type_ids, end=end))
+
+
+class AnalyticsReader:
+    """Runs the dashboard's long history scans on the configured backend.
+
+    Returns (timestamp, value, device_metric_type_id) rows ordered by time
+    whichever backend is used, packed history (see cold_storage) included.
+    DuckDB is optional: if it isn't installed, or the database isn't SQLite,
+    the SQLAlchemy backend is used instead.
+    """
+
+    def __init__(self):
+        self.backend = SqlAlchemyBackend()
+
+    def configure(self, config, database_url):
+        """Pick the backend from the "analytics" config section; `database_url` is the engine's URL"""
+        backend = config.get('backend', 'sqlalchemy')
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown analytics backend {backend!r}, expected one of {BACKENDS}")
+        self.backend = SqlAlchemyBackend()
+        if shard_router.enabled:
+            if backend == 'duckdb':
+                logger.warning("The DuckDB analytics backend doesn't read sharded storage, using the shards directly")
+            self.backend = ShardedBackend()
+            return
+        if backend != 'duckdb':
+            return
+        if database_url.get_backend_name() != 'sqlite' or not database_url.database:
+            logger.warning("The DuckDB analytics backend needs a SQLite database file, using SQLAlchemy")
+            return
+        mode = config.get('duckdb_mode', 'attach')
+        if mode not in DUCKDB_MODES:
+            raise ValueError(f"Unknown duckdb_mode {mode!r}, expected one of {DUCKDB_MODES}")
+        try:
+            backend = DuckDBBackend(
+                database_url.database,
+                mode,
+                config.get('export_path', 'analytics/metrics.parquet'),
+                config.get('export_interval_seconds', 300.0)
+            )
+        except ImportError:
+            logger.warning("duckdb is not installed, using the SQLAlchemy analytics backend")
+            return
+        try:
+            # Fails here rather than on the first dashboard read if DuckDB
+            # can't load its sqlite extension (it is downloaded on first use)
+            backend.check()
+        except Exception as e:
+            logger.warning(f"DuckDB can't read {database_url.database} ({e}), using the SQLAlchemy analytics backend")
+            return
+        self.backend = backend
+        logger.info(f"Analytics reads use DuckDB ({mode})")
+
+    def metric_history(self, metric_type_ids):
+        return self.backend.metric_history(metric_type_ids)
+
+
+analytics = AnalyticsReader()
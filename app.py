@@ -1,48 +1,264 @@
 from flask import Flask
-from models import db
+from models import db, SCHEMA_VERSION, set_sqlite_pragmas, sqlite_pragmas
 from routes import bp as api_bp
+from metadata_catalog import catalog
+from figure_cache import figure_cache
+from callback_profiler import callback_profiler
+from symbol_registry import symbol_registry
+from metric_import import MetricImporter, FORMATS
+from analytics_backend import analytics
+from sharding import shard_router
+from alerts import alert_engine
+from compression import compressor
+from cold_storage import cold_storage
+from query_plans import query_plans
+from aggregation import parse_duration
+from instrumentation import init_instrumentation
 from my_logging.logger import setup_logging # type: ignore
+from contextlib import contextmanager
+import click
+from sqlalchemy import text
 import logging
 import json
-import os 
-# Import and initialize the Dash application
-from dashboard import create_dash_app
+import os
+import subprocess
+import sys
+import threading
+import time
+import weakref
 
-app = Flask(__name__)
-with open('config.json') as config_file:
-    config = json.load(config_file)
+CONFIG_PATH = os.getenv('APP_CONFIG', 'config.json')
 
+def load_config(path=CONFIG_PATH):
+    with open(path) as config_file:
+        return json.load(config_file)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = config['database']['connection_string']
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
-setup_logging()
+@contextmanager
+def startup_phase(app, name):
+    """Record how long a phase of create_app takes, see startup_profile.py"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        app.extensions.setdefault('startup_timings', []).append((name, time.perf_counter() - started))
 
-app.logger.handlers = logging.getLogger().handlers
-app.logger.setLevel(logging.DEBUG)
+def ensure_schema(app):
+    """Create missing tables, at most once per schema version.
 
+    SQLite keeps SCHEMA_VERSION in `PRAGMA user_version`, so once one process
+    has created the schema every other worker only pays for that single read.
+    """
+    with app.app_context():
+        is_sqlite = db.engine.dialect.name == 'sqlite'
+        if is_sqlite:
+            with db.engine.connect() as connection:
+                user_version = connection.execute(text("PRAGMA user_version")).scalar()
+            if user_version == SCHEMA_VERSION:
+                app.logger.debug(f"Database schema is up to date (version {SCHEMA_VERSION})")
+                return
+
+        inspector = db.inspect(db.engine)
+        tables = inspector.get_table_names()
+        app.logger.debug(f"Tables before creation: {tables}")
+
+        db.create_all()
+
+        app.logger.debug(f"Tables after creation: {db.inspect(db.engine).get_table_names()}")
+
+        with db.engine.begin() as connection:
+            device_ids, metric_type_ids = merge_duplicate_metadata(connection)
+            # create_all only creates the indexes of tables it creates
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+        if device_ids or metric_type_ids:
+            shard_router.remap_metadata(device_ids, metric_type_ids)
+            app.logger.warning(f"Merged {len(device_ids)} duplicate devices "
+                               f"and {len(metric_type_ids)} duplicate metric types")
+
+        if is_sqlite:
+            with db.engine.begin() as connection:
+                connection.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+
+        app.logger.info("Database Setup Successfully")
+
+def merge_duplicate_metadata(connection):
+    """Merge devices and metric types that share a parent and name into the oldest one.
+
+    Concurrent ingests could create such duplicates before schema version
+    4 made these names unique; the unique indexes can only be created once
+    they are gone. Returns the ({old id: kept id}) maps for devices and for
+    metric types.
+    """
+    def duplicates(query):
+        kept = {}
+        merged = {}
+        for row_id, parent_id, name in connection.execute(text(query)):
+            kept_id = kept.setdefault((parent_id, name), row_id)
+            if kept_id != row_id:
+                merged[row_id] = kept_id
+        return merged
+
+    def merge(merged, table, id_column, references):
+        if not merged:
+            return
+        parameters = [{'old': old, 'new': new} for old, new in merged.items()]
+        for referencing_table, column in references:
+            connection.execute(
+                text(f"UPDATE {referencing_table} SET {column} = :new WHERE {column} = :old"), parameters)
+        connection.execute(text(f"DELETE FROM {table} WHERE {id_column} = :old"), parameters)
+
+    # Devices first: merging two devices can make their metric types duplicates
+    device_ids = duplicates("SELECT device_id, aggregator_id, name FROM devices ORDER BY device_id")
+    merge(device_ids, 'devices', 'device_id', [('snapshots', 'device_id'), ('device_metric_types', 'device_id')])
+    metric_type_ids = duplicates(
+        "SELECT device_metric_type_id, device_id, name FROM device_metric_types ORDER BY device_metric_type_id")
+    merge(metric_type_ids, 'device_metric_types', 'device_metric_type_id',
+          [('metrics', 'device_metric_type_id'), ('metric_chunks', 'device_metric_type_id'),
+           ('alert_events', 'device_metric_type_id')])
+    return device_ids, metric_type_ids
+
+def capture_query_plans(app):
+    """Explain the statements run on the app database and on every shard, see query_plans.py"""
+    with app.app_context():
+        query_plans.init_engine(db.engine)
+    for shard in shard_router.shards:
+        query_plans.init_engine(shard.engine)
+
+def exercise_queries(app):
+    """Run the dashboard's shared builders and the main API reads once"""
+    from dashboard import SHARED_FIGURES
+    client = app.test_client()
+    with app.app_context():
+        for builder in SHARED_FIGURES.values():
+            builder()
+        aggregators = catalog.aggregator_list()
+    if aggregators:
+        client.get(f'/api/aggregator?uuid={aggregators[0].guid}')
+    client.get('/api/aggregate?metric=CPU Percent&bucket=1h&percentile=95')
+    client.get('/api/alerts')
+
+def start_background_workers(app):
+    """Start per-process background threads.
+
+    Called from the first request rather than create_app so that, when the
+    app is preloaded in a pre-fork server's master, the threads are started
+    in each worker instead of being lost across the fork.
+    """
+    figure_cache_config = app.config['APP_CONFIG'].get('figure_cache', {})
+    if figure_cache_config.get('enabled', True):
+        figure_cache.refresh_interval = figure_cache_config.get('refresh_interval_seconds',
+                                                                figure_cache.refresh_interval)
+        figure_cache.start(app)
+    if cold_storage.enabled:
+        cold_storage.start(app)
+
+# The app whose connections a forked child must not share with its parent.
+# Only the most recent one: benchmarks create several apps in one process,
+# and a weak reference lets the earlier ones be freed
+_latest_app = None
+
+def _after_fork_in_child():
+    app = _latest_app() if _latest_app is not None else None
+    if app is None:
+        return
+    with app.app_context():
+        db.engine.dispose(close=False)
+    shard_router.dispose_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def create_app(config=None):
+    """Create and configure the Flask app with the API and the Dash dashboard"""
+    app = Flask(__name__)
+
+    with startup_phase(app, 'config'):
+        if config is None:
+            config = load_config()
+        app.config['APP_CONFIG'] = config
+        app.config['SQLALCHEMY_DATABASE_URI'] = config['database']['connection_string']
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        symbol_registry.configure(config.get('stock_symbols', {}).get('version_file', 'stock_symbols.version'))
+        callback_profiler.enabled = config.get('diagnostics', {}).get('profile_callbacks', False)
+        alert_engine.configure(config.get('alerts', {}).get('rules', []))
+        cold_storage.configure(config.get('cold_storage', {}))
+
+    with startup_phase(app, 'logging'):
+        setup_logging()
+        app.logger.handlers = logging.getLogger().handlers
+        app.logger.setLevel(logging.DEBUG)
+
+    with startup_phase(app, 'database'):
+        db.init_app(app)
+        with app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                pragmas = sqlite_pragmas(config['database'])
+                set_sqlite_pragmas(db.engine, pragmas)
+        # Before the schema check, which may need to update the shards too
+        sharding_config = config.get('sharding', {})
+        if sharding_config.get('enabled', False):
+            with app.app_context():
+                if db.engine.dialect.name != 'sqlite':
+                    raise ValueError("Sharded storage needs a SQLite database")
+                shard_router.configure(sharding_config, db.engine.url.database, pragmas)
+        if config['database'].get('check_schema_on_startup', True):
+            ensure_schema(app)
+        query_plans.configure(config.get('query_plans', {}))
+        if query_plans.enabled:
+            capture_query_plans(app)
+
+    with startup_phase(app, 'analytics'):
+        with app.app_context():
+            analytics.configure(config.get('analytics', {}), db.engine.url)
+
+    if config.get('instrumentation', {}).get('enabled', True):
+        with startup_phase(app, 'instrumentation'):
+            # Sharded snapshot and metric writes run on the shards' own engines
+            init_instrumentation(app, db, [shard.engine for shard in shard_router.shards])
+
+    with startup_phase(app, 'metadata_catalog'):
+        with app.app_context():
+            catalog.sync(db.session, force=True)
+        app.logger.info("Metadata catalog loaded")
+
+    # Important: Register the API blueprint with a prefix
+    # This ensures the Dash app takes over the root route
+    with startup_phase(app, 'blueprint'):
+        app.register_blueprint(api_bp, url_prefix='/api')
+    app.logger.info("API Blueprint registered")
 
-with app.app_context():
-    inspector = db.inspect(db.engine)
-    tables = inspector.get_table_names()
-    app.logger.debug(f"Tables before creation: {tables}")
-    
-    db.create_all()
-    
-    app.logger.debug(f"Tables after creation: {tables}")
-    
-    app.logger.info("Database Setup Successfully")
+    # Dash is imported here so that importing this module stays cheap
+    with startup_phase(app, 'dash'):
+        from dashboard import create_dash_app
+        create_dash_app(app)
+    app.logger.info("Dash app initialized")
 
-# Important: Register the API blueprint with a prefix
-# This ensures the Dash app takes over the root route
-app.register_blueprint(api_bp, url_prefix='/api')
+    compression_config = config.get('compression', {})
+    if compression_config.get('enabled', True):
+        # Covers the Dash routes as well as the API
+        compressor.configure(compression_config)
+        compressor.init_app(app)
 
-app.logger.info("API Blueprint registered")
+    background_lock = threading.Lock()
+    background_started = []
 
-dash_app = create_dash_app(app)
-app.logger.info("Dash app initialized")
+    @app.before_request
+    def ensure_background_workers():
+        if background_started:
+            return
+        with background_lock:
+            if not background_started:
+                start_background_workers(app)
+                background_started.append(True)
 
-def clear_all_data():
+    global _latest_app
+    _latest_app = weakref.ref(app)
+
+    register_commands(app)
+    return app
+
+def clear_all_data(app):
     with app.app_context():
         # Get all tables/models
         meta = db.metadata
@@ -50,13 +266,103 @@ def clear_all_data():
             app.logger.info(f"Clearing table {table}")
             db.session.execute(table.delete())
         db.session.commit()
+        shard_router.clear()
+        catalog.reset()
+        alert_engine.reset()
+        cold_storage.reset()
+        figure_cache.mark_stale()
         app.logger.info("All data cleared from database")
 
-@app.cli.command("clear-db")
-def clear_db_command():
-    """Clear all data from the database."""
-    clear_all_data()
-    print("Database cleared!")
+def register_commands(app):
+    @app.cli.command("clear-db")
+    def clear_db_command():
+        """Clear all data from the database."""
+        clear_all_data(app)
+        print("Database cleared!")
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create or upgrade the database schema."""
+        ensure_schema(app)
+        print("Database schema ready!")
+
+    @app.cli.command("import-metrics")
+    @click.argument('path')
+    @click.option('--format', 'file_format', type=click.Choice(FORMATS), help="Defaults to the file extension.")
+    @click.option('--workers', type=int, help="Parser processes, defaults to the number of CPUs.")
+    @click.option('--batch-size', type=int, default=20000, show_default=True, help="Metrics per committed batch.")
+    @click.option('--offset', type=int, help="Start at this record instead of the beginning.")
+    @click.option('--resume', is_flag=True, help="Continue from the offset saved by an earlier run.")
+    def import_metrics_command(path, file_format, workers, batch_size, offset, resume):
+        """Bulk import metrics from a JSON, NDJSON or CSV file.
+
+        A JSON document is decoded in this process, streamed if ijson is
+        installed and loaded whole otherwise; prefer NDJSON for big files.
+        """
+        with app.app_context():
+            importer = MetricImporter(db.session, path, file_format, workers, batch_size=batch_size)
+            if resume or offset is not None:
+                start = importer.resume(offset)
+                print(f"Resuming {path} at record {start}")
+            result = importer.run()
+        print(f"Imported {result['snapshots']} snapshots and {result['metrics']} metrics "
+              f"in {result['seconds']:.1f}s, {result['invalid']} invalid records skipped")
+        figure_cache.mark_stale()
+
+    @app.cli.command("pack-metrics")
+    @click.option('--older-than', help="Pack data older than this, e.g. 30d. Defaults to cold_storage.pack_older_than.")
+    def pack_metrics_command(older_than):
+        """Move old snapshots and metrics into compressed chunks."""
+        if older_than:
+            cold_storage.pack_older_than = parse_duration(older_than)
+        with app.app_context():
+            result = cold_storage.pack_all(progress=print)
+        print(f"Packed {result['points']} metrics into {result['chunks']} chunks ({result['bytes']} bytes)")
+
+    @app.cli.command("cold-storage-report")
+    def cold_storage_report_command():
+        """Report the compression ratio and decode throughput of the packed chunks."""
+        with app.app_context():
+            sessions = [shard.session() for shard in shard_router.shards] or [db.session]
+            for session in sessions:
+                print(json.dumps(cold_storage.report(session), indent=2))
+
+    @app.cli.command("query-plans")
+    @click.option('--exercise', is_flag=True, help="First run the dashboard builders and API reads with capture on.")
+    @click.option('--reset', is_flag=True, help="Forget previously captured statements first.")
+    @click.option('--flagged', is_flag=True, help="Only list statements with a flagged plan.")
+    @click.option('--fail-on-flagged', is_flag=True, help="Exit with status 1 if any plan is flagged.")
+    def query_plans_command(exercise, reset, flagged, fail_on_flagged):
+        """Report the captured query plans, flagging full scans and temp B-tree sorts."""
+        if reset:
+            query_plans.reset()
+        if exercise:
+            if not query_plans.enabled:
+                query_plans.enabled = True
+                capture_query_plans(app)
+            exercise_queries(app)
+        entries = query_plans.report()
+        flagged_count = sum(1 for entry in entries if entry['flags'])
+        for entry in entries:
+            if flagged and not entry['flags']:
+                continue
+            print(f"{'FLAGGED ' if entry['flags'] else ''}{entry['fingerprint']}, ran {entry['count']}x")
+            print(f"  sql:  {entry['sql'][:300]}")
+            for detail in entry['plan']:
+                print(f"  plan: {detail}")
+            for flag in entry['flags']:
+                print(f"  flag: {flag}")
+            for site in entry['call_sites']:
+                print(f"  from: {site}")
+        print(f"{len(entries)} statements in {query_plans.report_path}, {flagged_count} flagged")
+        if fail_on_flagged and flagged_count:
+            sys.exit(1)
+
+    @app.cli.command("startup-profile")
+    def startup_profile_command():
+        """Report per-phase import and initialization cost in a fresh interpreter."""
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'startup_profile.py')
+        subprocess.run([sys.executable, script], check=False)
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
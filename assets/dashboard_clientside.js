@@ -0,0 +1,179 @@
+/*
+ * Clientside callbacks for the dashboard (see create_dash_app in dashboard.py).
+ *
+ * These only restyle data the browser already has: the latest gauge
+ * readings and the raw stock series, shipped in dcc.Store components. So
+ * switching aggregator, stock symbol or stock view costs no server work.
+ * The figures match the ones dashboard.py used to build on the server.
+ */
+(function () {
+    var HORIZONTAL_LEGEND = {orientation: 'h', yanchor: 'bottom', y: 1.02, xanchor: 'center', x: 0.5};
+
+    function emptyFigure(template) {
+        return {data: [], layout: {template: template}};
+    }
+
+    // Stored timestamps are epoch seconds; plotly reads milliseconds on a date axis
+    function milliseconds(timestamps) {
+        return timestamps.map(function (timestamp) { return timestamp * 1000; });
+    }
+
+    // The naive UTC form pandas gives plotly, for shapes and annotations
+    function dateString(timestamp) {
+        return new Date(timestamp * 1000).toISOString().replace('T', ' ').replace('Z', '');
+    }
+
+    function gaugeFigure(metricName, reading, template) {
+        if (!reading) {
+            return emptyFigure(template);
+        }
+        return {
+            data: [{
+                type: 'indicator',
+                mode: 'gauge+number',
+                value: reading.value,
+                title: {text: metricName, font: {size: 24}},
+                gauge: {
+                    axis: {range: [0, 100]},
+                    bar: {color: reading.value < 70 ? 'darkblue' : 'red'},
+                    steps: [
+                        {range: [0, 50], color: 'lightgreen'},
+                        {range: [50, 70], color: 'yellow'},
+                        {range: [70, 100], color: 'pink'}
+                    ],
+                    threshold: {line: {color: 'red', width: 4}, thickness: 0.75, value: 90}
+                }
+            }],
+            layout: {
+                template: template,
+                annotations: [{
+                    text: 'Last updated: ' + reading.time,
+                    x: 0.5,
+                    y: -0.25,
+                    xref: 'paper',
+                    yref: 'paper',
+                    showarrow: false,
+                    font: {size: 14}
+                }],
+                height: 250,
+                margin: {l: 20, r: 20, t: 60, b: 60}
+            }
+        };
+    }
+
+    // Same rule as use_webgl in dashboard.py: the whole figure switches to
+    // WebGL once its largest trace passes the configured point count
+    function scatterType(pointCount, settings) {
+        var threshold = settings ? settings.webgl_threshold_points : null;
+        return threshold !== null && threshold !== undefined && pointCount > threshold ? 'scattergl' : 'scatter';
+    }
+
+    function percentChange(values) {
+        var first = values[0];
+        // As before: a series starting at 0 has no meaningful change, so it stays at 0
+        return values.map(function (value) { return first !== 0 ? (value - first) / first * 100 : 0; });
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        dashboard: {
+            /* CPU and RAM gauges of the selected aggregator, from {metric: {aggregator id: reading}} */
+            renderGauges: function (readings, aggregatorId, template) {
+                return ['CPU Percent', 'RAM Usage'].map(function (metricName) {
+                    var byAggregator = (readings || {})[metricName] || {};
+                    return gaugeFigure(metricName, aggregatorId ? byAggregator[String(aggregatorId)] : null, template);
+                });
+            },
+
+            /* Every stock, as % change from its first price ('normalized') or as prices */
+            renderStockPerformance: function (stocks, view, template, settings) {
+                if (!stocks || !stocks.symbols.length) {
+                    return emptyFigure(template);
+                }
+                var normalized = view !== 'price';
+                var first = Infinity;
+                var last = -Infinity;
+                var type = scatterType(Math.max.apply(null, stocks.symbols.map(function (symbol) {
+                    return stocks.series[symbol].t.length;
+                })), settings);
+                var traces = stocks.symbols.map(function (symbol) {
+                    var series = stocks.series[symbol];
+                    first = Math.min(first, series.t[0]);
+                    last = Math.max(last, series.t[series.t.length - 1]);
+                    return {
+                        type: type,
+                        mode: 'lines',
+                        name: symbol,
+                        x: milliseconds(series.t),
+                        y: normalized ? percentChange(series.v) : series.v
+                    };
+                });
+                var layout = {
+                    template: template,
+                    title: {
+                        text: normalized ? 'Stock Price Performance (% Change from Initial Price)' : 'Stock Prices',
+                        x: 0.5,
+                        y: 0.95
+                    },
+                    xaxis: {type: 'date', title: {text: 'Time'}},
+                    yaxis: {title: {text: normalized ? 'Percentage Change (%)' : 'Stock Price (USD)'}},
+                    legend: Object.assign({itemsizing: 'constant', itemwidth: 40}, HORIZONTAL_LEGEND),
+                    margin: {t: 100}
+                };
+                if (normalized) {
+                    // Reference line at 0% across the whole time range
+                    layout.shapes = [{
+                        type: 'line',
+                        x0: dateString(first),
+                        x1: dateString(last),
+                        y0: 0,
+                        y1: 0,
+                        line: {color: 'gray', width: 1, dash: 'dash'}
+                    }];
+                }
+                return {data: traces, layout: layout};
+            },
+
+            /* One stock's price, with its latest price called out */
+            renderStockLineChart: function (stocks, symbol, template, settings) {
+                var series = symbol && stocks ? stocks.series[symbol] : null;
+                if (!series) {
+                    return emptyFigure(template);
+                }
+                var latest = series.t.length - 1;
+                var metricName = 'Stock Price (' + symbol + ')';
+                return {
+                    data: [{
+                        type: scatterType(series.t.length, settings),
+                        mode: 'lines',
+                        name: '',
+                        showlegend: false,
+                        x: milliseconds(series.t),
+                        y: series.v,
+                        line: {color: '#636efa', dash: 'solid'},
+                        hovertemplate: 'timestamp=%{x}<br>value=%{y}<extra></extra>'
+                    }],
+                    layout: {
+                        template: template,
+                        title: {text: metricName + ' Over Time'},
+                        xaxis: {type: 'date', title: {text: 'Time'}},
+                        yaxis: {title: {text: 'Stock Price (USD)'}},
+                        legend: HORIZONTAL_LEGEND,
+                        annotations: [{
+                            text: '$' + series.v[latest].toFixed(2),
+                            x: dateString(series.t[latest]),
+                            y: series.v[latest],
+                            xref: 'x',
+                            yref: 'y',
+                            showarrow: true,
+                            arrowhead: 2,
+                            ax: 0,
+                            ay: -40,
+                            font: {size: 14, color: 'red'},
+                            bgcolor: 'white'
+                        }]
+                    }
+                };
+            }
+        }
+    });
+})();
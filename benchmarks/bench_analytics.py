@@ -0,0 +1,91 @@
+"""History scans on the SQLAlchemy analytics backend vs DuckDB (attach and export modes).
+
+    python benchmarks/bench_analytics.py --sizes 100000,1000000,10000000 --output analytics.json
+
+Times analytics.metric_history for the per-aggregator CPU history and the
+full stock history, and the dashboard figure or clientside data built on each. Before timing,
+every DuckDB result is checked against the SQLAlchemy one.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_app import ensure_database, environment, make_app, timed
+
+def backends(db_path, export_dir):
+    from analytics_backend import SqlAlchemyBackend, DuckDBBackend
+    yield 'sqlalchemy', SqlAlchemyBackend()
+    try:
+        attach = DuckDBBackend(db_path, 'attach')
+        attach.check()
+        export = DuckDBBackend(db_path, 'export', os.path.join(export_dir, 'metrics.parquet'), float('inf'))
+    except Exception as e:
+        print(f"DuckDB is not usable ({e}), only timing the SQLAlchemy backend")
+        return
+    yield 'duckdb-attach', attach
+    started = time.perf_counter()
+    export.refresh_export(force=True)
+    print(f"Parquet export took {time.perf_counter() - started:.2f}s")
+    yield 'duckdb-export', export
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100000,1000000', help="comma separated metric row counts")
+    parser.add_argument('--aggregators', type=int, default=4)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--metric-types', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'benchmarks', 'data'))
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        db_path, info = ensure_database(args.data_dir, size, args.aggregators, args.devices,
+                                        args.metric_types, args.seed)
+        app = make_app(db_path)
+        import dashboard
+        from analytics_backend import analytics, SqlAlchemyBackend
+        from metadata_catalog import catalog, STOCK_PRICE_CATEGORY
+
+        with app.app_context(), tempfile.TemporaryDirectory() as export_dir:
+            scans = {
+                'cpu_history': catalog.metric_type_ids('CPU Percent'),
+                'stock_history': catalog.metric_type_ids_for_category(STOCK_PRICE_CATEGORY),
+            }
+            figures = {
+                'create_time_series_graph': lambda: dashboard.create_time_series_graph('CPU Percent'),
+                'stock_series': dashboard.stock_series,
+            }
+            expected = {}
+            for backend_name, backend in backends(db_path, export_dir):
+                for scan, ids in scans.items():
+                    rows = backend.metric_history(ids)
+                    if backend_name == 'sqlalchemy':
+                        expected[scan] = rows
+                    elif rows != expected[scan]:
+                        raise AssertionError(f"{backend_name} returned different rows for {scan}")
+
+                timings = {scan: timed(lambda: backend.metric_history(ids), args.repeat) for scan, ids in scans.items()}
+                analytics.backend = backend
+                timings.update({name: timed(function, args.repeat) for name, function in figures.items()})
+
+                for benchmark, timing in timings.items():
+                    results.append({'metrics_target': size, 'metrics': info['metrics'],
+                                    'backend': backend_name, 'benchmark': benchmark, **timing})
+                    print(f"{size:>10} {backend_name:<14} {benchmark:<38} {timing['median_ms']:>10.2f} ms median")
+            analytics.backend = SqlAlchemyBackend()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'parameters': vars(args), 'results': results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""Ingest and query benchmarks at several database sizes.
+
+    python benchmarks/bench_app.py --sizes 10000,100000,1000000 --output results.json
+    python benchmarks/bench_app.py --sizes 10000 --compare results.json
+
+For each size a database is generated with datagen (kept in --data-dir, so
+later runs with the same parameters reuse it) and loaded into a fresh app.
+Timed on each:
+
+  post_aggregator   POST /api/aggregator through the test client
+  get_aggregator    GET /api/aggregator?uuid=... and, up to --max-get-all, GET /api/aggregator
+  dashboard         each fetch/figure function in dashboard.py
+
+POSTs write to a copy of the generated database, so every other timing
+sees exactly the generated data.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import datagen
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'min_ms': round(ordered[0] * 1000, 3),
+        'median_ms': round(statistics.median(ordered) * 1000, 3),
+        'p95_ms': round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+def timed(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def ensure_database(data_dir, size, aggregators, devices, metric_types, seed):
+    """Path and datagen info of a database with `size` metrics, generated only if not cached"""
+    os.makedirs(data_dir, exist_ok=True)
+    snapshots = datagen.snapshots_for(size, aggregators, devices, metric_types)
+    name = f'bench-{aggregators}x{devices}x{metric_types}x{snapshots}-seed{seed}'
+    db_path = os.path.join(data_dir, name + '.db')
+    info_path = os.path.join(data_dir, name + '.json')
+    if os.path.exists(db_path) and os.path.exists(info_path):
+        with open(info_path) as f:
+            return db_path, json.load(f)
+    print(f"Generating {db_path}")
+    info = datagen.generate(db_path, aggregators, devices, metric_types, snapshots, seed)
+    with open(info_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    return db_path, info
+
+def make_app(db_path):
+    from app import create_app
+    from metadata_catalog import catalog
+    catalog.reset()
+    return create_app({
+        'database': {'connection_string': f'sqlite:///{db_path}'},
+        # Background rebuilds would compete with the timings
+        'figure_cache': {'enabled': False},
+        'instrumentation': {'enabled': False},
+        'stock_symbols': {'version_file': db_path + '.symbols.version'},
+    })
+
+def make_payload(info, aggregator_index, first_step, snapshots):
+    metrics_per_snapshot = info['metric_names']
+    return {
+        'guid': info['aggregator_guids'][aggregator_index % len(info['aggregator_guids'])],
+        'name': f'bench-aggregator-{aggregator_index % len(info["aggregator_guids"]) + 1}',
+        'devices': [{
+            'name': info['device_names'][0],
+            'snapshots': [{
+                'timestamp_capture': datagen.START_EPOCH + (first_step + step) * datagen.SNAPSHOT_INTERVAL_SECONDS,
+                'timezone_mins': 0,
+                'metrics': [{'name': name, 'value': float(step)} for name in metrics_per_snapshot],
+            } for step in range(snapshots)],
+        }],
+    }
+
+def bench_post(db_path, info, requests, snapshots_per_request):
+    post_path = db_path + '.post.db'
+    shutil.copyfile(db_path, post_path)
+    app = make_app(post_path)
+    try:
+        client = app.test_client()
+        first_step = info['snapshots_per_device']
+        payloads = [
+            make_payload(info, i, first_step + i * snapshots_per_request, snapshots_per_request)
+            for i in range(requests)
+        ]
+        samples = []
+        started = time.perf_counter()
+        for payload in payloads:
+            request_started = time.perf_counter()
+            # Aggregators post the DTO's JSON text as a JSON string, see DTO_Aggregator.from_json
+            response = client.post('/api/aggregator', json=json.dumps(payload))
+            samples.append(time.perf_counter() - request_started)
+            if response.status_code != 201:
+                raise RuntimeError(f"POST /api/aggregator returned {response.status_code}: {response.get_data(as_text=True)}")
+        elapsed = time.perf_counter() - started
+        metrics = requests * snapshots_per_request * len(info['metric_names'])
+        result = summarize(samples)
+        result.update({
+            'requests_per_second': round(requests / elapsed, 2),
+            'metrics_per_second': round(metrics / elapsed, 2),
+            'snapshots_per_request': snapshots_per_request,
+        })
+        return result
+    finally:
+        from models import db
+        with app.app_context():
+            db.engine.dispose()
+        os.remove(post_path)
+
+def bench_get(app, info, repeat, max_get_all):
+    client = app.test_client()
+    guid = info['aggregator_guids'][0]
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {response.status_code}")
+
+    results = {'get_aggregator_by_uuid': timed(lambda: get(f'/api/aggregator?uuid={guid}'), repeat)}
+    if info['metrics'] <= max_get_all:
+        results['get_aggregator_all'] = timed(lambda: get('/api/aggregator'), repeat)
+    else:
+        results['get_aggregator_all'] = {'skipped': f"more than {max_get_all} metrics"}
+    return results
+
+def bench_dashboard(app, info, repeat):
+    import dashboard
+    from metadata_catalog import catalog
+    with app.app_context():
+        aggregator_id = catalog.aggregator_list()[0].aggregator_id
+        functions = {
+            'fetch_metric_data': lambda: dashboard.fetch_metric_data('CPU Percent'),
+            'fetch_metric_data_latest': lambda: dashboard.fetch_metric_data('CPU Percent', aggregator_id, limit=1),
+            'fetch_metric_data_by_aggregator': lambda: dashboard.fetch_metric_data_by_aggregator('CPU Percent'),
+            'create_time_series_graph': lambda: dashboard.create_time_series_graph('CPU Percent'),
+            'stock_series': dashboard.stock_series,
+            'create_btc_usd_time_series_graph': dashboard.create_btc_usd_time_series_graph,
+            'gauge_readings': dashboard.gauge_readings,
+        }
+        # The first call pays for the lazy pandas/plotly imports
+        dashboard.create_btc_usd_time_series_graph()
+        return {name: timed(function, repeat) for name, function in functions.items()}
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlite': sqlite3.sqlite_version,
+        'commit': commit,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+def compare(results, baseline_path):
+    """Print the median of each benchmark against the same one in a previous run"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r['metrics_target'], r['benchmark']): r for r in baseline['results']}
+    print(f"\nCompared with {baseline_path} ({baseline['environment'].get('commit')}):")
+    for result in results:
+        before = previous.get((result['metrics_target'], result['benchmark']))
+        if not before or 'median_ms' not in before or 'median_ms' not in result:
+            continue
+        ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+        print(f"  {result['metrics_target']:>10} {result['benchmark']:<38} "
+              f"{before['median_ms']:>10.2f} -> {result['median_ms']:>10.2f} ms  ({ratio:.2f}x)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000', help="comma separated metric row counts")
+    parser.add_argument('--aggregators', type=int, default=4)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--metric-types', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--post-requests', type=int, default=50)
+    parser.add_argument('--post-snapshots', type=int, default=10, help="snapshots per POST")
+    parser.add_argument('--max-get-all', type=int, default=100000,
+                        help="skip GET /api/aggregator without a uuid above this many metrics")
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'benchmarks', 'data'))
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        db_path, info = ensure_database(args.data_dir, size, args.aggregators, args.devices,
+                                        args.metric_types, args.seed)
+        timings = {'post_aggregator': bench_post(db_path, info, args.post_requests, args.post_snapshots)}
+        app = make_app(db_path)
+        timings.update(bench_get(app, info, args.repeat, args.max_get_all))
+        timings.update(bench_dashboard(app, info, args.repeat))
+
+        for benchmark, timing in timings.items():
+            result = {'metrics_target': size, 'metrics': info['metrics'], 'benchmark': benchmark, **timing}
+            results.append(result)
+            if 'median_ms' in timing:
+                print(f"{size:>10} {benchmark:<38} {timing['median_ms']:>10.2f} ms median  "
+                      f"{timing['p95_ms']:>10.2f} ms p95")
+            else:
+                print(f"{size:>10} {benchmark:<38} skipped: {timing['skipped']}")
+
+    report = {
+        'environment': environment(),
+        'parameters': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""SVG (Scatter) vs WebGL (Scattergl) line charts: trace type selection and serialization cost.
+
+    python benchmarks/bench_figures.py --check
+    python benchmarks/bench_figures.py --points 1000,10000,100000,1000000 --output figures.json
+
+--check needs no browser or database. It builds the dashboard's line
+charts from synthetic frames on either side of the configured
+webgl_threshold_points, and checks the trace types they get. If node is
+on the PATH, it runs the clientside stock charts in
+assets/dashboard_clientside.js the same way.
+
+Otherwise, for each point count the two server-side builders
+(create_time_series_figure and create_aggregator_time_series_figure) are
+timed in both modes. Each timing covers building the figure and
+serializing it with to_json, as the figure cache does. The JSON size is
+reported too.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_app import environment, timed
+
+AGGREGATORS = 4
+MODES = {'svg': None, 'webgl': 0}
+
+# Loads the clientside callbacks into a bare `window` and prints the trace
+# types they pick for a series of each length given on the command line
+CLIENTSIDE_CHECK = """
+const vm = require('vm');
+const fs = require('fs');
+const [path, threshold, ...lengths] = process.argv.slice(1);
+const context = {window: {}};
+vm.runInNewContext(fs.readFileSync(path, 'utf8'), context);
+const dashboard = context.window.dash_clientside.dashboard;
+const settings = {webgl_threshold_points: JSON.parse(threshold)};
+const types = lengths.map(function (length) {
+    const t = Array.from({length: Number(length)}, (_, i) => 1700000000 + i * 60);
+    const stocks = {symbols: ['AAA', 'BBB'], series: {
+        AAA: {t: t, v: t.map((_, i) => 100 + i % 7)},
+        BBB: {t: t.slice(0, 2), v: [50, 51]}
+    }};
+    return {
+        performance: dashboard.renderStockPerformance(stocks, 'normalized', {}, settings).data.map(trace => trace.type),
+        line: dashboard.renderStockLineChart(stocks, 'AAA', {}, settings).data.map(trace => trace.type)
+    };
+});
+console.log(JSON.stringify(types));
+"""
+
+def frames(points):
+    """A single series and an AGGREGATORS-line frame, each trace `points` long"""
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(0)
+    timestamps = pd.to_datetime(1700000000 + np.arange(points) * 60, unit='s')
+    single = pd.DataFrame({'timestamp': timestamps, 'value': rng.uniform(0, 100, points)})
+    by_aggregator = pd.DataFrame({
+        'timestamp': np.tile(timestamps, AGGREGATORS),
+        'value': rng.uniform(0, 100, points * AGGREGATORS),
+        'aggregator': np.repeat([f'aggregator-{index}' for index in range(AGGREGATORS)], points),
+    })
+    return single, by_aggregator
+
+def builders(single, by_aggregator):
+    import dashboard
+    return {
+        'create_time_series_figure': lambda: dashboard.create_time_series_figure(single, 'BTC-USD', 'Bitcoin value (USD)'),
+        'create_aggregator_time_series_figure': lambda: dashboard.create_aggregator_time_series_figure(by_aggregator, 'CPU Percent'),
+    }
+
+def check_server_figures(threshold):
+    import dashboard
+    failures = []
+    built = {}
+    for points, expected in ((threshold, 'scatter'), (threshold + 1, 'scattergl')):
+        for name, build in builders(*frames(points)).items():
+            figure = build()
+            types = {trace.type for trace in figure.data}
+            if types != {expected}:
+                failures.append(f"{name} with {points} points per trace: {sorted(types)}, expected {expected}")
+            built.setdefault(name, []).append(figure)
+    # Only the trace type may differ between the modes
+    for name, (svg, webgl) in built.items():
+        if svg.layout.to_plotly_json() != webgl.layout.to_plotly_json():
+            failures.append(f"{name}: layout differs between svg and webgl")
+        styling = [[(trace.name, trace.mode, trace.line.to_plotly_json(), trace.showlegend, trace.hovertemplate)
+                    for trace in figure.data] for figure in (svg, webgl)]
+        if styling[0] != styling[1]:
+            failures.append(f"{name}: trace styling differs between svg and webgl: {styling}")
+    # The smaller traces of a figure follow its largest one
+    _, by_aggregator = frames(threshold + 1)
+    by_aggregator = by_aggregator[(by_aggregator['aggregator'] == 'aggregator-0') | (by_aggregator.index % 2 == 0)]
+    types = [trace.type for trace in dashboard.create_aggregator_time_series_figure(by_aggregator, 'CPU Percent').data]
+    if set(types) != {'scattergl'}:
+        failures.append(f"mixed trace lengths: {types}, expected every trace scattergl")
+    saved = dashboard.FIGURE_SETTINGS['webgl_threshold_points']
+    dashboard.FIGURE_SETTINGS['webgl_threshold_points'] = None
+    try:
+        types = {trace.type for trace in builders(*frames(threshold + 1))['create_time_series_figure']().data}
+        if types != {'scatter'}:
+            failures.append(f"threshold None: {sorted(types)}, expected scatter")
+    finally:
+        dashboard.FIGURE_SETTINGS['webgl_threshold_points'] = saved
+    return failures
+
+def check_clientside_figures(threshold):
+    node = shutil.which('node')
+    if node is None:
+        print("node is not on the PATH, skipping the clientside check")
+        return []
+    script = os.path.join(ROOT, 'assets', 'dashboard_clientside.js')
+    failures = []
+    for setting, lengths, expected in ((threshold, [threshold, threshold + 1], ['scatter', 'scattergl']),
+                                       (None, [threshold + 1], ['scatter'])):
+        output = subprocess.run([node, '-e', CLIENTSIDE_CHECK, script, json.dumps(setting), *map(str, lengths)],
+                                capture_output=True, text=True, check=True).stdout
+        for length, want, types in zip(lengths, expected, json.loads(output)):
+            for chart, chart_types in types.items():
+                if set(chart_types) != {want}:
+                    failures.append(f"clientside {chart} with {length} points, threshold {setting}: "
+                                    f"{chart_types}, expected {want}")
+    return failures
+
+def check():
+    import dashboard
+    threshold = dashboard.FIGURE_SETTINGS['webgl_threshold_points']
+    failures = check_server_figures(threshold) + check_clientside_figures(threshold)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print(f"{'FAILED' if failures else 'OK'}: trace type selection at webgl_threshold_points={threshold}")
+    return 1 if failures else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help="only check the trace type selection")
+    parser.add_argument('--points', default='1000,10000,100000,1000000', help="comma separated points per trace")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        return check()
+
+    import dashboard
+    results = []
+    for points in [int(points) for points in args.points.split(',')]:
+        figure_builders = builders(*frames(points))
+        for mode, threshold in MODES.items():
+            dashboard.FIGURE_SETTINGS['webgl_threshold_points'] = threshold
+            for name, build in figure_builders.items():
+                size = len(build().to_json())
+                timing = timed(lambda: build().to_json(), args.repeat)
+                results.append({'points_per_trace': points, 'mode': mode, 'builder': name,
+                                'json_bytes': size, **timing})
+                print(f"{points:>10} {mode:<6} {name:<38} {timing['median_ms']:>10.2f} ms median "
+                      f"{size / 1024:>10.1f} KiB")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'parameters': vars(args), 'results': results}, f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""Fill a SQLite database with synthetic aggregators, devices, metric types and snapshots.
+
+    python benchmarks/datagen.py bench.db --aggregators 4 --devices 2 --metric-types 8 --snapshots 10000
+
+Rows are written with executemany straight into SQLite, bypassing the ORM,
+so millions of metrics take seconds. The same arguments and --seed always
+produce the same database.
+"""
+import argparse
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from models import db, SCHEMA_VERSION
+
+START_EPOCH = 1700000000
+SNAPSHOT_INTERVAL_SECONDS = 60
+STOCK_SYMBOLS = ['AAPL', 'MSFT', 'GOOG', 'AMZN', 'NVDA', 'META', 'TSLA', 'ORCL']
+BATCH_SIZE = 50000
+
+def metric_type_names(count):
+    """The metric names the dashboard looks for first, then made-up stock prices"""
+    names = ['CPU Percent', 'RAM Usage', 'BTC-USD']
+    names += [f'Stock Price ({symbol})' for symbol in STOCK_SYMBOLS]
+    index = 0
+    while len(names) < count:
+        names.append(f'Stock Price (SYM{index})')
+        index += 1
+    return names[:count]
+
+def snapshots_for(total_metrics, aggregators, devices, metric_types):
+    """Snapshots per device needed for at least `total_metrics` metric rows"""
+    return max(math.ceil(total_metrics / (aggregators * devices * metric_types)), 1)
+
+class ValueGenerator:
+    """Percentages for system metrics, a random walk for prices"""
+
+    def __init__(self, name, rng):
+        self.rng = rng
+        self.percent = name in ('CPU Percent', 'RAM Usage')
+        self.value = rng.uniform(10, 90) if self.percent else rng.uniform(20, 500)
+
+    def next(self):
+        if self.percent:
+            self.value = min(max(self.value + self.rng.gauss(0, 5), 0.0), 100.0)
+        else:
+            self.value = max(self.value * (1 + self.rng.gauss(0, 0.002)), 0.01)
+        return round(self.value, 4)
+
+def create_schema(path):
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    engine.dispose()
+
+def generate(path, aggregators=4, devices=2, metric_types=8, snapshots=1000, seed=0):
+    """Write a fresh database to `path` and return a description of what is in it"""
+    if os.path.exists(path):
+        os.remove(path)
+    create_schema(path)
+    rng = random.Random(seed)
+    names = metric_type_names(metric_types)
+    started = time.perf_counter()
+
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    try:
+        aggregator_rows = []
+        device_rows = []
+        metric_type_rows = []
+        for aggregator_id in range(1, aggregators + 1):
+            guid = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            aggregator_rows.append((aggregator_id, guid, f'bench-aggregator-{aggregator_id}'))
+            for device_index in range(devices):
+                device_id = len(device_rows) + 1
+                device_rows.append((device_id, f'bench-device-{device_index}', aggregator_id))
+                for name in names:
+                    metric_type_rows.append((len(metric_type_rows) + 1, name, device_id))
+        connection.executemany(
+            "INSERT INTO aggregators (aggregator_id, guid, name) VALUES (?, ?, ?)", aggregator_rows)
+        connection.executemany(
+            "INSERT INTO devices (device_id, name, aggregator_id) VALUES (?, ?, ?)", device_rows)
+        connection.executemany(
+            "INSERT INTO device_metric_types (device_metric_type_id, name, device_id) VALUES (?, ?, ?)",
+            metric_type_rows)
+
+        metric_types_by_device = {}
+        for metric_type_id, name, device_id in metric_type_rows:
+            metric_types_by_device.setdefault(device_id, []).append((metric_type_id, ValueGenerator(name, rng)))
+
+        snapshot_id = 0
+        metric_id = 0
+        snapshot_rows = []
+        metric_rows = []
+        for step in range(snapshots):
+            timestamp = START_EPOCH + step * SNAPSHOT_INTERVAL_SECONDS
+            for device_id, _, _ in device_rows:
+                snapshot_id += 1
+                snapshot_rows.append((snapshot_id, device_id, timestamp, 0, timestamp + rng.randint(0, 5), 0))
+                for metric_type_id, values in metric_types_by_device[device_id]:
+                    metric_id += 1
+                    metric_rows.append((metric_id, snapshot_id, values.next(), metric_type_id))
+            if len(metric_rows) >= BATCH_SIZE:
+                write_snapshots(connection, snapshot_rows, metric_rows)
+                snapshot_rows, metric_rows = [], []
+        write_snapshots(connection, snapshot_rows, metric_rows)
+
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.commit()
+    finally:
+        connection.close()
+
+    return {
+        'path': path,
+        'seed': seed,
+        'aggregators': aggregators,
+        'devices': devices,
+        'metric_types': metric_types,
+        'snapshots_per_device': snapshots,
+        'snapshots': snapshot_id,
+        'metrics': metric_id,
+        'aggregator_guids': [guid for _, guid, _ in aggregator_rows],
+        'device_names': [f'bench-device-{index}' for index in range(devices)],
+        'metric_names': names,
+        'seconds': time.perf_counter() - started,
+    }
+
+def write_snapshots(connection, snapshot_rows, metric_rows):
+    connection.executemany(
+        "INSERT INTO snapshots (snapshot_id, device_id, client_timestamp_epoch, client_timezon_mins, "
+        "server_timestamp_epoch, server_timezone_mins) VALUES (?, ?, ?, ?, ?, ?)", snapshot_rows)
+    connection.executemany(
+        "INSERT INTO metrics (metric_id, snapshot_id, value, device_metric_type_id) VALUES (?, ?, ?, ?)",
+        metric_rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--aggregators', type=int, default=4)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--metric-types', type=int, default=8)
+    parser.add_argument('--snapshots', type=int, default=1000, help="snapshots per device")
+    parser.add_argument('--metrics', type=int, help="total metric rows, overrides --snapshots")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    snapshots = args.snapshots
+    if args.metrics:
+        snapshots = snapshots_for(args.metrics, args.aggregators, args.devices, args.metric_types)
+    info = generate(args.path, args.aggregators, args.devices, args.metric_types, snapshots, args.seed)
+    print(f"Wrote {info['metrics']} metrics in {info['snapshots']} snapshots to {args.path} "
+          f"in {info['seconds']:.1f}s")
+
+if __name__ == "__main__":
+    main()
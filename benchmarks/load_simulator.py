@@ -0,0 +1,365 @@
+"""Simulated dashboard clients hitting the Dash callbacks and the API concurrently.
+
+    python benchmarks/load_simulator.py --clients 50 --duration 120 --speedup 10
+    python benchmarks/load_simulator.py --url http://localhost:8000 --clients 200 --output load.json
+
+Each client behaves like a browser running the dashboard built in
+create_dash_app. The flow is driven by GET /_dash-dependencies, so the
+requests match what the renderer sends.
+
+1. Load the page: /, /_dash-layout and /_dash-dependencies. Then run the
+   initial callbacks.
+2. Click a nav button, alternating between the pages from one client to
+   the next. Then run the initial callbacks of the new components.
+3. Until --duration is up, tick each dcc.Interval of the page at its own
+   interval divided by --speedup. On every --dropdown-every tick, pick
+   another dropdown value. With --api-every, also GET
+   /api/aggregator?uuid= and /api/aggregate.
+
+Clientside callbacks are skipped, as they cost the server nothing.
+Callbacks triggered together are sent one after another rather than in
+parallel as the renderer does. Without --url, the app is started on a
+threaded werkzeug server over a database seeded by datagen (see
+bench_app.ensure_database).
+
+The report, for each callback and API route, gives throughput, the
+p50/p95/p99 latency and the error rate. It also gives how late interval
+ticks fired because the previous tick's callbacks had not returned,
+which is where piling up shows first.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_app import ensure_database, environment
+
+PAGES = {'winos': 'win-os-metrics-button', 'stock': 'stock-metrics-button'}
+
+def percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+class Recorder:
+    """Latency samples and errors per label, shared by all clients"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_examples = {}
+        self.tick_lag = []
+
+    def record(self, label, seconds, error=None):
+        with self._lock:
+            self.samples[label].append(seconds)
+            if error is not None:
+                self.errors[label] += 1
+                self.error_examples.setdefault(label, error)
+
+    def record_tick_lag(self, seconds):
+        with self._lock:
+            self.tick_lag.append(seconds)
+
+    def report(self, elapsed):
+        rows = []
+        for label in sorted(self.samples):
+            ordered = sorted(self.samples[label])
+            rows.append({
+                'label': label,
+                'requests': len(ordered),
+                'errors': self.errors[label],
+                'error_rate': round(self.errors[label] / len(ordered), 4),
+                'requests_per_second': round(len(ordered) / elapsed, 2),
+                'p50_ms': round(percentile(ordered, 0.50) * 1000, 2),
+                'p95_ms': round(percentile(ordered, 0.95) * 1000, 2),
+                'p99_ms': round(percentile(ordered, 0.99) * 1000, 2),
+                'max_ms': round(ordered[-1] * 1000, 2),
+                'first_error': self.error_examples.get(label),
+            })
+        lag = sorted(self.tick_lag)
+        ticks = {
+            'ticks': len(lag),
+            'late_ticks': sum(1 for seconds in lag if seconds > 0),
+            'p95_lag_ms': round(percentile(lag, 0.95) * 1000, 2) if lag else 0.0,
+            'max_lag_ms': round(lag[-1] * 1000, 2) if lag else 0.0,
+        }
+        return rows, ticks
+
+def callback_label(output):
+    """'cpu-percent-graph.figure', or the first output and a count for multi-output callbacks"""
+    if output.startswith('..'):
+        outputs = [part.split('@')[0] for part in output[2:-2].split('...')]
+        return f"{outputs[0]} (+{len(outputs) - 1})" if len(outputs) > 1 else outputs[0]
+    return output.split('@')[0]
+
+def parse_outputs(output):
+    if output.startswith('..'):
+        return [dict(zip(('id', 'property'), part.rsplit('.', 1))) for part in output[2:-2].split('...')]
+    return dict(zip(('id', 'property'), output.rsplit('.', 1)))
+
+class DashClient:
+    """One simulated browser: keeps the component props the renderer would and sends its callbacks"""
+
+    def __init__(self, base_url, recorder, rng, guids):
+        import requests
+        self.http = requests.Session()
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.rng = rng
+        self.guids = guids
+        self.dependencies = []
+        self.props = {}
+        self.owner = {}
+
+    def request(self, method, path, label, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout=300, **kwargs)
+        except Exception as e:
+            self.recorder.record(label, time.perf_counter() - started, f"{type(e).__name__}: {e}")
+            return None
+        # 204 is a callback that raised PreventUpdate
+        error = None if response.status_code in (200, 204) else f"HTTP {response.status_code}: {response.text[:200]}"
+        self.recorder.record(label, time.perf_counter() - started, error)
+        return response if error is None else None
+
+    def add_components(self, layout, owner):
+        """Record the props of every component with an id in `layout`; returns their ids"""
+        added = []
+        stack = [layout]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(node)
+            elif isinstance(node, dict) and 'props' in node:
+                props = node['props']
+                component_id = props.get('id')
+                if isinstance(component_id, str):
+                    self.props[component_id] = dict(props)
+                    self.owner[component_id] = owner
+                    added.append(component_id)
+                stack.append(props.get('children'))
+        return added
+
+    def remove_components(self, owner):
+        owned = [component_id for component_id, parent in self.owner.items() if parent == owner]
+        for component_id in owned:
+            self.remove_components(component_id)
+            del self.props[component_id]
+            del self.owner[component_id]
+
+    def value(self, component_id, prop):
+        return self.props.get(component_id, {}).get(prop)
+
+    def ready(self, dependency):
+        # Clientside callbacks run in the browser and never reach the server
+        return not dependency.get('clientside_function') and \
+            all(item['id'] in self.props for item in dependency['inputs'] + dependency['state'])
+
+    def run_callback(self, dependency, changed=()):
+        body = {
+            'output': dependency['output'],
+            'outputs': parse_outputs(dependency['output']),
+            'inputs': [dict(item, value=self.value(item['id'], item['property'])) for item in dependency['inputs']],
+            'state': [dict(item, value=self.value(item['id'], item['property'])) for item in dependency['state']],
+            'changedPropIds': [f"{component_id}.{prop}" for component_id, prop in changed],
+        }
+        response = self.request('POST', '/_dash-update-component', callback_label(dependency['output']), json=body)
+        if response is None or response.status_code == 204:
+            return
+        new_components = []
+        for component_id, props in response.json().get('response', {}).items():
+            if component_id not in self.props:
+                continue
+            for prop, value in props.items():
+                self.props[component_id][prop] = value
+                if prop == 'children':
+                    self.remove_components(component_id)
+                    new_components += self.add_components(value, component_id)
+        if new_components:
+            self.initial_callbacks(new_components)
+
+    def initial_callbacks(self, component_ids):
+        """What the renderer runs when components appear: callbacks with one of them as input"""
+        component_ids = set(component_ids)
+        for dependency in self.dependencies:
+            if dependency.get('prevent_initial_call') or not self.ready(dependency):
+                continue
+            if any(item['id'] in component_ids for item in dependency['inputs']):
+                self.run_callback(dependency)
+
+    def set_prop(self, component_id, prop, value):
+        """A user or timer changing a prop: runs every callback with it as input"""
+        self.props[component_id][prop] = value
+        for dependency in self.dependencies:
+            if self.ready(dependency) and any(
+                    item['id'] == component_id and item['property'] == prop for item in dependency['inputs']):
+                self.run_callback(dependency, [(component_id, prop)])
+
+    def load_page(self):
+        self.request('GET', '/', 'GET /')
+        layout = self.request('GET', '/_dash-layout', 'GET /_dash-layout')
+        dependencies = self.request('GET', '/_dash-dependencies', 'GET /_dash-dependencies')
+        if layout is None or dependencies is None:
+            return False
+        self.props = {}
+        self.owner = {}
+        self.dependencies = dependencies.json()
+        self.initial_callbacks(self.add_components(layout.json(), None))
+        return True
+
+    def click(self, button_id):
+        self.set_prop(button_id, 'n_clicks', (self.value(button_id, 'n_clicks') or 0) + 1)
+
+    def change_dropdowns(self):
+        for component_id, props in list(self.props.items()):
+            options = [option['value'] for option in props.get('options') or [] if isinstance(option, dict)]
+            others = [option for option in options if option != props.get('value')]
+            if others:
+                self.set_prop(component_id, 'value', self.rng.choice(others))
+
+    def call_api(self):
+        if self.guids:
+            self.request('GET', f'/api/aggregator?uuid={self.rng.choice(self.guids)}', 'GET /api/aggregator?uuid=')
+        self.request('GET', '/api/aggregate?metric=CPU Percent&bucket=1h&percentile=95', 'GET /api/aggregate')
+
+    def run(self, page, deadline, speedup, dropdown_every, api_every):
+        if not self.load_page():
+            return
+        self.click(PAGES[page])
+        intervals = {
+            component_id: props['interval'] / 1000 / speedup
+            for component_id, props in self.props.items() if 'interval' in props and 'n_intervals' in props
+        }
+        # Browsers opened at different times don't tick in step
+        now = time.monotonic()
+        next_tick = {component_id: now + self.rng.uniform(0, period) for component_id, period in intervals.items()}
+        ticks = 0
+        while next_tick:
+            component_id = min(next_tick, key=next_tick.get)
+            due = next_tick[component_id]
+            if due >= deadline:
+                break
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.recorder.record_tick_lag(max(0.0, -wait))
+            self.set_prop(component_id, 'n_intervals', (self.value(component_id, 'n_intervals') or 0) + 1)
+            # dcc.Interval keeps its period whatever the callbacks take, and
+            # ticks missed while they were running collapse into one
+            period = intervals[component_id]
+            next_due = due + period
+            behind = time.monotonic() - next_due
+            if behind > 0:
+                next_due += period * int(behind // period)
+            next_tick[component_id] = next_due
+            ticks += 1
+            if dropdown_every and ticks % dropdown_every == 0:
+                self.change_dropdowns()
+            if api_every and ticks % api_every == 0:
+                self.call_api()
+
+def start_local_server(args):
+    from werkzeug.serving import make_server
+    db_path, info = ensure_database(args.data_dir, args.size, args.aggregators, args.devices,
+                                    args.metric_types, args.seed)
+    from app import create_app
+    app = create_app({
+        'database': {'connection_string': f'sqlite:///{db_path}'},
+        'figure_cache': {'enabled': not args.no_figure_cache},
+        'instrumentation': {'enabled': True},
+        'stock_symbols': {'version_file': db_path + '.symbols.version'},
+    })
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}', info['aggregator_guids']
+
+def discover_guids(base_url):
+    import requests
+    response = requests.get(base_url + '/api/aggregate', params={'metric': 'CPU Percent', 'bucket': '1w'}, timeout=300)
+    response.raise_for_status()
+    return sorted({series['aggregator_guid'] for series in response.json()['series'] if series['aggregator_guid']})
+
+def print_report(rows, ticks, elapsed, clients):
+    print(f"\n{clients} clients for {elapsed:.1f}s")
+    print(f"{'':<40} {'requests':>9} {'req/s':>8} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for row in rows:
+        print(f"{row['label']:<40} {row['requests']:>9} {row['requests_per_second']:>8.2f} "
+              f"{row['error_rate'] * 100:>6.1f}% {row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} "
+              f"{row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}")
+    for row in rows:
+        if row['first_error']:
+            print(f"first error of {row['label']}: {row['first_error']}")
+    print(f"interval ticks: {ticks['ticks']}, {ticks['late_ticks']} late, "
+          f"p95 lag {ticks['p95_lag_ms']:.1f} ms, max lag {ticks['max_lag_ms']:.1f} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="an already running server; by default one is started locally")
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=60.0, help="seconds of interval ticks per client")
+    parser.add_argument('--speedup', type=float, default=1.0, help="divide the dcc.Interval periods by this")
+    parser.add_argument('--pages', default='winos,stock', help="pages the clients open, round robin")
+    parser.add_argument('--dropdown-every', type=int, default=5, help="change the dropdowns every N ticks, 0 never")
+    parser.add_argument('--api-every', type=int, default=0, help="call the API routes every N ticks, 0 never")
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="seconds over which the clients start")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, default=100000, help="metrics in the local database")
+    parser.add_argument('--aggregators', type=int, default=4)
+    parser.add_argument('--devices', type=int, default=2)
+    parser.add_argument('--metric-types', type=int, default=8)
+    parser.add_argument('--data-dir', default=os.path.join(ROOT, 'benchmarks', 'data'))
+    parser.add_argument('--no-figure-cache', action='store_true', help="build figures in the callbacks")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    pages = [page.strip() for page in args.pages.split(',') if page.strip()]
+    unknown = set(pages) - set(PAGES)
+    if unknown:
+        parser.error(f"unknown pages {sorted(unknown)}, expected some of {sorted(PAGES)}")
+
+    server = None
+    if args.url:
+        base_url = args.url
+        guids = discover_guids(base_url)
+    else:
+        server, base_url, guids = start_local_server(args)
+    print(f"Simulating {args.clients} clients against {base_url}")
+
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    started = time.monotonic()
+    deadline = started + args.ramp_up + args.duration
+    threads = []
+    for index in range(args.clients):
+        client = DashClient(base_url, recorder, random.Random(rng.random()), guids)
+        delay = args.ramp_up * index / max(args.clients, 1)
+
+        def run(client=client, page=pages[index % len(pages)], delay=delay):
+            time.sleep(delay)
+            client.run(page, deadline, args.speedup, args.dropdown_every, args.api_every)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    if server is not None:
+        server.shutdown()
+
+    rows, ticks = recorder.report(elapsed)
+    print_report(rows, ticks, elapsed, args.clients)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'parameters': vars(args), 'elapsed_seconds': elapsed,
+                       'results': rows, 'interval_ticks': ticks}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
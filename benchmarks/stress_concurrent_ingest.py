@@ -0,0 +1,141 @@
+"""Concurrent POST /api/aggregator against a threaded server, then a check for duplicates.
+
+    python benchmarks/stress_concurrent_ingest.py --threads 16 --requests 400
+
+Starts the app on a threaded werkzeug server with an empty database. Every
+request of a round posts the same aggregators, devices and metric types
+for the first time, so they all race to create them. Afterwards the
+database must hold exactly one row per aggregator, device and metric type
+name, and every snapshot and metric posted. Exits with status 1 if not.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def make_payload(guid, name, devices, metric_types, request_index):
+    return {
+        'guid': guid,
+        'name': name,
+        'devices': [{
+            'name': f'device-{device}',
+            'snapshots': [{
+                'timestamp_capture': 1700000000 + request_index,
+                'timezone_mins': 0,
+                'metrics': [{'name': f'Metric {metric}', 'value': float(request_index)}
+                            for metric in range(metric_types)],
+            }],
+        } for device in range(devices)],
+    }
+
+def post(url, payload):
+    # Aggregators post the DTO's JSON text as a JSON string, see DTO_Aggregator.from_json
+    body = json.dumps(json.dumps(payload)).encode('utf-8')
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return response.status, None
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode('utf-8', 'replace')
+
+def check(db_path, aggregators, devices, metric_types, requests):
+    """Problems found in the database, empty if none"""
+    connection = sqlite3.connect(db_path)
+    try:
+        def scalar(query):
+            return connection.execute(query).fetchone()[0]
+        expected = {
+            'aggregators': aggregators,
+            'devices': aggregators * devices,
+            'device_metric_types': aggregators * devices * metric_types,
+            'snapshots': requests * devices,
+            'metrics': requests * devices * metric_types,
+        }
+        problems = [
+            f"{table}: {scalar(f'SELECT count(*) FROM {table}')} rows, expected {count}"
+            for table, count in expected.items()
+            if scalar(f'SELECT count(*) FROM {table}') != count
+        ]
+        duplicate_devices = scalar(
+            "SELECT count(*) FROM (SELECT 1 FROM devices GROUP BY aggregator_id, name HAVING count(*) > 1)")
+        duplicate_metric_types = scalar(
+            "SELECT count(*) FROM (SELECT 1 FROM device_metric_types GROUP BY device_id, name HAVING count(*) > 1)")
+        if duplicate_devices:
+            problems.append(f"{duplicate_devices} duplicated devices")
+        if duplicate_metric_types:
+            problems.append(f"{duplicate_metric_types} duplicated metric types")
+        return problems
+    finally:
+        connection.close()
+
+def run_round(args, round_index, work_dir):
+    from app import create_app
+    from metadata_catalog import catalog
+    from models import db
+    from werkzeug.serving import make_server
+
+    db_path = os.path.join(work_dir, f'stress-{round_index}.db')
+    catalog.reset()
+    app = create_app({
+        'database': {'connection_string': f'sqlite:///{db_path}', 'journal_mode': args.journal_mode},
+        'figure_cache': {'enabled': False},
+        'instrumentation': {'enabled': False},
+        'stock_symbols': {'version_file': db_path + '.symbols.version'},
+    })
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f'http://127.0.0.1:{server.server_port}/api/aggregator'
+
+    guids = [str(uuid.uuid4()) for _ in range(args.aggregators)]
+    payloads = [
+        make_payload(guids[i % args.aggregators], f'stress-{i % args.aggregators}',
+                     args.devices, args.metric_types, i)
+        for i in range(args.requests)
+    ]
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            results = list(pool.map(lambda payload: post(url, payload), payloads))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+        with app.app_context():
+            db.engine.dispose()
+
+    failures = [(status, body) for status, body in results if status != 201]
+    problems = [f"{len(failures)} requests failed, first: {failures[0]}"] if failures else []
+    problems += check(db_path, args.aggregators, args.devices, args.metric_types, args.requests - len(failures))
+    print(f"round {round_index}: {args.requests} requests on {args.threads} threads in {elapsed:.2f}s "
+          f"({args.requests / elapsed:.0f} requests/s), "
+          f"{'OK' if not problems else 'FAILED: ' + '; '.join(problems)}")
+    return not problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=400, help="POSTs per round")
+    parser.add_argument('--rounds', type=int, default=3, help="each round starts from an empty database")
+    parser.add_argument('--aggregators', type=int, default=2)
+    parser.add_argument('--devices', type=int, default=3)
+    parser.add_argument('--metric-types', type=int, default=10)
+    parser.add_argument('--journal-mode', default='wal', help="SQLite journal mode of the database")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        passed = all([run_round(args, round_index, work_dir) for round_index in range(args.rounds)])
+    sys.exit(0 if passed else 1)
+
+if __name__ == "__main__":
+    main()
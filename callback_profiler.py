@@ -0,0 +1,169 @@
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Phases reported for every profile, in display order
+PHASES = ('query', 'dataframe', 'figure', 'serialize')
+
+_current_profile = ContextVar('current_callback_profile', default=None)
+
+
+class CallbackProfile:
+    def __init__(self, name):
+        self.name = name
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.total = 0.0
+        self.figure_bytes = 0
+        self.trace_points = 0
+        self.finished_at = None
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'total_ms': round(self.total * 1000, 2),
+            **{f'{phase}_ms': round(seconds * 1000, 2) for phase, seconds in self.phases.items()},
+            'figure_bytes': self.figure_bytes,
+            'trace_points': self.trace_points,
+        }
+
+
+def _figures_in(output):
+    """Figures (plotly objects or dicts) in a callback's return value"""
+    outputs = output if isinstance(output, (list, tuple)) else [output]
+    figures = []
+    for value in outputs:
+        if hasattr(value, 'to_plotly_json'):
+            value = value.to_plotly_json()
+        if isinstance(value, dict) and 'data' in value:
+            figures.append(value)
+    return figures
+
+
+def count_trace_points(figure):
+    points = 0
+    for trace in figure.get('data', []):
+        if hasattr(trace, 'to_plotly_json'):
+            trace = trace.to_plotly_json()
+        for axis in ('x', 'y', 'values'):
+            values = trace.get(axis)
+            if values is not None and hasattr(values, '__len__'):
+                points += len(values)
+                break
+    return points
+
+
+class CallbackProfiler:
+    """Opt-in timing of Dash callbacks and the figure builds behind them.
+
+    `profiled` wraps a callback; inside it, code marks its phases with
+    `phase('query')`, `phase('dataframe')` and so on. When disabled both are
+    a single attribute check.
+    """
+
+    def __init__(self, enabled=False, history=50):
+        self.enabled = enabled
+        self.history = history
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        profile = _current_profile.get() if self.enabled else None
+        if profile is None:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.phases[name] = profile.phases.get(name, 0.0) + time.perf_counter() - started
+
+    @contextmanager
+    def profile(self, name):
+        """Profile everything run inside the block under `name`"""
+        if not self.enabled or _current_profile.get() is not None:
+            yield _current_profile.get()
+            return
+        profile = CallbackProfile(name)
+        token = _current_profile.set(profile)
+        started = time.perf_counter()
+        try:
+            yield profile
+        finally:
+            profile.total = time.perf_counter() - started
+            profile.finished_at = time.time()
+            _current_profile.reset(token)
+            self._record(profile)
+
+    def record_serialized(self, figure_json, figure):
+        """Let a caller that serializes figures itself report the size"""
+        profile = _current_profile.get() if self.enabled else None
+        if profile is not None:
+            profile.figure_bytes += len(figure_json)
+            profile.trace_points += count_trace_points(figure)
+
+    def profiled(self, name=None):
+        def decorator(callback):
+            callback_name = name or callback.__name__
+
+            @functools.wraps(callback)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return callback(*args, **kwargs)
+                with self.profile(callback_name) as profile:
+                    output = callback(*args, **kwargs)
+                    if profile is not None:
+                        self._measure_output(profile, output)
+                    return output
+            return wrapper
+        return decorator
+
+    def _measure_output(self, profile, output):
+        # Serializes the figures once more, the same way Dash will, to see
+        # what that costs and how big the response gets
+        from plotly.io.json import to_json_plotly
+        with self.phase('serialize'):
+            for figure in _figures_in(output):
+                profile.figure_bytes += len(to_json_plotly(figure))
+                profile.trace_points += count_trace_points(figure)
+
+    def _record(self, profile):
+        with self._lock:
+            self._profiles.setdefault(profile.name, deque(maxlen=self.history)).append(profile)
+        logger.info(
+            "Callback %s took %.1f ms (%s), %d bytes, %d points",
+            profile.name, profile.total * 1000,
+            ", ".join(f"{phase} {seconds * 1000:.1f} ms" for phase, seconds in profile.phases.items()),
+            profile.figure_bytes, profile.trace_points
+        )
+
+    def summary(self):
+        """Per-callback averages over the recent history, slowest first"""
+        with self._lock:
+            profiles = {name: list(history) for name, history in self._profiles.items()}
+        rows = []
+        for name, history in profiles.items():
+            calls = len(history)
+            rows.append({
+                'name': name,
+                'calls': calls,
+                'mean_ms': round(sum(p.total for p in history) / calls * 1000, 2),
+                'max_ms': round(max(p.total for p in history) * 1000, 2),
+                **{
+                    f'{phase}_ms': round(sum(p.phases.get(phase, 0.0) for p in history) / calls * 1000, 2)
+                    for phase in PHASES
+                },
+                'figure_bytes': history[-1].figure_bytes,
+                'trace_points': history[-1].trace_points,
+            })
+        rows.sort(key=lambda row: row['mean_ms'], reverse=True)
+        return rows
+
+
+callback_profiler = CallbackProfiler()
@@ -0,0 +1,451 @@
+"""Cold tier for old metrics: each series packed into compressed chunks.
+
+Snapshots and metrics older than `pack_older_than` are moved, one time
+slice at a time, into `metric_chunks`: one row per run of up to
+`max_chunk_points` points of a series, encoded as in Facebook's Gorilla
+paper. Timestamps are stored as delta-of-deltas, which are mostly zero
+for a steady reporting interval. Values are XORed with the previous one
+and only the meaningful bits are stored, so repeated or slowly changing
+floats take a few bits.
+
+Reads merge the decoded chunks with the raw rows (see points()), so
+callers see the same series whether or not it has been packed. Chunks
+never change once written, so decoded ones are kept in a small LRU cache.
+"""
+from collections import OrderedDict
+from metadata_catalog import catalog
+from models import db, Metric, MetricChunk, Snapshot
+from sharding import shard_router
+from sqlalchemy import delete, func, insert, select, text
+import heapq
+import logging
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MASK_64 = (1 << 64) - 1
+# Delta-of-delta ranges with their control bits and payload widths, from the paper
+TIMESTAMP_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+
+class BitWriter:
+    def __init__(self):
+        self._buffer = bytearray()
+        self._accumulator = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        self._accumulator = (self._accumulator << bits) | value
+        self._bits += bits
+        while self._bits >= 8:
+            self._bits -= 8
+            self._buffer.append((self._accumulator >> self._bits) & 0xFF)
+        self._accumulator &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            return bytes(self._buffer) + bytes([(self._accumulator << (8 - self._bits)) & 0xFF])
+        return bytes(self._buffer)
+
+
+class BitReader:
+    def __init__(self, data):
+        self._data = data
+        self._position = 0
+        self._accumulator = 0
+        self._bits = 0
+
+    def read(self, bits):
+        while self._bits < bits:
+            self._accumulator = (self._accumulator << 8) | self._data[self._position]
+            self._position += 1
+            self._bits += 8
+        self._bits -= bits
+        value = self._accumulator >> self._bits
+        self._accumulator &= (1 << self._bits) - 1
+        return value
+
+
+def encode_points(timestamps, values):
+    """Gorilla encoding of a series, timestamps (int seconds) sorted ascending"""
+    writer = BitWriter()
+    count = len(timestamps)
+    if not count:
+        return b''
+    value_bits = struct.unpack(f'>{count}Q', struct.pack(f'>{count}d', *values))
+
+    writer.write(timestamps[0] & MASK_64, 64)
+    writer.write(value_bits[0], 64)
+    previous_timestamp = timestamps[0]
+    previous_delta = 0
+    previous_value = value_bits[0]
+    previous_leading = previous_trailing = -1
+
+    for index in range(1, count):
+        timestamp = timestamps[index]
+        delta = timestamp - previous_timestamp
+        delta_of_delta = delta - previous_delta
+        if delta_of_delta == 0:
+            writer.write(0, 1)
+        else:
+            for control, control_bits, payload_bits in TIMESTAMP_BUCKETS:
+                offset = (1 << (payload_bits - 1)) - 1
+                if -offset <= delta_of_delta <= offset + 1:
+                    writer.write(control, control_bits)
+                    writer.write(delta_of_delta + offset, payload_bits)
+                    break
+            else:
+                writer.write(0b1111, 4)
+                writer.write(delta_of_delta & MASK_64, 64)
+        previous_timestamp, previous_delta = timestamp, delta
+
+        value = value_bits[index]
+        xor = value ^ previous_value
+        previous_value = value
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        if previous_leading >= 0 and leading >= previous_leading and trailing >= previous_trailing:
+            # Fits in the previous meaningful window
+            writer.write(0b10, 2)
+            writer.write(xor >> previous_trailing, 64 - previous_leading - previous_trailing)
+        else:
+            significant = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(significant - 1, 6)
+            writer.write(xor >> trailing, significant)
+            previous_leading, previous_trailing = leading, trailing
+    return writer.getvalue()
+
+
+def signed_64(value):
+    return value - (1 << 64) if value >> 63 else value
+
+
+def decode_points(data, count):
+    """(timestamps, values) lists of `count` points from encode_points output"""
+    if not count:
+        return [], []
+    reader = BitReader(data)
+    read = reader.read
+    timestamp = signed_64(read(64))
+    value = read(64)
+    timestamps = [timestamp]
+    value_bits = [value]
+    delta = 0
+    leading = trailing = 0
+
+    for _ in range(count - 1):
+        if read(1):
+            if not read(1):
+                delta += read(7) - 63
+            elif not read(1):
+                delta += read(9) - 255
+            elif not read(1):
+                delta += read(12) - 2047
+            else:
+                delta += signed_64(read(64))
+        timestamp += delta
+        timestamps.append(timestamp)
+
+        if read(1):
+            if read(1):
+                leading = read(5)
+                significant = read(6) + 1
+                trailing = 64 - leading - significant
+            value ^= read(64 - leading - trailing) << trailing
+        value_bits.append(value)
+    return timestamps, list(struct.unpack(f'>{count}d', struct.pack(f'>{count}Q', *value_bits)))
+
+
+class ColdStorage:
+    """Packs old raw rows into chunks, and reads chunks back for the dashboard and the API"""
+
+    def __init__(self, pack_older_than=30 * 86400, slice_seconds=7 * 86400, max_chunk_points=1024,
+                 pack_interval=3600.0, cache_size=256):
+        self.enabled = False
+        self.pack_older_than = pack_older_than
+        self.slice_seconds = slice_seconds
+        self.max_chunk_points = max_chunk_points
+        self.pack_interval = pack_interval
+        self.cache_size = cache_size
+        self._decoded = OrderedDict()
+        self._lock = threading.Lock()
+        self._app = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def configure(self, config):
+        from aggregation import parse_duration
+        self.enabled = config.get('enabled', False)
+        self.pack_older_than = parse_duration(config.get('pack_older_than', '30d'))
+        self.slice_seconds = parse_duration(config.get('slice', '7d'))
+        self.max_chunk_points = config.get('max_chunk_points', self.max_chunk_points)
+        self.pack_interval = config.get('pack_interval_seconds', self.pack_interval)
+        self.cache_size = config.get('decoded_cache_size', self.cache_size)
+        self.reset()
+
+    def reset(self):
+        """Forget decoded chunks, e.g. after the database has been cleared"""
+        with self._lock:
+            self._decoded.clear()
+
+    # Packing
+
+    def pack(self, session, now=None, progress=None):
+        """Move raw rows older than `pack_older_than` into chunks, one committed slice at a time"""
+        cutoff = int(now if now is not None else time.time()) - self.pack_older_than
+        totals = {'points': 0, 'chunks': 0, 'bytes': 0, 'slices': 0}
+        oldest_query = select(func.min(Snapshot.client_timestamp_epoch))
+        while True:
+            # From the oldest remaining snapshot, so gaps in the data are skipped
+            oldest = session.execute(oldest_query).scalar()
+            if oldest is None or oldest >= cutoff:
+                return totals
+            slice_start = oldest - oldest % self.slice_seconds
+            slice_end = min(slice_start + self.slice_seconds, cutoff)
+            points, chunks, size = self._pack_slice(session, slice_start, slice_end)
+            totals['points'] += points
+            totals['chunks'] += chunks
+            totals['bytes'] += size
+            totals['slices'] += 1
+            if progress and points:
+                progress(f"packed {points} points from {slice_start} to {slice_end} into {chunks} chunks")
+            oldest_query = select(func.min(Snapshot.client_timestamp_epoch))\
+                .where(Snapshot.client_timestamp_epoch >= slice_end)
+
+    def _pack_slice(self, session, start, end):
+        in_slice = select(Snapshot.snapshot_id).where(
+            Snapshot.client_timestamp_epoch >= start, Snapshot.client_timestamp_epoch < end)
+        try:
+            # Deleting first claims the rows: a concurrent packer waits for
+            # the write lock and then finds nothing left to pack
+            metrics = session.execute(
+                delete(Metric).where(Metric.snapshot_id.in_(in_slice))
+                .returning(Metric.device_metric_type_id, Metric.snapshot_id, Metric.metric_id, Metric.value)
+                .execution_options(synchronize_session=False)
+            ).all()
+            if not metrics:
+                session.rollback()
+                return 0, 0, 0
+            snapshots = {
+                snapshot_id: (timestamp, timezone_mins)
+                for snapshot_id, timestamp, timezone_mins in session.execute(
+                    select(Snapshot.snapshot_id, Snapshot.client_timestamp_epoch, Snapshot.client_timezon_mins)
+                    .where(Snapshot.client_timestamp_epoch >= start, Snapshot.client_timestamp_epoch < end))
+            }
+
+            series = {}
+            for metric_type_id, snapshot_id, metric_id, value in metrics:
+                timestamp, timezone_mins = snapshots[snapshot_id]
+                series.setdefault(metric_type_id, []).append((timestamp, metric_id, timezone_mins, value))
+
+            chunks = []
+            for metric_type_id, points in series.items():
+                points.sort()
+                run = []
+                for point in points:
+                    # A chunk has one timezone, so a change starts a new one
+                    if run and (len(run) == self.max_chunk_points or point[2] != run[0][2]):
+                        chunks.append(self._chunk_row(metric_type_id, run))
+                        run = []
+                    run.append(point)
+                chunks.append(self._chunk_row(metric_type_id, run))
+            session.execute(insert(MetricChunk), chunks)
+            session.execute(delete(Snapshot).where(Snapshot.client_timestamp_epoch >= start,
+                                                   Snapshot.client_timestamp_epoch < end)
+                            .execution_options(synchronize_session=False))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return len(metrics), len(chunks), sum(len(chunk['data']) for chunk in chunks)
+
+    def _chunk_row(self, metric_type_id, run):
+        return {
+            'device_metric_type_id': metric_type_id,
+            'start_epoch': run[0][0],
+            'end_epoch': run[-1][0],
+            'point_count': len(run),
+            'client_timezone_mins': run[0][2],
+            'data': encode_points([point[0] for point in run], [point[3] for point in run]),
+        }
+
+    def pack_all(self, progress=None):
+        """pack() the app database, or every shard"""
+        if not shard_router.enabled:
+            return self.pack(db.session, progress=progress)
+        totals = {}
+        for shard in shard_router.shards:
+            session = shard.session()
+            try:
+                for key, value in self.pack(session, progress=progress).items():
+                    totals[key] = totals.get(key, 0) + value
+            finally:
+                session.close()
+        return totals
+
+    def start(self, app):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._app = app
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="cold-storage", daemon=True)
+        self._thread.start()
+        logger.info(f"Cold storage packing every {self.pack_interval}s, rows older than {self.pack_older_than}s")
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.wait(self.pack_interval):
+            try:
+                with self._app.app_context():
+                    totals = self.pack_all()
+                    db.session.remove()
+                if totals.get('points'):
+                    logger.info(f"Packed {totals['points']} old metrics into {totals['chunks']} chunks")
+            except Exception as e:
+                logger.error(f"Packing old metrics failed: {e}")
+
+    # Reading
+
+    def _decode(self, session, chunks):
+        """Decoded (timestamps, values) of (chunk_id, point_count) chunks, through the cache"""
+        bind = str(session.get_bind(mapper=MetricChunk.__mapper__).url)
+        decoded = {}
+        missing = []
+        with self._lock:
+            for chunk_id, point_count in chunks:
+                # Ids can be reused once a database is cleared, see reset()
+                cached = self._decoded.get((bind, chunk_id, point_count))
+                if cached is None:
+                    missing.append((chunk_id, point_count))
+                else:
+                    self._decoded.move_to_end((bind, chunk_id, point_count))
+                    decoded[chunk_id] = cached
+        if missing:
+            counts = dict(missing)
+            rows = session.execute(
+                select(MetricChunk.chunk_id, MetricChunk.data).where(MetricChunk.chunk_id.in_(list(counts)))).all()
+            with self._lock:
+                for chunk_id, data in rows:
+                    decoded[chunk_id] = decode_points(data, counts[chunk_id])
+                    self._decoded[(bind, chunk_id, counts[chunk_id])] = decoded[chunk_id]
+                while len(self._decoded) > self.cache_size:
+                    self._decoded.popitem(last=False)
+        return decoded
+
+    def _chunks(self, session, metric_type_ids, start=None, end=None):
+        query = select(MetricChunk.chunk_id, MetricChunk.device_metric_type_id, MetricChunk.point_count,
+                       MetricChunk.client_timezone_mins)\
+            .where(MetricChunk.device_metric_type_id.in_(metric_type_ids))
+        if start is not None:
+            query = query.where(MetricChunk.end_epoch >= start)
+        if end is not None:
+            query = query.where(MetricChunk.start_epoch < end)
+        return session.execute(query.order_by(MetricChunk.start_epoch, MetricChunk.chunk_id)).all()
+
+    def points(self, session, metric_type_ids, start=None, end=None):
+        """(timestamp, value, device_metric_type_id) from the chunks of these series, ordered by time.
+
+        `start` is inclusive and `end` exclusive, like the raw queries.
+        """
+        if not metric_type_ids:
+            return []
+        chunks = self._chunks(session, metric_type_ids, start, end)
+        if not chunks:
+            return []
+        decoded = self._decode(session, [(chunk.chunk_id, chunk.point_count) for chunk in chunks])
+        runs = []
+        for chunk in chunks:
+            timestamps, values = decoded[chunk.chunk_id]
+            runs.append([
+                (timestamp, value, chunk.device_metric_type_id)
+                for timestamp, value in zip(timestamps, values)
+                if (start is None or timestamp >= start) and (end is None or timestamp < end)
+            ])
+        return list(heapq.merge(*runs, key=lambda point: point[0]))
+
+    def snapshots(self, session, device_id):
+        """A device's packed data regrouped as (timestamp, timezone_mins, [(metric name, value)]), oldest first.
+
+        Snapshots are rebuilt from the points that share a timestamp, so
+        two snapshots a device took in the same second come back as one.
+        """
+        metric_type_ids = [
+            metric_type_id for metric_type_id, metric_type in catalog.metric_types.items()
+            if metric_type.device_id == device_id
+        ]
+        if not metric_type_ids:
+            return []
+        chunks = self._chunks(session, metric_type_ids)
+        decoded = self._decode(session, [(chunk.chunk_id, chunk.point_count) for chunk in chunks])
+        grouped = {}
+        for chunk in chunks:
+            name = catalog.metric_types[chunk.device_metric_type_id].name
+            timestamps, values = decoded[chunk.chunk_id]
+            for timestamp, value in zip(timestamps, values):
+                grouped.setdefault((timestamp, chunk.client_timezone_mins), []).append((name, value))
+        return [(timestamp, timezone_mins, metrics) for (timestamp, timezone_mins), metrics in sorted(grouped.items())]
+
+    # Reporting
+
+    def report(self, session, decode_sample_points=1000000):
+        """Size of the chunks compared with the raw representation, and decode throughput"""
+        chunks, points, encoded_bytes = session.execute(select(
+            func.count(MetricChunk.chunk_id),
+            func.coalesce(func.sum(MetricChunk.point_count), 0),
+            func.coalesce(func.sum(func.length(MetricChunk.data)), 0),
+        )).one()
+        raw_metrics = session.execute(select(func.count(Metric.metric_id))).scalar()
+        result = {
+            'chunks': chunks,
+            'packed_points': points,
+            'encoded_bytes': encoded_bytes,
+            'raw_metrics': raw_metrics,
+            'bits_per_point': round(encoded_bytes * 8 / points, 2) if points else None,
+            # Against 8 bytes of timestamp and 8 of value per point
+            'compression_ratio': round(points * 16 / encoded_bytes, 2) if encoded_bytes else None,
+            'raw_bytes_per_metric': None,
+        }
+        try:
+            # Pages used by the raw tables, if SQLite was built with dbstat
+            table_bytes = dict(session.execute(text(
+                "SELECT name, sum(pgsize) FROM dbstat WHERE name IN ('metrics', 'snapshots') GROUP BY name")).all())
+            if raw_metrics:
+                result['raw_bytes_per_metric'] = round(sum(table_bytes.values()) / raw_metrics, 1)
+        except Exception:
+            session.rollback()
+
+        sampled_points = 0
+        sampled_bytes = 0
+        started = time.perf_counter()
+        for data, point_count in session.execute(select(MetricChunk.data, MetricChunk.point_count)):
+            decode_points(data, point_count)
+            sampled_points += point_count
+            sampled_bytes += len(data)
+            if sampled_points >= decode_sample_points:
+                break
+        elapsed = time.perf_counter() - started
+        result['decode_points_per_second'] = round(sampled_points / elapsed) if sampled_points else None
+        result['decode_megabytes_per_second'] = round(sampled_bytes / elapsed / 1e6, 2) if sampled_points else None
+        return result
+
+
+def merge_history(raw_rows, cold_rows):
+    """Raw and packed (timestamp, ...) rows, both ordered by time, as one list; packed rows first on ties"""
+    if not cold_rows:
+        return raw_rows
+    return list(heapq.merge(cold_rows, raw_rows, key=lambda row: row[0]))
+
+
+cold_storage = ColdStorage()
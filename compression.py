@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from flask import request
+import gzip
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Figure JSON, API responses and the Dash bundles; images are already compressed
+COMPRESSIBLE_MIMETYPES = (
+    'application/json',
+    'application/javascript',
+    'text/javascript',
+    'text/css',
+    'text/html',
+    'text/plain',
+    'image/svg+xml',
+)
+# Served from files or package data that only change on deploy, so their
+# compressed bytes are cached; anything else is compressed per response
+STATIC_PATH_PREFIXES = ('/assets/', '/_dash-component-suites/')
+
+
+class ResponseCompressor:
+    """Compresses responses with brotli or gzip, whichever the client prefers.
+
+    Only successful responses of a compressible type and at least
+    `min_size` bytes are compressed. brotli is optional: without it only
+    gzip is offered. Dash's static assets are compressed once per
+    (path, version, encoding) and kept in a bounded LRU cache.
+    """
+
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=5, static_cache_size=128):
+        self.enabled = True
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.static_cache_size = static_cache_size
+        self._static_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        self.enabled = config.get('enabled', True)
+        self.min_size = config.get('min_size_bytes', self.min_size)
+        self.gzip_level = config.get('gzip_level', self.gzip_level)
+        self.brotli_quality = config.get('brotli_quality', self.brotli_quality)
+        self.static_cache_size = config.get('static_cache_size', self.static_cache_size)
+        with self._lock:
+            self._static_cache.clear()
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+        offered = 'br, gzip' if brotli is not None else 'gzip'
+        logger.info(f"Response compression enabled ({offered}, from {self.min_size} bytes)")
+
+    def choose_encoding(self, accept_encodings):
+        """'br', 'gzip' or None for a parsed Accept-Encoding header"""
+        candidates = []
+        if brotli is not None:
+            candidates.append('br')
+        candidates.append('gzip')
+        best = None
+        best_quality = 0
+        for encoding in candidates:
+            # Candidates are in order of preference, so only a higher q wins
+            quality = accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, data, encoding):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+
+    def _should_compress(self, response):
+        if not 200 <= response.status_code < 300 or response.status_code in (204, 206):
+            return False
+        if 'Content-Encoding' in response.headers or 'no-transform' in response.headers.get('Cache-Control', ''):
+            return False
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return False
+        # Streamed responses of unknown length are left alone
+        if response.is_streamed and not response.direct_passthrough:
+            return False
+        if response.content_length is not None and response.content_length < self.min_size:
+            return False
+        return True
+
+    def _cached(self, key, data, encoding):
+        with self._lock:
+            compressed = self._static_cache.get(key)
+            if compressed is not None:
+                self._static_cache.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+        compressed = self.compress(data, encoding)
+        with self._lock:
+            self._static_cache[key] = compressed
+            while len(self._static_cache) > self.static_cache_size:
+                self._static_cache.popitem(last=False)
+        return compressed
+
+    def after_request(self, response):
+        if not self.enabled or not self._should_compress(response):
+            return response
+        # Responses differ by Accept-Encoding from here on, even uncompressed ones
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        # Files (send_from_directory) are read here instead of by the server
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < self.min_size:
+            return response
+
+        etag, _ = response.get_etag()
+        if request.path.startswith(STATIC_PATH_PREFIXES):
+            # Dash fingerprints component suites in the path and assets in
+            # the query string; assets also have an ETag from their mtime
+            key = (request.path, request.query_string, etag, len(data), encoding)
+            compressed = self._cached(key, data, encoding)
+        else:
+            compressed = self.compress(data, encoding)
+        if len(compressed) >= len(data):
+            return response
+
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            # Weak, so If-None-Match still matches the uncompressed ETag
+            response.set_etag(etag, weak=True)
+        return response
+
+
+compressor = ResponseCompressor()
@@ -1,19 +1,285 @@
 import dash
-from dash import dcc, html, Input, Output, callback
-import plotly.express as px
-import plotly.graph_objects as go
+from dash import dcc, html, ClientsideFunction, Input, Output, callback
 from datetime import datetime
-import pandas as pd
-from models import db, Device, Aggregator, Snapshot, DeviceMetricType, Metric
-from sqlalchemy import desc, func
+from functools import lru_cache
+from lazy_imports import lazy_module
+from models import db, Snapshot, Metric
+from metadata_catalog import catalog, STOCK_PRICE_CATEGORY
+from figure_cache import figure_cache
+from callback_profiler import callback_profiler
+from analytics_backend import analytics
+from sharding import shard_router
+from cold_storage import cold_storage
+from my_logging.payload import summarize_payload, RateLimitFilter # type: ignore
+from sqlalchemy import desc
+import heapq
 import logging
 import os
-import re
 
 logger = logging.getLogger(__name__)
+# Interval callbacks repeat the same log lines for every open dashboard
+logger.addFilter(RateLimitFilter(rate=30, per=60.0, sample_every=50))
+
+# Only needed once a figure is actually built, see lazy_imports
+pd = lazy_module('pandas')
+px = lazy_module('plotly.express')
+go = lazy_module('plotly.graph_objects')
+pio = lazy_module('plotly.io')
+
+GAUGE_METRICS = ('CPU Percent', 'RAM Usage')
+
+# Set from the "figures" config section by create_dash_app. Above this many
+# points in a trace, line charts are drawn with WebGL (Scattergl) instead of
+# SVG; None keeps every chart on SVG
+FIGURE_SETTINGS = {'webgl_threshold_points': 10000}
+
+# Metric types are resolved to ids through the catalog, so these queries
+# only ever touch the snapshots and metrics tables
+def base_metric_query(fetch_metric_type=False, session=None):
+    columns = [Snapshot.client_timestamp_epoch, Metric.value]
+    if fetch_metric_type:
+        columns.append(Metric.device_metric_type_id)
+    return (session or db.session).query(*columns).join(Metric)
+
+def metric_type_ids(metric_name, aggregator_id=None):
+    catalog.sync(db.session)
+    return catalog.metric_type_ids(metric_name, aggregator_id)
+
+def add_metric_filter(query, metric_type_ids):
+    return query.filter(Metric.device_metric_type_id.in_(metric_type_ids))
+
+def order_by_timestamp(query):
+    return query.order_by(desc(Snapshot.client_timestamp_epoch))
+
+def add_limit(query, limit):
+    return query.limit(limit)
+
+def fetch_metric_data(metric_name, aggregator_id=None, limit=None):
+    try:
+        ids = metric_type_ids(metric_name, aggregator_id or None)
+        if not ids:
+            return []
+
+        def run_query(session, ids):
+            query = base_metric_query(session=session)
+            query = add_metric_filter(query, ids)
+            query = order_by_timestamp(query)
+            if limit:
+                query = add_limit(query, limit)
+            rows = query.all()
+            # Packed history is older than the raw rows (unless data was
+            # backfilled), so with `limit` rows only chunks reaching the
+            # oldest of them can matter
+            start = rows[-1][0] if limit and len(rows) == limit else None
+            cold = cold_storage.points(session, ids, start=start)
+            if not cold:
+                return rows
+            merged = heapq.merge(rows, [(timestamp, value) for timestamp, value, _ in reversed(cold)],
+                                 key=lambda row: row[0], reverse=True)
+            return list(merged)[:limit] if limit else list(merged)
+
+        with callback_profiler.phase('query'):
+            if shard_router.enabled:
+                # Each shard returns its own latest `limit` rows, newest first
+                return shard_router.metric_rows(
+                    run_query, ids, key=lambda row: row[0], reverse=True, limit=limit)
+            return run_query(db.session, ids)
+    except Exception as e:
+        logger.error(f"Error fetching {metric_name} data: {str(e)}")
+        return []
+
+def fetch_metric_data_by_aggregator(metric_name):
+    try:
+        ids = metric_type_ids(metric_name)
+        if not ids:
+            return []
+        with callback_profiler.phase('query'):
+            return [
+                (timestamp, value, catalog.aggregator_name(metric_type_id))
+                for timestamp, value, metric_type_id in analytics.metric_history(ids)
+            ]
+    except Exception as e:
+        logger.error(f"Error fetching {metric_name} data: {str(e)}")
+        return []
+
+def configure_figures(config):
+    FIGURE_SETTINGS['webgl_threshold_points'] = config.get('webgl_threshold_points',
+                                                           FIGURE_SETTINGS['webgl_threshold_points'])
+
+def use_webgl(point_count):
+    """Whether a figure whose largest trace has point_count points should use WebGL.
+
+    Decided per figure rather than per trace: WebGL traces are drawn on a
+    canvas under the SVG layer, so a mix would reorder traces and legends.
+    """
+    threshold = FIGURE_SETTINGS['webgl_threshold_points']
+    return threshold is not None and point_count > threshold
+
+def create_time_series_figure(df, metric_name, yaxis_title):
+    with callback_profiler.phase('figure'):
+        figure = px.line(df, x='timestamp', y='value', title=f'{metric_name} Over Time',
+                         render_mode='webgl' if use_webgl(len(df)) else 'svg')
+        figure.update_layout(
+            xaxis_title='Time',
+            yaxis_title=yaxis_title,
+            legend=dict(
+                orientation="h",
+                yanchor="bottom",
+                y=1.02,
+                xanchor="center",
+                x=0.5
+            )
+        )
+    return figure
+
+def create_aggregator_time_series_figure(df, metric_name):
+    """One line per aggregator, from a frame of timestamp, value and aggregator"""
+    figure = go.Figure()
+    with callback_profiler.phase('figure'):
+        scatter = go.Scattergl if use_webgl(df['aggregator'].value_counts().max()) else go.Scatter
+        for aggregator in df['aggregator'].unique():
+            agg_df = df[df['aggregator'] == aggregator]
+            figure.add_trace(scatter(
+                x=agg_df['timestamp'],
+                y=agg_df['value'],
+                mode='lines',
+                name=aggregator
+            ))
+        figure.update_layout(
+            title=f'{metric_name} Over Time',
+            xaxis_title='Time',
+            yaxis_title=metric_name,
+            legend=dict(
+                orientation="h",
+                yanchor="bottom",
+                y=1.02,
+                xanchor="center",
+                x=0.5
+            )
+        )
+    return figure
+
+def create_time_series_graph(metric_name):
+    figure = go.Figure()
+    metric_data = fetch_metric_data_by_aggregator(metric_name)
+    if metric_data:
+        logger.info("Data found for %s: %s", metric_name, summarize_payload(metric_data))
+        with callback_profiler.phase('dataframe'):
+            df = pd.DataFrame(metric_data, columns=['timestamp', 'value', 'aggregator'])
+            df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+        figure = create_aggregator_time_series_figure(df, metric_name)
+    return figure
+
+def stock_series():
+    """Every stock's price history for the clientside stock charts.
+
+    {'symbols': [...], 'series': {symbol: {'t': [epoch seconds], 'v': [prices]}}},
+    oldest first. Normalizing and styling are done in the browser, see
+    assets/dashboard_clientside.js.
+    """
+    logger.info("Fetching all stock data")
+    catalog.sync(db.session)
+    stock_metric_type_ids = catalog.metric_type_ids_for_category(STOCK_PRICE_CATEGORY)
+    metric_data = []
+    if stock_metric_type_ids:
+        with callback_profiler.phase('query'):
+            # A full history scan, run on the configured analytics backend
+            metric_data = analytics.metric_history(stock_metric_type_ids)
+    logger.info("All stock data fetched")
+    logger.debug(f"Number of stock records found: {len(metric_data)}")
+
+    series = {}
+    with callback_profiler.phase('dataframe'):
+        for timestamp, value, metric_type_id in metric_data:
+            symbol_series = series.setdefault(catalog.metric_types[metric_type_id].symbol, {'t': [], 'v': []})
+            symbol_series['t'].append(timestamp)
+            symbol_series['v'].append(value)
+    return {'symbols': list(series), 'series': series}
+
+def create_btc_usd_time_series_graph():
+    figure = go.Figure()
+
+    try:
+        metric_name = "BTC-USD"
+        logger.info(f"Fetching {metric_name} data")
+        metric_data = fetch_metric_data(metric_name)
+        logger.info(f"{metric_name} data fetched")
+        logger.debug(f"Number of {metric_name} records found: {len(metric_data)}")
+        
+        if metric_data:
+            with callback_profiler.phase('dataframe'):
+                df = pd.DataFrame(metric_data, columns=['timestamp', 'value'])
+                df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+            figure = create_time_series_figure(df, metric_name, 'Bitcoin value (USD)')
+    except Exception as e:
+        logger.error(f"Error updating {metric_name} graph: {str(e)}")
+
+    return figure
+
+def gauge_readings():
+    """Latest value of each gauge metric for every aggregator, for the clientside gauges.
+
+    {metric: {aggregator_id: {'value': ..., 'time': 'HH:MM:SS'}}}; the
+    time is formatted here so it is in the server's timezone as before.
+    """
+    catalog.sync(db.session)
+    readings = {}
+    for metric_name in GAUGE_METRICS:
+        readings[metric_name] = {}
+        for aggregator in catalog.aggregator_list():
+            metric_data = fetch_metric_data(metric_name, aggregator.aggregator_id, limit=1)
+            if metric_data:
+                timestamp, value = metric_data[0]
+                readings[metric_name][aggregator.aggregator_id] = {
+                    'value': value,
+                    'time': datetime.fromtimestamp(timestamp).strftime('%H:%M:%S'),
+                }
+    return readings
+
+@lru_cache(maxsize=1)
+def figure_template():
+    """The default plotly template, so clientside figures look like the server's"""
+    return pio.templates[pio.templates.default].to_plotly_json()
+
+def figure_settings():
+    """FIGURE_SETTINGS for the clientside charts, which pick their trace type the same way"""
+    return dict(FIGURE_SETTINGS)
+
+# Figures that are the same for every client, and the data the clientside
+# callbacks draw figures from, precomputed by the figure cache
+SHARED_FIGURES = {
+    'cpu-percent': lambda: create_time_series_graph('CPU Percent'),
+    'ram-usage': lambda: create_time_series_graph('RAM Usage'),
+    'gauges': gauge_readings,
+    'stock-series': stock_series,
+    'btc-usd': lambda: create_btc_usd_time_series_graph(),
+}
+
+def figure_status_text(keys):
+    parts = []
+    for key in keys:
+        entry = figure_cache.get(key)
+        if entry:
+            parts.append(f"{key}: updated {entry.age_seconds:.0f}s ago, built in {entry.build_seconds * 1000:.0f} ms")
+    return " | ".join(parts)
+
+DIAGNOSTICS_PATH = '/diagnostics'
+
+def profile_summary_table(rows):
+    if not rows:
+        return html.Div("No callbacks profiled yet")
+    columns = list(rows[0].keys())
+    return html.Table([
+        html.Thead(html.Tr([html.Th(column) for column in columns])),
+        html.Tbody([html.Tr([html.Td(row[column]) for column in columns]) for row in rows])
+    ], className="diagnostics-table")
 
 def create_dash_app(flask_app):
     """Create and return a Dash app instance"""
+    configure_figures(flask_app.config.get('APP_CONFIG', {}).get('figures', {}))
+    for key, builder in SHARED_FIGURES.items():
+        figure_cache.register(key, builder)
+
     current_dir = os.getcwd()
     assets_dir = os.path.join(current_dir, 'assets')
     logger.debug(f"Current directory: {current_dir}")
@@ -44,28 +310,34 @@ def create_dash_app(flask_app):
     @dash_app.callback(
         Output('page-content', 'children'),
         [Input('win-os-metrics-button', 'n_clicks'),
-         Input('stock-metrics-button', 'n_clicks')]
+         Input('stock-metrics-button', 'n_clicks'),
+         Input('url', 'pathname')]
     )
-    def display_metrics(win_clicks, stock_clicks):
+    def display_metrics(win_clicks, stock_clicks, pathname):
         ctx = dash.callback_context
-        if not ctx.triggered:
-            return html.Div()
-        button_id = ctx.triggered[0]['prop_id'].split('.')[0]
+        button_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
         if button_id == 'win-os-metrics-button':
             return get_windows_metrics_layout()
         elif button_id == 'stock-metrics-button':
             return get_stock_metrics_layout()
+        elif pathname == DIAGNOSTICS_PATH:
+            # Not linked from the nav buttons, only reachable by URL
+            return get_diagnostics_layout()
         return html.Div()
 
     
 
     def get_windows_metrics_layout():
-        aggregators = db.session.query(Aggregator).all()
+        catalog.sync(db.session)
+        aggregators = catalog.aggregator_list()
         default_aggregator = aggregators[0].aggregator_id if aggregators else None
     
         return html.Div([
             html.H1("Windows Metrics", className="dashboard-title"),
             dcc.Interval(id='interval-component', interval=30*1000, n_intervals=0),
+            # Latest readings of every aggregator: switching aggregator is clientside
+            dcc.Store(id='gauge-store'),
+            dcc.Store(id='figure-template', data=figure_template()),
             html.Div([
                 html.Div([
                     dcc.Graph(id='cpu-percent-graph')
@@ -92,31 +364,37 @@ def create_dash_app(flask_app):
                 ], className="card"),
             ], className="card-container"),
             # Add a trigger button to manually update graphs
-            html.Button("Refresh Data", id="refresh-button", className="nav-button")
+            html.Button("Refresh Data", id="refresh-button", className="nav-button"),
+            html.Div(id='winos-figure-status', className="figure-status")
         ])
     
     def get_stock_metrics_layout():
-        # Get unique stock symbols by extracting them from metric names
-        stock_metrics = db.session.query(DeviceMetricType.name)\
-            .filter(DeviceMetricType.name.like('Stock Price (%)'))\
-            .distinct()\
-            .all()
-
-        # Extract stock symbols from metric names
-        stock_options = []
-        for row in stock_metrics:
-            name = row[0]  # Extract string from SQLAlchemy Row
-            symbol_match = re.search(r'Stock Price \((.*?)\)', name)
-            if symbol_match:
-                symbol = symbol_match.group(1)
-                stock_options.append({'label': symbol, 'value': symbol})
+        # Stock symbols are parsed out of the metric names once, by the catalog
+        catalog.sync(db.session)
+        stock_options = [
+            {'label': symbol, 'value': symbol}
+            for symbol in catalog.symbols(STOCK_PRICE_CATEGORY)
+        ]
         default_stock = stock_options[0]['value'] if stock_options else None
 
         return html.Div([
             html.H1("Stock Metrics", className="dashboard-title"),
             dcc.Interval(id='stock-interval-component', interval=60*1000, n_intervals=0),
+            # Raw price series: the view, symbol and styling are applied clientside
+            dcc.Store(id='stock-series-store'),
+            dcc.Store(id='figure-template', data=figure_template()),
+            dcc.Store(id='figure-settings', data=figure_settings()),
             html.Div([
                 html.Div([
+                    dcc.RadioItems(
+                        id='stock-view',
+                        options=[
+                            {'label': '% change', 'value': 'normalized'},
+                            {'label': 'Price', 'value': 'price'}
+                        ],
+                        value='normalized',
+                        inline=True
+                    ),
                     dcc.Graph(id='stock-price-graph')
                 ], className="card"),
                 html.Div([
@@ -134,6 +412,7 @@ def create_dash_app(flask_app):
                 ], className="card")
             ], className="card-container"),
             html.Button("Refresh Data", id="stock-refresh-button", className="nav-button"),
+            html.Div(id='stock-figure-status', className="figure-status"),
             html.H3("Add Stock Symbols", className="card-title"),
                     dcc.Input(
                         id='stock-symbols-input',
@@ -145,364 +424,135 @@ def create_dash_app(flask_app):
                     html.Div(id='symbols-status-message')
         ])
     
-    def base_metric_query(fetch_aggregator=False):
-        columns = [Snapshot.client_timestamp_epoch, Metric.value]
-        if fetch_aggregator:
-            columns.append(Aggregator.name)
-        return db.session.query(*columns).join(Metric).join(DeviceMetricType).join(Device)
-
-    def add_aggregator_join(query):
-        return query.join(Aggregator)
-
-    def add_metric_filter(query, metric_name):
-        return query.filter(DeviceMetricType.name == metric_name)
-
-    def add_aggregator_filter(query, aggregator_id):
-        return query.filter(Device.aggregator_id == aggregator_id)
-
-    def order_by_timestamp(query):
-        return query.order_by(desc(Snapshot.client_timestamp_epoch))
-
-    def add_limit(query, limit):
-        return query.limit(limit)
-
-    def fetch_metric_data(metric_name, aggregator_id=None, limit=None):
-        try:
-            query = base_metric_query()
-            query = add_metric_filter(query, metric_name)
-            if aggregator_id:
-                query = add_aggregator_filter(query, aggregator_id)
-            query = order_by_timestamp(query)
-            if limit:
-                query = add_limit(query, limit)
-            return query.all()
-        except Exception as e:
-            logger.error(f"Error fetching {metric_name} data: {str(e)}")
-            return []
-
-    def fetch_metric_data_by_aggregator(metric_name):
-        try:
-            query = base_metric_query(fetch_aggregator=True)
-            query = add_aggregator_join(query)
-            query = add_metric_filter(query, metric_name)
-            query = order_by_timestamp(query)
-            return query.all()
-        except Exception as e:
-            logger.error(f"Error fetching {metric_name} data: {str(e)}")
-            return []
-
-    def create_time_series_figure(df, metric_name, yaxis_title):
-        figure = px.line(df, x='timestamp', y='value', title=f'{metric_name} Over Time')
-        figure.update_layout(
-            xaxis_title='Time',
-            yaxis_title=yaxis_title,
-            legend=dict(
-                orientation="h",
-                yanchor="bottom",
-                y=1.02,
-                xanchor="center",
-                x=0.5
-            )
-        )
-        return figure
-
-    def create_time_series_graph(metric_name):
-        figure = go.Figure()
-        metric_data = fetch_metric_data_by_aggregator(metric_name)
-        if metric_data:
-            logger.info(f"Data found for {metric_name}: {metric_data}")
-            df = pd.DataFrame(metric_data, columns=['timestamp', 'value', 'aggregator'])
-            df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
-            for aggregator in df['aggregator'].unique():
-                agg_df = df[df['aggregator'] == aggregator]
-                figure.add_trace(go.Scatter(
-                    x=agg_df['timestamp'],
-                    y=agg_df['value'],
-                    mode='lines',
-                    name=aggregator
-                ))
-            figure.update_layout(
-                title=f'{metric_name} Over Time',
-                xaxis_title='Time',
-                yaxis_title=metric_name,
-                legend=dict(
-                    orientation="h",
-                    yanchor="bottom",
-                    y=1.02,
-                    xanchor="center",
-                    x=0.5
-                )
-            )
-        return figure
-
-    def create_all_stocks_time_series_graph():
-        figure = go.Figure()
-    
-        try:
-            logger.info("Fetching all stock data")
-            metric_data = db.session.query(Snapshot.client_timestamp_epoch, Metric.value, DeviceMetricType.name)\
-                .select_from(Snapshot)\
-                .join(Metric, Snapshot.snapshot_id == Metric.snapshot_id)\
-                .join(DeviceMetricType, Metric.device_metric_type_id == DeviceMetricType.device_metric_type_id)\
-                .filter(DeviceMetricType.name.like('Stock Price (%)'))\
-                .order_by(Snapshot.client_timestamp_epoch)\
-                .all()
-            logger.info("All stock data fetched")
-            logger.debug(f"Number of stock records found: {len(metric_data)}")
-            
-            if metric_data:
-                df = pd.DataFrame(metric_data, columns=['timestamp', 'value', 'Stock'])
-                df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
-                df['Stock'] = df['Stock'].str.extract(r'Stock Price \((.*?)\)')
-                
-                # Normalize data - calculate percentage change relative to first value for each stock
-                normalized_df = df.copy()
-                normalized_df['normalized_value'] = 0.0  # Initialize with default values
-                stocks = normalized_df['Stock'].unique()
-                
-                for stock in stocks:
-                    stock_data = normalized_df[normalized_df['Stock'] == stock]
-                    if not stock_data.empty:
-                        # Get the first value for this stock
-                        first_value = stock_data['value'].iloc[0]
-                        if (first_value != 0):  # Avoid division by zero
-                            # Calculate percentage change from first value
-                            normalized_df.loc[normalized_df['Stock'] == stock, 'normalized_value'] = \
-                                ((normalized_df.loc[normalized_df['Stock'] == stock, 'value'] - first_value) / first_value) * 100
-                
-                # Remove any rows with NaN values
-                normalized_df = normalized_df.dropna(subset=['normalized_value'])
-                
-                # Make sure we still have data to plot
-                if not normalized_df.empty:
-                    # Create the figure using go.Figure and go.Scatter for more control
-                    figure = go.Figure()
-                    
-                    for stock in stocks:
-                        stock_data = normalized_df[normalized_df['Stock'] == stock]
-                        if not stock_data.empty:
-                            figure.add_trace(go.Scatter(
-                                x=stock_data['timestamp'],
-                                y=stock_data['normalized_value'],
-                                mode='lines',
-                                name=stock
-                            ))
-                    
-                    figure.update_layout(
-                        title='Stock Price Performance (% Change from Initial Price)',
-                        xaxis_title='Time',
-                        yaxis_title='Percentage Change (%)',
-                        legend=dict(
-                            orientation="h",
-                            yanchor="bottom",
-                            y=1.02,
-                            xanchor="center",
-                            x=0.5,
-                            itemsizing='constant',
-                            itemwidth=40,
-                        ),
-                        margin=dict(t=100),
-                        title_x=0.5,
-                        title_y=0.95
-                    )
-                    
-                    # Add a horizontal line at y=0 for reference
-                    figure.add_shape(
-                        type="line",
-                        x0=normalized_df['timestamp'].min(),
-                        x1=normalized_df['timestamp'].max(),
-                        y0=0,
-                        y1=0,
-                        line=dict(color="gray", width=1, dash="dash")
-                    )
-                else:
-                    logger.warning("No valid data after normalization for stocks")
-                    
-            else:
-                logger.warning("No stock data found")
-                    
-        except Exception as e:
-            logger.error(f"Error updating stock graph: {str(e)}")
-            # Log the full traceback for debugging
-            import traceback
-            logger.error(traceback.format_exc())
-    
-        return figure
-    
-    def create_btc_usd_time_series_graph():
-        figure = go.Figure()
-
-        try:
-            metric_name = "BTC-USD"
-            logger.info(f"Fetching {metric_name} data")
-            metric_data = fetch_metric_data(metric_name)
-            logger.info(f"{metric_name} data fetched")
-            logger.debug(f"Number of {metric_name} records found: {len(metric_data)}")
-            
-            if metric_data:
-                df = pd.DataFrame(metric_data, columns=['timestamp', 'value'])
-                df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
-                figure = create_time_series_figure(df, metric_name, 'Bitcoin value (USD)')
-        except Exception as e:
-            logger.error(f"Error updating {metric_name} graph: {str(e)}")
-
-        return figure
-    
-    def create_gauge(metric_name, aggregator_id):
-        gauge = go.Figure()
-        if not aggregator_id:
-            logger.error("Aggregator ID not provided for %s gauge", metric_name)
-            return gauge
-
-        metric_data = fetch_metric_data(metric_name, aggregator_id, limit=1)
-        if metric_data:
-            timestamp, value = metric_data[0]
-            readable_time = datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')
-            gauge = go.Figure(go.Indicator(
-                mode="gauge+number",
-                value=value,
-                title={'text': f"{metric_name}", 'font': {'size': 24}},
-                gauge={
-                    'axis': {'range': [0, 100]},
-                    'bar': {'color': "darkblue" if value < 70 else "red"},
-                    'steps': [
-                        {'range': [0, 50], 'color': 'lightgreen'},
-                        {'range': [50, 70], 'color': 'yellow'},
-                        {'range': [70, 100], 'color': 'pink'}
-                    ],
-                    'threshold': {
-                        'line': {'color': "red", 'width': 4},
-                        'thickness': 0.75,
-                        'value': 90
-                    }
-                }
-            ))
-            gauge.add_annotation(
-                text=f"Last updated: {readable_time}",
-                x=0.5,
-                y=-0.25,
-                xref="paper",
-                yref="paper",
-                showarrow=False,
-                font=dict(size=14)
-            )
-            gauge.update_layout(
-                height=250,
-                margin=dict(l=20, r=20, t=60, b=60)
-            )
-        return gauge
-
-    def create_stock_line_chart(symbol):
-        figure = go.Figure()
-        metric_name = f"Stock Price ({symbol})"
-        metric_data = fetch_metric_data(metric_name)
-        if metric_data:
-            df = pd.DataFrame(metric_data, columns=['timestamp', 'value'])
-            df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
-            figure = create_time_series_figure(df, metric_name, 'Stock Price (USD)')
-            if not df.empty:
-                current_price = df['value'].iloc[0]
-                figure.add_annotation(
-                    text=f"${current_price:.2f}",
-                    x=df['timestamp'].iloc[0],
-                    y=current_price,
-                    xref="x",
-                    yref="y",
-                    showarrow=True,
-                    arrowhead=2,
-                    ax=0,
-                    ay=-40,
-                    font=dict(size=14, color="red"),
-                    bgcolor="white"
-                )
-        return figure
+    def get_diagnostics_layout():
+        return html.Div([
+            html.H1("Callback Diagnostics", className="dashboard-title"),
+            dcc.Interval(id='diagnostics-interval', interval=5*1000, n_intervals=0),
+            html.Div(id='diagnostics-table', className="card")
+        ])
 
     @dash_app.callback(
         Output('cpu-percent-graph', 'figure'),
         [Input('refresh-button', 'n_clicks')]
     )
+    @callback_profiler.profiled()
     def update_cpu_graph(n_clicks):
-        return create_time_series_graph('CPU Percent')
+        # A click rebuilds now, so the response carries the new data
+        return figure_cache.figure('cpu-percent', rebuild=bool(n_clicks))
 
     @dash_app.callback(
         Output('ram-usage-graph', 'figure'),
         [Input('refresh-button', 'n_clicks')]
     )
+    @callback_profiler.profiled()
     def update_ram_graph(n_clicks):
-        return create_time_series_graph('RAM Usage')
+        return figure_cache.figure('ram-usage', rebuild=bool(n_clicks))
     
     @dash_app.callback(
-        Output('stock-price-graph', 'figure'),
+        Output('stock-series-store', 'data'),
         [Input('stock-refresh-button', 'n_clicks')]
     )
-    def update_all_stocks_graph(n_clicks):
-        return create_all_stocks_time_series_graph()
+    @callback_profiler.profiled()
+    def update_stock_series(n_clicks):
+        return figure_cache.figure('stock-series', rebuild=bool(n_clicks))
     
     @dash_app.callback(
         Output('btc-usd-graph', 'figure'),
         [Input('stock-refresh-button', 'n_clicks')]
     )
+    @callback_profiler.profiled()
     def update_btc_usd_graph(n_clicks):
-        return create_btc_usd_time_series_graph()
+        return figure_cache.figure('btc-usd', rebuild=bool(n_clicks))
     
     @dash_app.callback(
-        Output('cpu-usage-gauge', 'figure'),
-        [Input('refresh-button', 'n_clicks'),
-         Input('aggregator-dropdown', 'value')]
+        Output('gauge-store', 'data'),
+        [Input('refresh-button', 'n_clicks')]
     )
-    def update_cpu_gauge(n_clicks, aggregator_id):
-        return create_gauge('CPU Percent', aggregator_id)
-    
-    @dash_app.callback(
-        Output('ram-usage-gauge', 'figure'),
-        [Input('refresh-button', 'n_clicks'),
-         Input('aggregator-dropdown', 'value')]
+    @callback_profiler.profiled()
+    def update_gauge_store(n_clicks):
+        return figure_cache.figure('gauges', rebuild=bool(n_clicks))
+
+    # Presentation only: these run in the browser, see assets/dashboard_clientside.js
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace='dashboard', function_name='renderGauges'),
+        [Output('cpu-usage-gauge', 'figure'),
+         Output('ram-usage-gauge', 'figure')],
+        [Input('gauge-store', 'data'),
+         Input('aggregator-dropdown', 'value')],
+        [dash.State('figure-template', 'data')]
     )
-    def update_ram_gauge(n_clicks, aggregator_id):
-        return create_gauge('RAM Usage', aggregator_id)
-    
-    @dash_app.callback(
+
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace='dashboard', function_name='renderStockPerformance'),
+        Output('stock-price-graph', 'figure'),
+        [Input('stock-series-store', 'data'),
+         Input('stock-view', 'value')],
+        [dash.State('figure-template', 'data'),
+         dash.State('figure-settings', 'data')]
+    )
+
+    dash_app.clientside_callback(
+        ClientsideFunction(namespace='dashboard', function_name='renderStockLineChart'),
         Output('stock-price-line-chart', 'figure'),
-        [Input('stock-refresh-button', 'n_clicks'),
-         Input('stock-dropdown', 'value')]
+        [Input('stock-series-store', 'data'),
+         Input('stock-dropdown', 'value')],
+        [dash.State('figure-template', 'data'),
+         dash.State('figure-settings', 'data')]
     )
-    def update_stock_line_chart(n_clicks, symbol):
-        if not symbol:
-            return go.Figure()
-        return create_stock_line_chart(symbol)
 
     # Callback to update graphs when interval triggers
     @dash_app.callback(
         [Output('cpu-percent-graph', 'figure', allow_duplicate=True),
          Output('ram-usage-graph', 'figure', allow_duplicate=True),
-         Output('cpu-usage-gauge', 'figure', allow_duplicate=True),
-         Output('ram-usage-gauge', 'figure', allow_duplicate=True)],
+         Output('gauge-store', 'data', allow_duplicate=True)],
         [Input('interval-component', 'n_intervals')],
-        [dash.State('aggregator-dropdown', 'value')],
         prevent_initial_call=True
     )
-    def update_winos_graphs_interval(n_intervals, aggregator_id):
+    @callback_profiler.profiled()
+    def update_winos_graphs_interval(n_intervals):
         logger.info(f"Interval refresh triggered for WinOS metrics")
-        cpu_figure = create_time_series_graph('CPU Percent')
-        ram_figure = create_time_series_graph('RAM Usage')
-        cpu_gauge = create_gauge('CPU Percent', aggregator_id)
-        ram_gauge = create_gauge('RAM Usage', aggregator_id)
-        return cpu_figure, ram_figure, cpu_gauge, ram_gauge
+        cpu_figure = figure_cache.figure('cpu-percent')
+        ram_figure = figure_cache.figure('ram-usage')
+        gauges = figure_cache.figure('gauges')
+        return cpu_figure, ram_figure, gauges
 
     @dash_app.callback(
-        [Output('stock-price-graph', 'figure', allow_duplicate=True),
-         Output('btc-usd-graph', 'figure', allow_duplicate=True),
-         Output('stock-price-line-chart', 'figure', allow_duplicate=True)],
+        [Output('stock-series-store', 'data', allow_duplicate=True),
+         Output('btc-usd-graph', 'figure', allow_duplicate=True)],
         [Input('stock-interval-component', 'n_intervals')],
-        [dash.State('stock-dropdown', 'value')],
         prevent_initial_call=True
     )
-    def update_stock_graphs_interval(n_intervals, symbol):
+    @callback_profiler.profiled()
+    def update_stock_graphs_interval(n_intervals):
         logger.info(f"Interval refresh triggered for stock metrics")
-        stock_figure = create_all_stocks_time_series_graph()
-        btc_figure = create_btc_usd_time_series_graph()
-        stock_line_chart = create_stock_line_chart(symbol) if symbol else go.Figure()
-        return stock_figure, btc_figure, stock_line_chart
+        stocks = figure_cache.figure('stock-series')
+        btc_figure = figure_cache.figure('btc-usd')
+        return stocks, btc_figure
+
+    @dash_app.callback(
+        Output('winos-figure-status', 'children'),
+        [Input('interval-component', 'n_intervals'),
+         Input('refresh-button', 'n_clicks')]
+    )
+    def update_winos_figure_status(n_intervals, n_clicks):
+        return figure_status_text(['cpu-percent', 'ram-usage', 'gauges'])
+
+    @dash_app.callback(
+        Output('stock-figure-status', 'children'),
+        [Input('stock-interval-component', 'n_intervals'),
+         Input('stock-refresh-button', 'n_clicks')]
+    )
+    def update_stock_figure_status(n_intervals, n_clicks):
+        return figure_status_text(['stock-series', 'btc-usd'])
+
+    @dash_app.callback(
+        Output('diagnostics-table', 'children'),
+        [Input('diagnostics-interval', 'n_intervals')]
+    )
+    def update_diagnostics_table(n_intervals):
+        if not callback_profiler.enabled:
+            return html.Div("Callback profiling is off, set diagnostics.profile_callbacks in the config to enable it")
+        return profile_summary_table(callback_profiler.summary())
 
     # This callback will change the stock symbols returned by the /stock-symbols route
     @dash_app.callback(
@@ -0,0 +1,160 @@
+from callback_profiler import callback_profiler
+from dataclasses import dataclass
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedFigure:
+    key: str
+    figure: dict
+    # Size of the serialized figure; only the parsed form is kept, it is
+    # what the callbacks return
+    figure_bytes: int
+    built_at: float
+    build_seconds: float
+
+    @property
+    def age_seconds(self):
+        return time.time() - self.built_at
+
+
+class FigureCache:
+    """Shared figures rebuilt off the request path.
+
+    Builders are registered once by the dashboard and run by a background
+    thread after ingest (see `mark_stale`) or every `refresh_interval` seconds.
+    Callbacks read the latest built figure, except a Refresh click, which
+    rebuilds it on the spot. Concurrent rebuilds of the same figure
+    collapse into a single build.
+    """
+
+    def __init__(self, refresh_interval=30.0, debounce=1.0):
+        self.refresh_interval = refresh_interval
+        self.debounce = debounce
+        self._builders = {}
+        self._entries = {}
+        self._inflight = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._app = None
+
+    def register(self, key, builder):
+        """Register a zero-argument callable returning a plotly figure, or a JSON-serializable dict"""
+        self._builders[key] = builder
+
+    def keys(self):
+        return list(self._builders)
+
+    def get(self, key):
+        """Latest figure for `key`, only building it here if the cache is cold"""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self.rebuild(key)
+        return entry
+
+    def figure(self, key, rebuild=False):
+        """The cached figure, or with `rebuild` (e.g. a Refresh click) a freshly built one"""
+        entry = self.rebuild(key) if rebuild else self.get(key)
+        return entry.figure if entry else {}
+
+    def rebuild(self, key):
+        """Build `key` now; callers arriving while a build is running wait for it instead"""
+        with self._lock:
+            done = self._inflight.get(key)
+            leader = done is None
+            if leader:
+                done = self._inflight[key] = threading.Event()
+
+        if not leader:
+            done.wait()
+            return self._entries.get(key)
+
+        try:
+            started = time.perf_counter()
+            with callback_profiler.profile(f'figure:{key}'):
+                if self._app is not None:
+                    with self._app.app_context():
+                        figure = self._builders[key]()
+                else:
+                    figure = self._builders[key]()
+                with callback_profiler.phase('serialize'):
+                    # Plain data for clientside callbacks, or a plotly figure
+                    figure_json = json.dumps(figure) if isinstance(figure, dict) else figure.to_json()
+                figure_dict = json.loads(figure_json)
+                callback_profiler.record_serialized(figure_json, figure_dict)
+            entry = CachedFigure(
+                key=key,
+                figure=figure_dict,
+                figure_bytes=len(figure_json),
+                built_at=time.time(),
+                build_seconds=time.perf_counter() - started
+            )
+            self._entries[key] = entry
+            logger.debug(f"Rebuilt figure {key} in {entry.build_seconds * 1000:.1f} ms "
+                         f"({len(figure_json)} bytes)")
+            return entry
+        except Exception as e:
+            logger.error(f"Error rebuilding figure {key}: {e}")
+            return self._entries.get(key)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            done.set()
+
+    def mark_stale(self, keys=None):
+        """Ask the background thread to rebuild `keys` (default: everything) soon"""
+        with self._lock:
+            self._stale.update(keys or self._builders)
+        self._wakeup.set()
+
+    def status(self):
+        return {
+            key: {
+                'age_seconds': round(entry.age_seconds, 1),
+                'build_ms': round(entry.build_seconds * 1000, 1),
+                'bytes': entry.figure_bytes
+            }
+            for key, entry in self._entries.items()
+        }
+
+    def start(self, app):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._app = app
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="figure-cache", daemon=True)
+        self._thread.start()
+        logger.info(f"Figure cache started, refreshing every {self.refresh_interval}s")
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            triggered = self._wakeup.wait(self.refresh_interval)
+            if self._stopping.is_set():
+                break
+            if triggered:
+                # Let a burst of ingest requests settle into a single rebuild
+                time.sleep(self.debounce)
+            self._wakeup.clear()
+            with self._lock:
+                keys = list(self._stale) if triggered else list(self._builders)
+                self._stale.clear()
+            for key in keys:
+                self.rebuild(key)
+
+
+figure_cache = FigureCache()
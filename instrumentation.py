@@ -0,0 +1,207 @@
+from bisect import bisect_left
+from flask import g, has_request_context, request
+from sqlalchemy import event
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+INGEST_LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def render_gauge(name, help_text, values, label_name=None):
+    """Lines for a gauge; `values` is a number, or a dict of label value -> number"""
+    return _render_values(name, help_text, 'gauge', values, label_name)
+
+
+def render_counter(name, help_text, values, label_name=None):
+    """Lines for a counter kept elsewhere; `name` should end in _total"""
+    return _render_values(name, help_text, 'counter', values, label_name)
+
+
+def _render_values(name, help_text, metric_type, values, label_name):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    if isinstance(values, dict):
+        for label_value, value in sorted(values.items()):
+            lines.append(f"{name}{_format_labels([(label_name, label_value)])} {value}")
+    else:
+        lines.append(f"{name} {values}")
+    return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in self._series.items()]
+        for label_values, counts, total, count in sorted(snapshot):
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        for label_values, value in snapshot:
+            lines.append(f"{self.name}{_format_labels(list(zip(self.label_names, label_values)))} {value}")
+        return lines
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', "Request latency by route",
+    ('route', 'method', 'status'), LATENCY_BUCKETS)
+request_statements = Histogram(
+    'http_request_sql_statements', "SQL statements executed per request",
+    ('route',), STATEMENT_COUNT_BUCKETS)
+request_sql_duration = Histogram(
+    'http_request_sql_duration_seconds', "Time spent in SQL per request",
+    ('route',), LATENCY_BUCKETS)
+background_statements = Counter(
+    'background_sql_statements_total', "SQL statements executed outside of requests", ())
+background_sql_seconds = Counter(
+    'background_sql_duration_seconds_total', "Time spent in SQL outside of requests", ())
+rows_ingested = Counter(
+    'ingest_rows_total', "Metric rows ingested", ('aggregator',))
+snapshots_ingested = Counter(
+    'ingest_snapshots_total', "Snapshots ingested", ('aggregator',))
+ingest_lag = Histogram(
+    'ingest_lag_seconds', "Delay between client capture and server receipt of a snapshot",
+    ('aggregator',), INGEST_LAG_BUCKETS)
+
+METRICS = [
+    request_duration,
+    request_statements,
+    request_sql_duration,
+    background_statements,
+    background_sql_seconds,
+    rows_ingested,
+    snapshots_ingested,
+    ingest_lag,
+]
+
+
+def record_ingest(aggregator, rows, lags):
+    """Called by the ingest path once a batch is committed"""
+    rows_ingested.inc(rows, aggregator)
+    snapshots_ingested.inc(len(lags), aggregator)
+    for lag in lags:
+        ingest_lag.observe(lag, aggregator)
+
+
+def _route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.instrumentation_started = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+
+
+def _after_request(response):
+    started = g.pop('instrumentation_started', None)
+    if started is not None:
+        route = _route_label()
+        request_duration.observe(time.perf_counter() - started, route, request.method, response.status_code)
+        request_statements.observe(g.get('sql_statements', 0), route)
+        request_sql_duration.observe(g.get('sql_seconds', 0.0), route)
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, so a failed statement leaves nothing behind
+    context._instrumentation_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_instrumentation_started', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+    else:
+        background_statements.inc(1)
+        background_sql_seconds.inc(elapsed)
+
+
+def instrument_engine(engine):
+    """Time the statements run on `engine`, e.g. a shard's, as part of the current request"""
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_instrumentation(app, db, engines=()):
+    """Hook request timing into `app` and statement timing into its engine and `engines`"""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    with app.app_context():
+        instrument_engine(db.engine)
+    for engine in engines:
+        instrument_engine(engine)
+    logger.info("Request and SQL instrumentation enabled")
+
+
+def render_metrics(extra_lines=()):
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
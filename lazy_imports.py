@@ -0,0 +1,52 @@
+import importlib
+import threading
+
+# Modules that take a noticeable share of startup time. They are only needed
+# once a figure is built or a symbol is validated, so nothing imports them at
+# module level; warm_imports() loads them up front where that is preferable
+# (e.g. in a pre-fork master so the workers share the pages).
+HEAVY_MODULES = [
+    'pandas',
+    'plotly.graph_objects',
+    'plotly.express',
+    'reticker',
+]
+
+_import_lock = threading.Lock()
+
+
+class LazyModule:
+    """Stand-in for a module that is imported on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _import_lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+def lazy_module(name):
+    return LazyModule(name)
+
+
+def warm_imports(modules=None):
+    """Import the heavy modules now, returning the seconds spent on each"""
+    import time
+    timings = {}
+    for name in modules or HEAVY_MODULES:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        timings[name] = time.perf_counter() - started
+    return timings
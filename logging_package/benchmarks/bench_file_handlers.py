@@ -0,0 +1,104 @@
+"""Records per second of JsonFileHandler vs NdjsonFileHandler as the log file grows.
+
+    python benchmarks/bench_file_handlers.py --sizes-mb 0,1,10,100,300 --output results.json
+
+Each run pre-fills a fresh file to the given size, then logs records through
+the handler until either --records have been written or --max-seconds have
+passed (JsonFileHandler needs the time limit: every record rewrites the file).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from my_logging.json_file_handler import JsonFileHandler
+from my_logging.ndjson_file_handler import NdjsonFileHandler
+
+SAMPLE_ENTRY = {
+    "asctime": "2025-01-01 00:00:00,000",
+    "name": "routes",
+    "levelname": "INFO",
+    "message": "Mapping DTO to Model",
+}
+
+def prefill(path, size_bytes, as_array):
+    line = json.dumps(SAMPLE_ENTRY)
+    count = max(size_bytes // (len(line) + 1), 0)
+    chunk = 10000
+    with open(path, 'w') as f:
+        if as_array:
+            f.write('[')
+        written = 0
+        while written < count:
+            n = min(chunk, count - written)
+            separator = ',' if as_array else '\n'
+            if as_array and written:
+                f.write(',')
+            f.write(separator.join([line] * n))
+            if not as_array:
+                f.write('\n')
+            written += n
+        if as_array:
+            f.write(']')
+    return os.path.getsize(path)
+
+def make_record(i):
+    return logging.LogRecord(
+        name='bench', level=logging.INFO, pathname=__file__, lineno=i,
+        msg=f"benchmark record {i}", args=None, exc_info=None
+    )
+
+def run(handler_class, path, records, max_seconds):
+    handler = handler_class(path)
+    handler.setFormatter(logging.Formatter(
+        '{"asctime": "%(asctime)s", "name": "%(name)s", "levelname": "%(levelname)s", "message": "%(message)s"}'
+    ))
+    written = 0
+    started = time.perf_counter()
+    deadline = started + max_seconds
+    while written < records and time.perf_counter() < deadline:
+        handler.handle(make_record(written))
+        written += 1
+    handler.close()
+    elapsed = time.perf_counter() - started
+    return written, elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes-mb', default='0,1,10,100', help="comma separated initial file sizes")
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--max-seconds', type=float, default=10.0)
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_mb in [float(size) for size in args.sizes_mb.split(',')]:
+            for handler_class, as_array in [(JsonFileHandler, True), (NdjsonFileHandler, False)]:
+                path = os.path.join(tmp, f'bench.{handler_class.__name__}.log')
+                initial_bytes = prefill(path, int(size_mb * 1024 * 1024), as_array)
+                written, elapsed = run(handler_class, path, args.records, args.max_seconds)
+                result = {
+                    'handler': handler_class.__name__,
+                    'initial_mb': size_mb,
+                    'initial_bytes': initial_bytes,
+                    'records': written,
+                    'seconds': elapsed,
+                    'records_per_second': written / elapsed if elapsed else None,
+                }
+                results.append(result)
+                print(f"{result['handler']:<20} {size_mb:>8.1f} MB  {written:>8} records  "
+                      f"{result['records_per_second']:>12.1f} records/s")
+                os.remove(path)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,44 @@
 from datetime import datetime
+from my_logging.queue_logging import enable_queue_logging, disable_queue_logging
 import logging.config
 import json
 import os
 
+# Handler class and file extension for each supported log file format
+FILE_FORMATS = {
+    'json': ('my_logging.json_file_handler.JsonFileHandler', 'json'),
+    'ndjson': ('my_logging.ndjson_file_handler.NdjsonFileHandler', 'ndjson'),
+}
+ROTATING_HANDLER = 'my_logging.rotating_handler.RotatingNdjsonFileHandler'
+
 def setup_logging(
     default_path=None,
     default_level=logging.INFO,
-    env_key='LOG_CFG'
+    env_key='LOG_CFG',
+    file_format=None,
+    use_queue=None,
+    rotate=None
 ):
-    """Setup logging configuration"""
+    """Setup logging configuration
+
+    `file_format` picks the file handler: 'json' (a single JSON array,
+    rewritten on every record) or 'ndjson' (append-only, one record per
+    line). It defaults to the LOG_FORMAT environment variable, then to the
+    "my_logging" section of the config file, then to 'json'.
+
+    With `use_queue` (or LOG_QUEUE=1, or "queue": {"enabled": true} in the
+    config) the root handlers run on a listener thread and callers only
+    enqueue records, see my_logging.queue_logging.
+
+    With `rotate` (or LOG_ROTATE=1, or "rotation": {"enabled": true}) the
+    file rolls over at midnight and at a size cap, rotated files are
+    compressed and only the newest ones are kept. Rotation always writes
+    NDJSON, see my_logging.rotating_handler.
+    """
     if default_path is None:
         # Determine the path to the config.json file relative to this script
         default_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'config.json')
-    
+
     path = default_path
     value = os.getenv(env_key, None)
     if value:
@@ -20,20 +46,50 @@ def setup_logging(
     if os.path.exists(path):
         with open(path, 'rt') as f:
             config = json.load(f)
-        
+
+        # Options for this package, not understood by dictConfig
+        options = config.pop('my_logging', {})
+        file_format = file_format or os.getenv('LOG_FORMAT') or options.get('file_format', 'json')
+        if file_format not in FILE_FORMATS:
+            raise ValueError(f"Unknown log file format: {file_format}")
+        handler_class, extension = FILE_FORMATS[file_format]
+
+        rotation_options = dict(options.get('rotation', {}))
+        if rotate is None:
+            rotate = os.getenv('LOG_ROTATE', '').lower() in ('1', 'true', 'yes') \
+                or rotation_options.get('enabled', False)
+        rotation_options.pop('enabled', None)
+        if rotate:
+            file_format = 'ndjson'
+            handler_class, extension = ROTATING_HANDLER, 'ndjson'
+
         # Ensure the logs directory exists in the current working directory
         log_dir = os.path.join(os.getcwd(), 'logs')
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
-        
+
         # Set the filename dynamically based on the current date
         date_str = datetime.now().strftime('%Y-%m-%d')
-        config['handlers']['file']['filename'] = os.path.join(log_dir, f'{date_str}.json')
+        config['handlers']['file']['class'] = handler_class
+        config['handlers']['file']['filename'] = os.path.join(log_dir, f'{date_str}.{extension}')
+        if file_format == 'ndjson':
+            config['handlers']['file'].update(options.get('ndjson', {}))
+        if rotate:
+            config['handlers']['file'].update(rotation_options)
 
+        # Stop a pipeline from an earlier call before its handlers are replaced
+        disable_queue_logging()
         logging.config.dictConfig(config)
+
+        queue_options = options.get('queue', {})
+        if use_queue is None:
+            use_queue = os.getenv('LOG_QUEUE', '').lower() in ('1', 'true', 'yes') \
+                or queue_options.get('enabled', False)
+        if use_queue:
+            enable_queue_logging(maxsize=queue_options.get('maxsize', 10000))
     else:
         print(f"Logging Configuration File Not Found: {path}")
         logging.basicConfig(level=default_level)
 
 if __name__ == "__main__":
-    setup_logging()
\ No newline at end of file
+    setup_logging()
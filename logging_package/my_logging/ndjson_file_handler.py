@@ -0,0 +1,113 @@
+import logging
+import json
+import os
+import threading
+import weakref
+
+# Handlers whose flusher thread has to be restarted in a forked child
+_live_handlers = weakref.WeakSet()
+
+class NdjsonFileHandler(logging.FileHandler):
+    """Append-only alternative to JsonFileHandler.
+
+    Each record is written as one JSON document per line (NDJSON), so the
+    cost of a record no longer depends on how big the file already is.
+    Records are buffered and written out when `capacity` records or
+    `flush_bytes` bytes are pending, when a record at `flush_level` or above
+    arrives, or every `flush_interval` seconds. Use my_logging.ndjson_tools
+    to read the files back or convert them to the JSON array format.
+    """
+
+    def __init__(self, filename, mode='a', encoding='utf-8', delay=False,
+                 capacity=1000, flush_bytes=256 * 1024, flush_interval=1.0,
+                 flush_level=logging.ERROR):
+        super().__init__(filename, mode, encoding, delay)
+        self.capacity = capacity
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.flush_level = logging._checkLevel(flush_level)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self._flusher = None
+        self._start_flusher()
+        _live_handlers.add(self)
+
+    def _start_flusher(self):
+        self._stop_flusher = threading.Event()
+        if self.flush_interval:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically,
+                name=f"ndjson-flush-{self.baseFilename}",
+                daemon=True
+            )
+            self._flusher.start()
+
+    def _after_fork_in_child(self):
+        # Threads don't survive a fork (e.g. gunicorn --preload workers), and
+        # the records still buffered are the parent's to write
+        self.buffer = []
+        self.buffered_bytes = 0
+        if not self._stop_flusher.is_set():
+            self._start_flusher()
+
+    def format_line(self, record):
+        log_entry = self.format(record)
+        if isinstance(record.msg, dict):
+            log_entry = json.dumps(record.msg)
+        # One document per line, whatever the formatter did with newlines
+        return log_entry.replace('\n', ' ') + '\n'
+
+    def emit(self, record):
+        try:
+            line = self.format_line(record)
+            self.buffer.append(line)
+            self.buffered_bytes += len(line)
+            if (len(self.buffer) >= self.capacity
+                    or self.buffered_bytes >= self.flush_bytes
+                    or record.levelno >= self.flush_level):
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def write_buffer(self, data):
+        """Write already-joined lines to the file, overridden by rotating handlers"""
+        if self.stream is None:
+            self.stream = self._open()
+        self.stream.write(data)
+        self.stream.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                data = ''.join(self.buffer)
+                self.buffer = []
+                self.buffered_bytes = 0
+                self.write_buffer(data)
+        finally:
+            self.release()
+
+    def _flush_periodically(self):
+        while not self._stop_flusher.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # Never let the flusher die, the next emit will retry
+                pass
+
+    def close(self):
+        _live_handlers.discard(self)
+        self._stop_flusher.set()
+        self.acquire()
+        try:
+            self.flush()
+        finally:
+            self.release()
+        super().close()
+
+def _after_fork_in_child():
+    for handler in list(_live_handlers):
+        handler._after_fork_in_child()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
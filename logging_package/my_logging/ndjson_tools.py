@@ -0,0 +1,54 @@
+import argparse
+import gzip
+import json
+import sys
+
+def iter_records(path):
+    """Yield each record of an NDJSON log file (optionally gzipped) as a dict.
+
+    Blank lines are skipped, as is a partial last line left behind by a
+    process that was killed mid-write.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"Skipping malformed line {line_number} in {path}", file=sys.stderr)
+
+def convert_to_json_array(src, dst):
+    """Write the records of an NDJSON file as the JSON array JsonFileHandler produces.
+
+    Streams line by line so arbitrarily large files can be converted.
+    Returns the number of records written.
+    """
+    count = 0
+    with open(dst, 'w', encoding='utf-8') as out:
+        out.write('[')
+        for record in iter_records(src):
+            if count:
+                out.write(',')
+            out.write(json.dumps(record))
+            count += 1
+        out.write(']')
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tools for NDJSON log files")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help="Convert an NDJSON log to a JSON array")
+    convert.add_argument('src')
+    convert.add_argument('dst')
+
+    args = parser.parse_args(argv)
+    if args.command == 'convert':
+        count = convert_to_json_array(args.src, args.dst)
+        print(f"Converted {count} records to {args.dst}")
+
+if __name__ == "__main__":
+    main()
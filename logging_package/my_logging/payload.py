@@ -0,0 +1,148 @@
+import json
+import logging
+import reprlib
+import threading
+import time
+
+# Bounded repr: never walks more than a few items per container, however big
+_sample_repr = reprlib.Repr()
+_sample_repr.maxlevel = 3
+_sample_repr.maxdict = 4
+_sample_repr.maxlist = 3
+_sample_repr.maxtuple = 3
+_sample_repr.maxset = 3
+_sample_repr.maxstring = 60
+_sample_repr.maxother = 60
+
+class PayloadSummary:
+    """Log argument that describes a payload instead of printing it.
+
+    Nothing is computed until the record is actually formatted, so passing
+    `summarize_payload(data)` as an argument to a disabled level costs one
+    object allocation:
+
+        logger.debug("Received payload: %s", summarize_payload(data))
+
+    The summary gives the type and size, the total number of items under
+    each nested list key (e.g. devices=2, snapshots=10) and a bounded sample.
+    A string holding a JSON object or array (e.g. a request body that is
+    itself JSON-encoded) is decoded first, again only when formatted.
+    """
+
+    __slots__ = ('payload', 'max_sample', 'max_depth', '_text')
+
+    def __init__(self, payload, max_sample=200, max_depth=6):
+        self.payload = payload
+        self.max_sample = max_sample
+        self.max_depth = max_depth
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self._summarize()
+        return self._text
+
+    __repr__ = __str__
+
+    def _summarize(self):
+        payload = self.payload
+        parts = [type(payload).__name__]
+        decoded = self._decode_json(payload)
+        if decoded is not None:
+            parts.append(f"len={len(payload)} decoded to")
+            payload = decoded
+            parts.append(type(payload).__name__)
+        if isinstance(payload, (dict, list, tuple, set)):
+            parts.append(f"len={len(payload)}")
+            counts = self._count_by_key(payload)
+            if counts:
+                parts.append(", ".join(f"{key}={count}" for key, count in counts.items()))
+        elif isinstance(payload, (str, bytes)):
+            parts.append(f"len={len(payload)}")
+        parts.append(f"sample={self._sample(payload)}")
+        return " ".join(parts)
+
+    @staticmethod
+    def _decode_json(payload):
+        if not isinstance(payload, (str, bytes)) or payload.lstrip()[:1] not in ('{', '[', b'{', b'['):
+            return None
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def _count_by_key(self, payload):
+        """Total number of items under each nested list key, e.g. devices=2 snapshots=10"""
+        counts = {}
+        stack = [(payload, 0)]
+        visited = 0
+        while stack and visited < 100000:
+            node, depth = stack.pop()
+            visited += 1
+            if depth >= self.max_depth:
+                continue
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    if isinstance(value, (list, tuple)):
+                        counts[key] = counts.get(key, 0) + len(value)
+                    if isinstance(value, (dict, list, tuple)):
+                        stack.append((value, depth + 1))
+            elif isinstance(node, (list, tuple)):
+                for value in node:
+                    if isinstance(value, (dict, list, tuple)):
+                        stack.append((value, depth + 1))
+        return counts
+
+    def _sample(self, payload):
+        text = _sample_repr.repr(payload)
+        if len(text) > self.max_sample:
+            text = text[:self.max_sample] + f"...<{len(text) - self.max_sample} more chars>"
+        return text
+
+def summarize_payload(payload, max_sample=200, max_depth=6):
+    return PayloadSummary(payload, max_sample, max_depth)
+
+class RateLimitFilter(logging.Filter):
+    """Per-call-site rate limit with sampling for chatty log statements.
+
+    Each call site (logger name, file and line) may emit `rate` records per
+    `per` seconds; past that only every `sample_every`-th record gets
+    through (0 drops them all) until the window resets. The next record let
+    through says how many were suppressed. Records at `exempt_level` or
+    above are never limited.
+    """
+
+    def __init__(self, rate=10, per=60.0, sample_every=0, exempt_level=logging.WARNING, name=''):
+        super().__init__(name)
+        self.rate = rate
+        self.per = per
+        self.sample_every = sample_every
+        self.exempt_level = logging._checkLevel(exempt_level)
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.exempt_level:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.per:
+                # Carry the suppressed count over so it is still reported
+                site = [now, 0, site[2] if site else 0]
+                self._sites[key] = site
+            site[1] += 1
+            seen = site[1]
+            allowed = seen <= self.rate or (
+                self.sample_every and (seen - self.rate) % self.sample_every == 0
+            )
+            if not allowed:
+                site[2] += 1
+                return False
+            suppressed, site[2] = site[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+            if isinstance(record.msg, str):
+                record.msg = f"{record.msg} [{suppressed} similar records suppressed]"
+        return True
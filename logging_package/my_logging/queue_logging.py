@@ -0,0 +1,185 @@
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import copy
+import itertools
+import logging
+import math
+import os
+import queue
+import threading
+
+class DropDebugFirstQueue:
+    """Bounded queue between request threads and the logging listener.
+
+    `put_nowait` never blocks. When the queue is full the oldest queued record
+    of the lowest level below the incoming one is evicted, so DEBUG records
+    go first, then INFO and so on; if nothing queued is less important than
+    the incoming record, the incoming record is dropped instead.
+
+    Records are kept in one deque per level and numbered as they arrive, so
+    both evicting and `get` (which takes the lowest number among the heads
+    of the deques) cost O(number of levels), not O(queue length).
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._reset_after_fork()
+        self.enqueued = 0
+        self.dropped = {}
+        self.high_water = 0
+
+    def _reset_after_fork(self):
+        # A lock held by another thread at fork time would never be released
+        self._by_level = {}
+        self._size = 0
+        self._sequence = itertools.count()
+        self._not_empty = threading.Condition(threading.Lock())
+
+    def put_nowait(self, record):
+        with self._not_empty:
+            # None is the listener's stop sentinel: never dropped, and
+            # queued above every level so it is never evicted either
+            level = record.levelno if record is not None else math.inf
+            if record is not None and self._size >= self.maxsize:
+                if not self._evict_below(level):
+                    self._count_drop(record)
+                    return
+            items = self._by_level.get(level)
+            if items is None:
+                items = self._by_level[level] = deque()
+            items.append((next(self._sequence), record))
+            self._size += 1
+            if record is not None:
+                self.enqueued += 1
+            self.high_water = max(self.high_water, self._size)
+            self._not_empty.notify()
+
+    put = put_nowait
+
+    def _evict_below(self, levelno):
+        queued_levels = [level for level, items in self._by_level.items() if items and level < levelno]
+        if not queued_levels:
+            return False
+        _, victim = self._by_level[min(queued_levels)].popleft()
+        self._size -= 1
+        self._count_drop(victim)
+        return True
+
+    def _count_drop(self, record):
+        self.dropped[record.levelname] = self.dropped.get(record.levelname, 0) + 1
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                if not self._size:
+                    raise queue.Empty()
+            elif not self._not_empty.wait_for(lambda: self._size, timeout):
+                raise queue.Empty()
+            # The oldest record is at the head of one of the deques
+            oldest = min((items for items in self._by_level.values() if items), key=lambda items: items[0][0])
+            _, record = oldest.popleft()
+            self._size -= 1
+            return record
+
+    def qsize(self):
+        return self._size
+
+    def stats(self):
+        with self._not_empty:
+            return {
+                'queued': self._size,
+                'enqueued': self.enqueued,
+                'dropped': dict(self.dropped),
+                'dropped_total': sum(self.dropped.values()),
+                'high_water': self.high_water,
+                'maxsize': self.maxsize,
+            }
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread.
+
+    The stock QueueHandler formats each record in the calling thread, which
+    is exactly the cost we want off the request path. Arguments are passed
+    through as-is, so code logging through this handler must not mutate
+    objects after passing them as log arguments.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if record.exc_info:
+            # Tracebacks hold frames that can change once the caller moves on
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class QueueLogging:
+    """A running queue-based pipeline: the handler, its queue and the listener"""
+
+    def __init__(self, handlers, maxsize=10000):
+        self.queue = DropDebugFirstQueue(maxsize)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def restart_after_fork(self):
+        # The listener thread does not survive a fork, start a fresh one
+        self.queue._reset_after_fork()
+        self.listener._thread = None
+        self.listener.start()
+
+    def stats(self):
+        return self.queue.stats()
+
+_active = None
+
+def enable_queue_logging(maxsize=10000, logger=None):
+    """Move the handlers of `logger` (default: root) behind a queue and listener thread"""
+    global _active
+    logger = logger or logging.getLogger()
+    disable_queue_logging(logger)
+
+    pipeline = QueueLogging(logger.handlers[:], maxsize)
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(pipeline.handler)
+    pipeline.start()
+    _active = pipeline
+    return pipeline
+
+def disable_queue_logging(logger=None):
+    """Drain the queue and put the original handlers back"""
+    global _active
+    if _active is None:
+        return
+    logger = logger or logging.getLogger()
+    _active.stop()
+    logger.removeHandler(_active.handler)
+    for handler in _active.listener.handlers:
+        logger.addHandler(handler)
+    _active = None
+
+def get_queue_stats():
+    """Counters of the active pipeline, or None when queue logging is off"""
+    return _active.stats() if _active is not None else None
+
+def _stop_at_exit():
+    # Registered after logging's own shutdown hook, so it runs first and the
+    # queue is drained while the file handlers are still open
+    if _active is not None:
+        _active.stop()
+
+atexit.register(_stop_at_exit)
+
+def _after_fork_in_child():
+    if _active is not None:
+        _active.restart_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,166 @@
+from datetime import date, timedelta
+from my_logging.ndjson_file_handler import NdjsonFileHandler
+import gzip
+import os
+import queue
+import re
+import shutil
+import threading
+
+# Daily log files, rotated files and their compressed copies, e.g.
+# 2025-01-01.json, 2025-01-01.ndjson, 2025-01-01.3.ndjson, 2025-01-01.3.ndjson.gz,
+# and the same with a .pid<n> part for forked worker processes
+LOG_FILE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}(\.pid\d+)?(\.\d+)?\.(nd)?json(\.gz)?$')
+ROTATED_FILE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}(\.pid\d+)?\.\d+\.ndjson$')
+ACTIVE_FILE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})(\.pid\d+)?\.ndjson$')
+
+class RotatingNdjsonFileHandler(NdjsonFileHandler):
+    """NDJSON handler that rolls over at midnight and at a size cap.
+
+    The active file is `<directory>/<YYYY-MM-DD>.ndjson`. On rollover it is
+    renamed to `<YYYY-MM-DD>.<n>.ndjson` and gzip-compressed by a background
+    thread, after which only the newest `backup_count` log files in the
+    directory are kept. The checks run when the buffer is flushed, not per
+    record.
+
+    A process forked after the handler was created (e.g. a gunicorn
+    --preload worker) switches to its own `<YYYY-MM-DD>.pid<pid>.ndjson`.
+    This means no two processes ever rename or append to the same file.
+    Retention is shared, and it never removes another process's active file
+    from today or yesterday.
+    """
+
+    def __init__(self, filename, mode='a', encoding='utf-8', delay=False,
+                 max_bytes=50 * 1024 * 1024, backup_count=30, compress=True, **kwargs):
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.current_date = date.today()
+        self.current_size = 0
+        self.process_suffix = ''
+        self._start_compressor()
+        super().__init__(self._path_for(self.current_date), mode, encoding, delay, **kwargs)
+        self.current_size = self._existing_size()
+
+        # Pick up files rotated by a process that exited before compressing them
+        for name in sorted(os.listdir(self.directory)):
+            if ROTATED_FILE_PATTERN.match(name):
+                self._pending.put(os.path.join(self.directory, name))
+        self._pending.put(None)
+
+    def _start_compressor(self):
+        self._pending = queue.Queue()
+        self._compressor_pid = os.getpid()
+        self._compressor = threading.Thread(target=self._compress_rotated, name="log-compressor", daemon=True)
+        self._compressor.start()
+
+    def _after_fork_in_child(self):
+        # Called with the handler lock freshly reinitialized by logging. The
+        # inherited queue belongs to the parent's compressor, which carries on
+        super()._after_fork_in_child()
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self.process_suffix = f'.pid{os.getpid()}'
+        self.baseFilename = self._path_for(self.current_date)
+        self.current_size = self._existing_size()
+        self._start_compressor()
+
+    def _path_for(self, day):
+        return os.path.join(self.directory, f'{day.isoformat()}{self.process_suffix}.ndjson')
+
+    def _existing_size(self):
+        try:
+            return os.path.getsize(self.baseFilename)
+        except OSError:
+            return 0
+
+    def should_rollover(self, data):
+        if date.today() != self.current_date:
+            return True
+        return bool(self.max_bytes) and self.current_size > 0 \
+            and self.current_size + len(data) > self.max_bytes
+
+    def write_buffer(self, data):
+        if self.should_rollover(data):
+            self.do_rollover()
+        super().write_buffer(data)
+        self.current_size += len(data)
+
+    def _next_rotated_path(self):
+        prefix = f'{self.current_date.isoformat()}{self.process_suffix}.'
+        taken = set()
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix):
+                index = name[len(prefix):].split('.', 1)[0]
+                if index.isdigit():
+                    taken.add(int(index))
+        index = max(taken, default=0) + 1
+        return os.path.join(self.directory, f'{self.current_date.isoformat()}{self.process_suffix}.{index}.ndjson')
+
+    def do_rollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            rotated = self._next_rotated_path()
+            os.replace(self.baseFilename, rotated)
+            self._pending.put(rotated)
+        self.current_date = date.today()
+        self.baseFilename = self._path_for(self.current_date)
+        self.current_size = self._existing_size()
+        self._pending.put(None)
+
+    def _compress_rotated(self):
+        # None in the queue means "enforce retention now"
+        while True:
+            path = self._pending.get()
+            try:
+                if path is None:
+                    self.enforce_retention()
+                elif self.compress and os.path.exists(path):
+                    # Another process picking up the same leftover file at
+                    # startup must not see a half-written .gz
+                    temp_path = f'{path}.gz.{os.getpid()}.tmp'
+                    with open(path, 'rb') as src, gzip.open(temp_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.replace(temp_path, path + '.gz')
+                    os.remove(path)
+            except Exception:
+                # A failed compression leaves the plain file, which is still readable
+                pass
+            finally:
+                self._pending.task_done()
+
+    def enforce_retention(self):
+        if self.backup_count is None:
+            return
+        # Files other processes may still be writing to
+        recent = {self.current_date.isoformat(), (self.current_date - timedelta(days=1)).isoformat()}
+        log_files = []
+        for name in os.listdir(self.directory):
+            active = ACTIVE_FILE_PATTERN.match(name)
+            if LOG_FILE_PATTERN.match(name) and not (active and active.group(1) in recent):
+                log_files.append(os.path.join(self.directory, name))
+        log_files.sort(key=self._mtime, reverse=True)
+        for path in log_files[self.backup_count:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            # Removed by another process meanwhile
+            return 0
+
+    def close(self):
+        super().close()
+        # Let outstanding compressions finish so no plain rotated files are
+        # left, unless this process has no compressor to finish them
+        if self._compressor_pid == os.getpid() and self._compressor.is_alive():
+            self._pending.join()
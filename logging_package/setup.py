@@ -2,7 +2,7 @@ from setuptools import setup, find_packages
 
 setup(
     name='my_logging',
-    version='0.1.0',
+    version='0.2.0',
     packages=find_packages(),
     install_requires=[
         'python-json-logger',
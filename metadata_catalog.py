@@ -0,0 +1,229 @@
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy import func, select
+from models import Aggregator, Device, DeviceMetricType
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Metric type names are written by the aggregators as "<category> (<symbol>)",
+# e.g. "Stock Price (AAPL)". Anything else is its own category with no symbol.
+METRIC_NAME_PATTERN = re.compile(r'^(?P<category>.+?) \((?P<symbol>.*?)\)$')
+
+STOCK_PRICE_CATEGORY = 'Stock Price'
+
+
+def parse_metric_name(name):
+    """Split a metric type name into its (category, symbol) parts"""
+    match = METRIC_NAME_PATTERN.match(name)
+    if match:
+        return match.group('category'), match.group('symbol')
+    return name, None
+
+
+@dataclass(frozen=True)
+class AggregatorEntry:
+    aggregator_id: int
+    guid: str
+    name: str
+
+
+@dataclass(frozen=True)
+class DeviceEntry:
+    device_id: int
+    aggregator_id: int
+    name: str
+
+
+@dataclass(frozen=True)
+class MetricTypeEntry:
+    device_metric_type_id: int
+    device_id: int
+    aggregator_id: int
+    name: str
+    category: str
+    symbol: Optional[str]
+
+
+class MetadataCatalog:
+    """In-memory copy of the aggregator/device/metric type tables.
+
+    These tables are tiny and almost never change compared to snapshots and
+    metrics, so they are loaded once and then kept up to date by the ingest
+    path. `version` is bumped whenever the catalog changes so callers can
+    cheaply tell whether anything derived from it needs rebuilding.
+    """
+
+    def __init__(self, max_staleness=5.0):
+        self._lock = threading.RLock()
+        self.max_staleness = max_staleness
+        self.version = 0
+        self._reset()
+
+    def _reset(self):
+        self.aggregators = {}
+        self.devices = {}
+        self.metric_types = {}
+        self._aggregator_ids_by_guid = {}
+        self._device_ids_by_key = {}
+        self._metric_type_ids_by_key = {}
+        self._metric_type_ids_by_name = {}
+        self._metric_type_ids_by_category = {}
+        self._max_ids = (0, 0, 0)
+        self._last_sync = 0.0
+        self.loaded = False
+
+    def reset(self):
+        """Forget everything, e.g. after the database has been cleared"""
+        with self._lock:
+            self._reset()
+            self.version += 1
+
+    def sync(self, session, force=False):
+        """Pick up rows created since the last sync (possibly by another process).
+
+        Only the three primary key maxima are queried unless something changed,
+        and that check itself is skipped if the catalog was synced recently.
+        """
+        now = time.monotonic()
+        if not force and self.loaded and now - self._last_sync < self.max_staleness:
+            return self.version
+
+        max_ids = tuple(session.execute(select(
+            select(func.max(Aggregator.aggregator_id)).scalar_subquery(),
+            select(func.max(Device.device_id)).scalar_subquery(),
+            select(func.max(DeviceMetricType.device_metric_type_id)).scalar_subquery(),
+        )).one())
+        max_ids = tuple(value or 0 for value in max_ids)
+
+        with self._lock:
+            self._last_sync = now
+            if self.loaded and max_ids == self._max_ids:
+                return self.version
+
+            if any(new < old for new, old in zip(max_ids, self._max_ids)):
+                # Rows were deleted underneath us, start over
+                logger.info("Metadata catalog out of date, reloading")
+                self._reset()
+                self._last_sync = now
+
+            last_aggregator_id, last_device_id, last_metric_type_id = self._max_ids
+            for row in session.query(Aggregator.aggregator_id, Aggregator.guid, Aggregator.name)\
+                    .filter(Aggregator.aggregator_id > last_aggregator_id):
+                self._add_aggregator(*row)
+            for row in session.query(Device.device_id, Device.aggregator_id, Device.name)\
+                    .filter(Device.device_id > last_device_id):
+                self._add_device(*row)
+            for row in session.query(DeviceMetricType.device_metric_type_id, DeviceMetricType.device_id, DeviceMetricType.name)\
+                    .filter(DeviceMetricType.device_metric_type_id > last_metric_type_id):
+                self._add_metric_type(*row)
+
+            self._max_ids = tuple(max(new, old) for new, old in zip(max_ids, self._max_ids))
+            self.loaded = True
+            self.version += 1
+            logger.debug(f"Metadata catalog synced to version {self.version}: "
+                         f"{len(self.aggregators)} aggregators, {len(self.devices)} devices, "
+                         f"{len(self.metric_types)} metric types")
+            return self.version
+
+    def _add_aggregator(self, aggregator_id, guid, name):
+        entry = AggregatorEntry(aggregator_id, str(guid), name)
+        self.aggregators[aggregator_id] = entry
+        self._aggregator_ids_by_guid[entry.guid] = aggregator_id
+        return entry
+
+    def _add_device(self, device_id, aggregator_id, name):
+        entry = DeviceEntry(device_id, aggregator_id, name)
+        self.devices[device_id] = entry
+        self._device_ids_by_key[(aggregator_id, name)] = device_id
+        return entry
+
+    def _add_metric_type(self, device_metric_type_id, device_id, name):
+        if device_metric_type_id in self.metric_types:
+            return self.metric_types[device_metric_type_id]
+        device = self.devices.get(device_id)
+        category, symbol = parse_metric_name(name)
+        entry = MetricTypeEntry(
+            device_metric_type_id,
+            device_id,
+            device.aggregator_id if device else None,
+            name,
+            category,
+            symbol
+        )
+        self.metric_types[device_metric_type_id] = entry
+        self._metric_type_ids_by_key[(device_id, name)] = device_metric_type_id
+        self._metric_type_ids_by_name.setdefault(name, []).append(device_metric_type_id)
+        self._metric_type_ids_by_category.setdefault(category, []).append(device_metric_type_id)
+        return entry
+
+    def register(self, aggregators=(), devices=(), metric_types=()):
+        """Record entities the ingest path has just committed.
+
+        Each argument is a list of (id, parent id or guid, name) tuples in
+        the same order as the table columns.
+        """
+        if not (aggregators or devices or metric_types):
+            return self.version
+        with self._lock:
+            for aggregator in aggregators:
+                self._add_aggregator(*aggregator)
+            for device in devices:
+                self._add_device(*device)
+            for metric_type in metric_types:
+                self._add_metric_type(*metric_type)
+            # The high-water marks are left alone: another process may have
+            # created rows below these ids, and the next sync re-reads ours
+            # harmlessly.
+            self.version += 1
+            return self.version
+
+    # Lookups used by the ingest path
+
+    def get_aggregator_id(self, guid):
+        return self._aggregator_ids_by_guid.get(str(guid))
+
+    def get_device_id(self, aggregator_id, name):
+        return self._device_ids_by_key.get((aggregator_id, name))
+
+    def get_metric_type_id(self, device_id, name):
+        return self._metric_type_ids_by_key.get((device_id, name))
+
+    # Lookups used by the dashboard and queries
+
+    def aggregator_list(self):
+        return [self.aggregators[key] for key in sorted(self.aggregators)]
+
+    def metric_type_ids(self, name, aggregator_id=None):
+        ids = self._metric_type_ids_by_name.get(name, [])
+        if aggregator_id is None:
+            return list(ids)
+        return [
+            metric_type_id for metric_type_id in ids
+            if self.metric_types[metric_type_id].aggregator_id == aggregator_id
+        ]
+
+    def metric_type_ids_for_category(self, category):
+        return list(self._metric_type_ids_by_category.get(category, []))
+
+    def symbols(self, category):
+        """Distinct symbols seen for a category, in the order they first appeared"""
+        seen = {}
+        for metric_type_id in self._metric_type_ids_by_category.get(category, []):
+            symbol = self.metric_types[metric_type_id].symbol
+            if symbol is not None:
+                seen.setdefault(symbol, None)
+        return list(seen)
+
+    def aggregator_name(self, device_metric_type_id):
+        metric_type = self.metric_types.get(device_metric_type_id)
+        if metric_type is None:
+            return None
+        aggregator = self.aggregators.get(metric_type.aggregator_id)
+        return aggregator.name if aggregator else None
+
+
+catalog = MetadataCatalog()
@@ -0,0 +1,408 @@
+"""Offline backfill of metrics from files, used by `flask import-metrics`.
+
+Three input formats are understood:
+
+  json    the POST /api/aggregator body, or a list of them
+  ndjson  one such aggregator object per line
+  csv     one metric per row, with the columns in CSV_COLUMNS; consecutive
+          rows with the same guid, device and timestamp form a snapshot
+
+Records (snapshots for json, lines for ndjson, rows for csv) are parsed and
+validated in a process pool, in chunks, and the results are written in file
+order by a single writer through aggregator_mapping.bulk_insert_snapshots.
+After every committed batch the offset is saved next to the input, so an
+interrupted import can be resumed with --resume.
+
+A json document is streamed with ijson if it is installed. The JSON
+decoding itself then still happens in the main process, and only the
+validation runs in the pool. Without ijson the whole document is loaded
+into memory first. Either way, resuming reads the document again from the
+start up to the saved offset. ndjson has none of these costs and is the
+better format for large backfills.
+"""
+from aggregator_mapping import bulk_insert_snapshots
+from sharding import shard_router
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import csv
+import itertools
+import json
+import logging
+import math
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('json', 'ndjson', 'csv')
+CSV_COLUMNS = ('guid', 'aggregator_name', 'device_name', 'timestamp_capture', 'timezone_mins', 'metric_name', 'value')
+# Invalid records are counted, only the first few are reported individually
+MAX_REPORTED_ERRORS = 20
+
+def detect_format(path):
+    extension = os.path.splitext(path[:-3] if path.endswith('.gz') else path)[1].lstrip('.').lower()
+    if extension in ('jsonl', 'ndjson'):
+        return 'ndjson'
+    if extension in FORMATS:
+        return extension
+    raise ValueError(f"Can't tell the format of {path}, pass --format")
+
+def state_path_for(path):
+    return path + '.import-state'
+
+def load_state(path):
+    try:
+        with open(state_path_for(path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_state(path, state):
+    # Written to a temporary file first so a crash never leaves half a state
+    temp_path = state_path_for(path) + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path_for(path))
+
+# Parsing and validation, run in the worker processes
+
+def parse_timestamp(value):
+    if isinstance(value, bool):
+        raise ValueError(f"invalid timestamp {value!r}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip()
+    try:
+        return int(float(text))
+    except ValueError:
+        return int(datetime.fromisoformat(text).timestamp())
+
+def parse_value(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"metric value {value} is not finite")
+    return value
+
+def require_text(value, field):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{field} must be a non-empty string")
+    return value
+
+def parse_snapshot(guid, aggregator_name, device_name, snapshot):
+    if not isinstance(snapshot, dict):
+        raise ValueError("snapshot must be an object")
+    metrics = snapshot.get('metrics') or []
+    return (
+        guid,
+        aggregator_name,
+        device_name,
+        parse_timestamp(snapshot['timestamp_capture']),
+        int(snapshot.get('timezone_mins', 0)),
+        [(require_text(metric['name'], 'metric name'), parse_value(metric['value'])) for metric in metrics],
+    )
+
+def parse_aggregator(aggregator):
+    """All snapshots of one aggregator object, in order"""
+    if not isinstance(aggregator, dict):
+        raise ValueError("aggregator must be an object")
+    guid = require_text(str(aggregator['guid']), 'guid')
+    name = require_text(aggregator['name'], 'aggregator name')
+    snapshots = []
+    for device in aggregator.get('devices') or []:
+        device_name = require_text(device['name'], 'device name')
+        for snapshot in device.get('snapshots') or []:
+            snapshots.append(parse_snapshot(guid, name, device_name, snapshot))
+    return snapshots
+
+def parse_chunk(file_format, first_offset, records):
+    """Parse one chunk of raw records; returns (snapshots, errors).
+
+    `records` are JSON lines for ndjson, CSV rows (lists) for csv and
+    (guid, aggregator name, device name, snapshot dict) tuples for json.
+    Each error is an (offset, message) pair.
+    """
+    snapshots = []
+    errors = []
+    for offset, record in enumerate(records, start=first_offset):
+        try:
+            if file_format == 'ndjson':
+                snapshots.extend(parse_aggregator(json.loads(record)))
+            elif file_format == 'csv':
+                if len(record) != len(CSV_COLUMNS):
+                    raise ValueError(f"expected {len(CSV_COLUMNS)} columns, got {len(record)}")
+                row = dict(zip(CSV_COLUMNS, record))
+                snapshot = parse_snapshot(
+                    require_text(row['guid'], 'guid'),
+                    require_text(row['aggregator_name'], 'aggregator name'),
+                    require_text(row['device_name'], 'device name'),
+                    {'timestamp_capture': row['timestamp_capture'], 'timezone_mins': row['timezone_mins'] or 0,
+                     'metrics': [{'name': row['metric_name'], 'value': row['value']}]}
+                )
+                # Consecutive rows of the same snapshot are merged
+                previous = snapshots[-1] if snapshots else None
+                if previous and previous[:5] == snapshot[:5]:
+                    previous[5].extend(snapshot[5])
+                else:
+                    snapshots.append(snapshot)
+            else:
+                guid, aggregator_name, device_name, snapshot = record
+                snapshots.append(parse_snapshot(
+                    require_text(guid, 'guid'),
+                    require_text(aggregator_name, 'aggregator name'),
+                    require_text(device_name, 'device name'),
+                    snapshot
+                ))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append((offset, f"{type(e).__name__}: {e}"))
+    return snapshots, errors
+
+# Reading, in the main process
+
+def open_text(path):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+def open_binary(path):
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def iter_json_snapshots(f):
+    """(guid, aggregator name, device name, snapshot) of a JSON document, streamed.
+
+    The names may come after the snapshots in their objects. Snapshots
+    are held back until their names are known, so only a single aggregator
+    is ever kept in memory.
+    """
+    import ijson
+    events = ijson.parse(f, use_float=True)
+    first = next(events, None)
+    if first is None:
+        return
+    # A single aggregator object, or a list of them
+    base = 'item' if first[1] == 'start_array' else ''
+
+    def under(suffix):
+        return f'{base}.{suffix}' if base else suffix
+
+    snapshot_prefix = under('devices.item.snapshots.item')
+    device_prefix = under('devices.item')
+    aggregator = {}
+    device = {}
+    pending = []
+    builder = None
+    depth = 0
+
+    def ready():
+        return 'guid' in aggregator and 'name' in aggregator and 'name' in device
+
+    def release():
+        for record_aggregator, record_device, snapshot in pending:
+            yield (record_aggregator.get('guid'), record_aggregator.get('name'), record_device.get('name'), snapshot)
+        pending.clear()
+
+    for prefix, event, value in itertools.chain([first], events):
+        if builder is not None:
+            builder.event(event, value)
+            depth += event in ('start_map', 'start_array')
+            depth -= event in ('end_map', 'end_array')
+            if depth == 0:
+                pending.append((aggregator, device, builder.value))
+                builder = None
+                if ready():
+                    yield from release()
+        elif prefix == snapshot_prefix:
+            if event in ('start_map', 'start_array'):
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+                depth = 1
+            else:
+                # Not an object, left for parse_snapshot to reject
+                pending.append((aggregator, device, value))
+                if ready():
+                    yield from release()
+        elif prefix == under('guid'):
+            aggregator['guid'] = value
+        elif prefix == under('name'):
+            aggregator['name'] = value
+        elif prefix == f'{device_prefix}.name':
+            device['name'] = value
+        elif prefix == device_prefix and event == 'start_map':
+            device = {}
+        elif prefix == device_prefix and event == 'end_map' and 'guid' in aggregator and 'name' in aggregator:
+            yield from release()
+        elif prefix == base and event == 'end_map':
+            yield from release()
+            aggregator = {}
+
+def iter_records(path, file_format):
+    """Raw records of the file in order, before any parsing"""
+    if file_format == 'json':
+        # Bytes for ijson's C backend; json.load takes them too
+        with open_binary(path) as f:
+            try:
+                yield from iter_json_snapshots(f)
+                return
+            except ImportError:
+                logger.warning(f"ijson is not installed, loading all of {path} into memory")
+            document = json.load(f)
+            for aggregator in document if isinstance(document, list) else [document]:
+                for device in aggregator.get('devices') or []:
+                    for snapshot in device.get('snapshots') or []:
+                        yield (aggregator.get('guid'), aggregator.get('name'), device.get('name'), snapshot)
+        return
+    with open_text(path) as f:
+        if file_format == 'ndjson':
+            for line in f:
+                if line.strip():
+                    yield line
+        else:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header and header != list(CSV_COLUMNS):
+                # Not a header row after all
+                yield header
+            yield from reader
+
+def same_csv_snapshot(row, next_row):
+    # guid, aggregator, device, timestamp and timezone, as in parse_chunk
+    return row[:5] == next_row[:5]
+
+def chunked(records, size, same_group=None):
+    """Lists of `size` records, extended while `same_group(last, next)` holds"""
+    iterator = iter(records)
+    carry = []
+    while True:
+        chunk = carry + list(itertools.islice(iterator, size - len(carry)))
+        carry = []
+        if not chunk:
+            return
+        if same_group is not None:
+            for record in iterator:
+                if not same_group(chunk[-1], record):
+                    carry = [record]
+                    break
+                chunk.append(record)
+        yield chunk
+
+class MetricImporter:
+    """Feeds chunks to the pool and writes the parsed results in order.
+
+    At most `workers * 2` chunks are in flight, so memory stays bounded
+    however big the file is. Parsing scales with the number of workers
+    until the single writer becomes the bottleneck.
+    """
+
+    def __init__(self, session, path, file_format=None, workers=None, chunk_size=2000,
+                 batch_size=20000, progress=print):
+        self.session = session
+        self.path = path
+        self.file_format = file_format or detect_format(path)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.progress = progress
+        self.state = {'offset': 0, 'snapshots': 0, 'metrics': 0, 'invalid': 0}
+
+    def resume(self, offset=None):
+        """Continue from `offset`, or from the saved state if not given"""
+        saved = load_state(self.path)
+        if offset is None:
+            if saved:
+                self.state = saved
+        else:
+            self.state['offset'] = offset
+        return self.state['offset']
+
+    def write(self, batch):
+        if not shard_router.enabled:
+            return bulk_insert_snapshots(batch, self.session)
+        # One transaction per shard: if the import stops between two of
+        # them, resuming writes the shards already committed a second time
+        by_shard = {}
+        for snapshot in batch:
+            by_shard.setdefault(shard_router.shard_for(snapshot[0]), []).append(snapshot)
+        snapshot_count = metric_count = 0
+        for shard, snapshots in sorted(by_shard.items(), key=lambda item: item[0].index):
+            session = shard.session()
+            try:
+                snapshots_written, metrics_written = bulk_insert_snapshots(snapshots, session)
+            finally:
+                session.close()
+            snapshot_count += snapshots_written
+            metric_count += metrics_written
+        return snapshot_count, metric_count
+
+    def run(self):
+        start_offset = self.state['offset']
+        records = itertools.islice(iter_records(self.path, self.file_format), start_offset, None)
+        started = time.perf_counter()
+        imported_snapshots = 0
+        imported_metrics = 0
+        batch = []
+        batch_metrics = 0
+        batch_end = start_offset
+        reported_errors = 0
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = deque()
+            # CSV rows are merged into snapshots within a chunk, so chunks
+            # only end where a snapshot does
+            chunks = chunked(records, self.chunk_size,
+                             same_csv_snapshot if self.file_format == 'csv' else None)
+            offset = start_offset
+
+            def submit_next():
+                nonlocal offset
+                chunk = next(chunks, None)
+                if chunk is None:
+                    return False
+                in_flight.append((offset + len(chunk), pool.submit(parse_chunk, self.file_format, offset, chunk)))
+                offset += len(chunk)
+                return True
+
+            while len(in_flight) < self.workers * 2 and submit_next():
+                pass
+
+            while in_flight:
+                chunk_end, future = in_flight.popleft()
+                snapshots, errors = future.result()
+                submit_next()
+
+                for error_offset, message in errors:
+                    if reported_errors < MAX_REPORTED_ERRORS:
+                        logger.warning(f"Skipping invalid record {error_offset} in {self.path}: {message}")
+                        reported_errors += 1
+                self.state['invalid'] += len(errors)
+                batch.extend(snapshots)
+                batch_metrics += sum(len(snapshot[5]) for snapshot in snapshots)
+                batch_end = chunk_end
+
+                if batch_metrics >= self.batch_size or not in_flight:
+                    snapshot_count, metric_count = self.write(batch)
+                    batch = []
+                    batch_metrics = 0
+                    imported_snapshots += snapshot_count
+                    imported_metrics += metric_count
+                    self.state['offset'] = batch_end
+                    self.state['snapshots'] += snapshot_count
+                    self.state['metrics'] += metric_count
+                    save_state(self.path, self.state)
+                    elapsed = time.perf_counter() - started
+                    self.progress(
+                        f"offset {batch_end}: {self.state['snapshots']} snapshots, "
+                        f"{self.state['metrics']} metrics, {self.state['invalid']} invalid "
+                        f"({imported_metrics / elapsed if elapsed else 0:.0f} metrics/s)"
+                    )
+
+        return {
+            'offset': self.state['offset'],
+            'snapshots': imported_snapshots,
+            'metrics': imported_metrics,
+            'invalid': self.state['invalid'],
+            'seconds': time.perf_counter() - started,
+        }
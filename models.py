@@ -1,6 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from sqlalchemy import Column, Float, ForeignKey, Integer, Table, Text
+from sqlalchemy import Column, Float, ForeignKey, Integer, Table, Text, event
 from sqlalchemy.sql.sqltypes import NullType
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
@@ -8,6 +8,30 @@ import uuid
 
 db = SQLAlchemy()
 
+# Bump whenever the tables below change so existing databases get upgraded
+# on the next startup (see ensure_schema in app.py)
+SCHEMA_VERSION = 5
+
+def sqlite_pragmas(database_config):
+    """PRAGMAs for every SQLite connection, from the "database" config section.
+
+    WAL lets the dashboard read while an ingest writes, and concurrent
+    ingests wait up to the busy timeout for the write lock instead of
+    failing straight away with "database is locked". WAL makes commits
+    across attached databases atomic per file only; for sharded storage see
+    commit_metadata_first in aggregator_mapping.py.
+    """
+    return {
+        'journal_mode': database_config.get('journal_mode', 'wal'),
+        'busy_timeout': int(database_config.get('busy_timeout_ms', 30000)),
+    }
+
+def set_sqlite_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def run_pragmas(dbapi_connection, connection_record):
+        for name, value in pragmas.items():
+            dbapi_connection.execute(f"PRAGMA {name} = {value}")
+
 class Aggregator(db.Model):
     __tablename__ = 'aggregators'
     aggregator_id = db.Column(db.Integer, primary_key=True)
@@ -29,6 +53,12 @@ class Device(db.Model):
     snapshots = db.relationship('Snapshot', back_populates='device')
     metric_types = db.relationship('DeviceMetricType', back_populates='device')
 
+    # Concurrent ingests of a new device resolve to the same row, see
+    # aggregator_mapping.insert_or_ignore
+    __table_args__ = (
+        db.Index('uq_devices_aggregator_name', 'aggregator_id', 'name', unique=True),
+    )
+
     def __repr__(self):
         return f'<Device {self.name}>'
 
@@ -56,6 +86,10 @@ class DeviceMetricType(db.Model):
     device = db.relationship('Device', back_populates='metric_types')
     metrics = db.relationship('Metric', back_populates='device_metric_type')
 
+    __table_args__ = (
+        db.Index('uq_device_metric_types_device_name', 'device_id', 'name', unique=True),
+    )
+
     def __repr__(self):
         return f'<DeviceMetricType {self.name}>'
 
@@ -70,4 +104,57 @@ class Metric(db.Model):
     device_metric_type = db.relationship('DeviceMetricType', back_populates='metrics')
     
     def __repr__(self):
-        return f'<Metric {self.device_metric_type.name}:{self.value}>'
\ No newline at end of file
+        return f'<Metric {self.device_metric_type.name}:{self.value}>'
+
+class StockSymbol(db.Model):
+    __tablename__ = 'stock_symbols'
+    stock_symbol_id = db.Column(db.Integer, primary_key=True)
+    symbol = db.Column(db.Text, unique=True, nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<StockSymbol {self.symbol}>'
+
+class RegistryVersion(db.Model):
+    __tablename__ = 'registry_versions'
+    name = db.Column(db.Text, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<RegistryVersion {self.name}:{self.version}>'
+
+class AlertEvent(db.Model):
+    __tablename__ = 'alert_events'
+    alert_event_id = db.Column(db.Integer, primary_key=True)
+    rule = db.Column(db.Text, nullable=False)
+    device_metric_type_id = db.Column(db.ForeignKey('device_metric_types.device_metric_type_id'), nullable=False)
+    state = db.Column(db.Text, nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    client_timestamp_epoch = db.Column(db.Integer, nullable=False)
+    server_timestamp_epoch = db.Column(db.Integer, nullable=False)
+    message = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_alert_events_series', 'rule', 'device_metric_type_id', 'alert_event_id'),
+    )
+
+    def __repr__(self):
+        return f'<AlertEvent {self.rule}:{self.state}>'
+
+class MetricChunk(db.Model):
+    """Cold tier: a run of one series' (timestamp, value) points, Gorilla encoded (see cold_storage.py)"""
+    __tablename__ = 'metric_chunks'
+    chunk_id = db.Column(db.Integer, primary_key=True)
+    device_metric_type_id = db.Column(db.ForeignKey('device_metric_types.device_metric_type_id'), nullable=False)
+    start_epoch = db.Column(db.Integer, nullable=False)
+    end_epoch = db.Column(db.Integer, nullable=False)
+    point_count = db.Column(db.Integer, nullable=False)
+    client_timezone_mins = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_metric_chunks_series', 'device_metric_type_id', 'start_epoch'),
+    )
+
+    def __repr__(self):
+        return f'<MetricChunk {self.device_metric_type_id}:{self.start_epoch}-{self.end_epoch}>'
@@ -0,0 +1,168 @@
+"""Development mode: EXPLAIN QUERY PLAN for every distinct statement the app runs.
+
+Statements are fingerprinted (whitespace collapsed, expanded IN lists
+folded into one placeholder) and each fingerprint is explained once, on
+the connection that ran it. Plans that scan a watched table without an
+index, or sort or group it through a temporary B-tree, are flagged with
+the line of app code the statement came from. Results are kept in a JSON
+file so `flask query-plans` can report on what a running server saw.
+
+SQLite only; the capture costs a stack walk per statement, so it is off
+unless enabled in the "query_plans" config section.
+"""
+from sqlalchemy import event
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')
+WHITESPACE = re.compile(r'\s+')
+# "IN (?, ?, ?)" is one statement shape whatever the number of values
+EXPANDED_IN = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+# "SCAN metrics" (SQLite 3.36+) or "SCAN TABLE metrics AS m"
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+TEMP_BTREE = re.compile(r'USE TEMP B-TREE FOR (.+)$')
+MAX_CALL_SITES = 5
+
+
+def fingerprint(statement):
+    """(normalized SQL, short hash) of a statement"""
+    normalized = EXPANDED_IN.sub('(?)', WHITESPACE.sub(' ', statement).strip())
+    return normalized, hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+def plan_flags(plan, statement, tables):
+    """Problems in a plan's detail lines that involve one of `tables`"""
+    flags = []
+    touched = [table for table in tables if re.search(rf'\b{table}\b', statement, re.IGNORECASE)]
+    for detail in plan:
+        scan = SCAN.match(detail)
+        if scan and scan.group(1) in tables and 'INDEX' not in detail:
+            flags.append(f"full scan of {scan.group(1)}")
+        sort = TEMP_BTREE.search(detail)
+        if sort and touched:
+            flags.append(f"temp B-tree for {sort.group(1)} over {', '.join(touched)}")
+    return list(dict.fromkeys(flags))
+
+
+def call_site(frame):
+    """'file:line in function' of the innermost frame in this repo's own code"""
+    this_file = os.path.abspath(__file__)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(ROOT + os.sep) and filename != this_file and 'site-packages' not in filename:
+            return f"{os.path.relpath(filename, ROOT)}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+
+class QueryPlanCapture:
+    """Explains each distinct statement once and records the plans, see the module docstring"""
+
+    def __init__(self, report_path='query_plans.json', tables=('metrics', 'snapshots')):
+        self.enabled = False
+        self.report_path = report_path
+        self.tables = tables
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        self.enabled = config.get('enabled', False)
+        self.report_path = os.path.abspath(config.get('report_path', self.report_path))
+        self.tables = tuple(config.get('tables', self.tables))
+        with self._lock:
+            self._entries = self.load()
+
+    def init_engine(self, engine):
+        if engine.dialect.name != 'sqlite':
+            logger.warning(f"Query plan capture only supports SQLite, not {engine.dialect.name}")
+            return
+        if not event.contains(engine, 'before_cursor_execute', self._before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        logger.info(f"Capturing query plans into {self.report_path}")
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.enabled or not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return
+        normalized, key = fingerprint(statement)
+        site = call_site(sys._getframe(1))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['count'] += 1
+                if site and site not in entry['call_sites'] and len(entry['call_sites']) < MAX_CALL_SITES:
+                    entry['call_sites'].append(site)
+                    self._save()
+                return
+        try:
+            # On a separate cursor of the same connection, so it sees the
+            # same attached databases; DBAPI cursors don't fire engine events
+            explain_cursor = cursor.connection.cursor()
+            try:
+                arguments = parameters[0] if executemany and parameters else parameters
+                explain_cursor.execute(f"EXPLAIN QUERY PLAN {statement}", arguments or ())
+                plan = [row[3] for row in explain_cursor.fetchall()]
+            finally:
+                explain_cursor.close()
+        except Exception as e:
+            plan = [f"EXPLAIN failed: {e}"]
+        flags = plan_flags(plan, normalized, self.tables)
+        with self._lock:
+            if key in self._entries:
+                self._entries[key]['count'] += 1
+                return
+            self._entries[key] = {
+                'fingerprint': key,
+                'sql': normalized,
+                'plan': plan,
+                'flags': flags,
+                'count': 1,
+                'call_sites': [site] if site else [],
+                'first_seen': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            }
+            self._save()
+        if flags:
+            logger.warning(f"Query plan {key} from {site}: {'; '.join(flags)}")
+
+    def load(self):
+        try:
+            with open(self.report_path) as report_file:
+                return {entry['fingerprint']: entry for entry in json.load(report_file)['statements']}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable query plan report {self.report_path}: {e}")
+            return {}
+
+    def _save(self):
+        # Called with the lock held; counts are only saved with a new
+        # statement or call site, so the file's counts lag behind
+        os.makedirs(os.path.dirname(self.report_path) or '.', exist_ok=True)
+        temp_path = f'{self.report_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as report_file:
+            json.dump({'statements': list(self._entries.values())}, report_file, indent=2)
+        os.replace(temp_path, self.report_path)
+
+    def reset(self):
+        with self._lock:
+            self._entries = {}
+            self._save()
+
+    def report(self, flagged_only=False):
+        """Captured statements, flagged ones first, then by how often they ran"""
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()]
+        if flagged_only:
+            entries = [entry for entry in entries if entry['flags']]
+        return sorted(entries, key=lambda entry: (not entry['flags'], -entry['count']))
+
+
+query_plans = QueryPlanCapture()
@@ -1,20 +1,32 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from models import *
 from datetime import datetime
 from dto_datamodel import DTO_Aggregator
 from aggregator_mapping import map_dto_to_model
+from figure_cache import figure_cache
+from symbol_validation import symbol_validator
+from symbol_registry import symbol_registry
+from my_logging.payload import summarize_payload, RateLimitFilter # type: ignore
+from my_logging.queue_logging import get_queue_stats # type: ignore
+from instrumentation import render_metrics, render_gauge, render_counter
+from aggregation import aggregate_metrics, parse_duration, parse_percentiles, parse_time
+from alerts import list_alert_events
+from metadata_catalog import catalog
+from sharding import shard_router
+from cold_storage import cold_storage
 import logging
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 from dto_datamodel import *
 import json
-from reticker import TickerExtractor
 
 # Create blueprint - note we no longer need url_prefix here as it's defined in app.py
 bp = Blueprint('main', __name__)
 logger = logging.getLogger(__name__)
+# Every ingest request logs the same handful of lines, keep the first ones
+# of each minute and a sample of the rest
+logger.addFilter(RateLimitFilter(rate=60, per=60.0, sample_every=100))
 
-STOCK_SYMBOLS_CACHE = ["AAPL", "MSFT", "GOOGL", "AMZN"]
 # Root route for API
 @bp.route('/')
 def home():
@@ -29,25 +41,28 @@ def handle_aggregator():
         return get_aggregator()
 
 def add_aggregator():
+    session = None
     try:
-        session = db.session
         data = request.get_json()
         logger.info("Received data")
         if not data:
             logger.error("Invalid data received")
             return jsonify({"error": "Invalid data"}), 400
         
-        logger.debug(data)
+        # Only summarized, and only if the record is actually emitted
+        logger.debug("Received payload: %s", summarize_payload(data))
         # Deserialize JSON to DTO
         logger.info("Deserializing JSON to DTO")
-        logger.debug(f"Data: {data}")
         aggregator_dto = DTO_Aggregator.from_json(data)
         logger.info("Deserialization complete")
+        # With sharded storage the aggregator's snapshots go to its own file
+        session = shard_router.session_for(aggregator_dto.guid) if shard_router.enabled else db.session
         
         # Map DTO to models and save to the database
         logger.info("Mapping DTO to Model")
         map_dto_to_model(aggregator_dto, session)
         logger.info("Mapping complete")
+        figure_cache.mark_stale()
         
         return jsonify({"message": "Aggregator added successfully"}), 201
     except Exception as e:
@@ -65,46 +80,80 @@ def add_aggregator():
                         "message": str(e)
                         }), 500
 
+def aggregator_to_dict(aggregator, session):
+    return DTO_Aggregator(
+        guid=aggregator.guid,
+        name=aggregator.name,
+        devices=[
+            DTO_Device(
+                name=device.name,
+                # Packed history first, it is older than any raw snapshot
+                snapshots=[
+                    DTO_Snapshot(
+                        timestamp_capture=datetime.fromtimestamp(timestamp),
+                        timezone_mins=timezone_mins,
+                        metrics=[DTO_Metric(name=name, value=value) for name, value in metrics]
+                    ) for timestamp, timezone_mins, metrics in cold_storage.snapshots(session, device.device_id)
+                ] + [
+                    DTO_Snapshot(
+                        timestamp_capture=datetime.fromtimestamp(snapshot.client_timestamp_epoch),
+                        timezone_mins=snapshot.client_timezon_mins,
+                        metrics=[
+                            DTO_Metric(
+                                name=metric.device_metric_type.name,
+                                value=metric.value
+                            ) for metric in snapshot.metrics
+                        ]
+                    ) for snapshot in device.snapshots
+                ]
+            ) for device in aggregator.devices
+        ]
+    ).to_dict()
+
+def fetch_aggregators(session, uuid=None, shard=None):
+    """Aggregators as dicts; with `shard`, only those whose snapshots are stored on it"""
+    query = session.query(Aggregator)
+    if uuid:
+        query = query.filter_by(guid=uuid)
+    return [
+        aggregator_to_dict(aggregator, session) for aggregator in query.all()
+        if shard is None or shard_router.shard_for(aggregator.guid) is shard
+    ]
+
 def get_aggregator():
     try:
-        session = db.session
         uuid = request.args.get('uuid')
+        # Packed snapshots are regrouped by metric type, through the catalog
+        catalog.sync(db.session)
         
-        aggregators = []
         if uuid:
             logger.info(f"Fetching aggregator with UUID: {uuid}")
             # Fetch a single aggregator by UUID
-            aggregators = session.query(Aggregator).filter_by(guid=uuid)
+            if shard_router.enabled:
+                session = shard_router.session_for(uuid)
+                try:
+                    aggregators_dto = fetch_aggregators(session, uuid)
+                finally:
+                    session.close()
+            else:
+                aggregators_dto = fetch_aggregators(db.session, uuid)
             logger.info("Aggregator fetched")
-            if not aggregators:
+            if not aggregators_dto:
                 return jsonify({"error": "Aggregator not found"}), 404
         else:
             # Fetch all aggregators
             logger.info("Fetching all aggregators")
-            aggregators = session.query(Aggregator).all()
-        aggregators_dto = [
-            DTO_Aggregator(
-                guid=aggregator.guid,
-                name=aggregator.name,
-                devices=[
-                    DTO_Device(
-                        name=device.name,
-                        snapshots=[
-                            DTO_Snapshot(
-                                timestamp_capture=datetime.fromtimestamp(snapshot.client_timestamp_epoch),
-                                timezone_mins=snapshot.client_timezon_mins,
-                                metrics=[
-                                    DTO_Metric(
-                                        name=metric.device_metric_type.name,
-                                        value=metric.value
-                                    ) for metric in snapshot.metrics
-                                ]
-                            ) for snapshot in device.snapshots
-                        ]
-                    ) for device in aggregator.devices
+            if shard_router.enabled:
+                # Every shard builds the aggregators it stores, in parallel
+                aggregators_dto = [
+                    aggregator
+                    for shard_aggregators in shard_router.fan_out(
+                        lambda session, shard: fetch_aggregators(session, shard=shard),
+                        {shard: (shard,) for shard in shard_router.shards})
+                    for aggregator in shard_aggregators
                 ]
-            ).to_dict() for aggregator in aggregators
-        ]
+            else:
+                aggregators_dto = fetch_aggregators(db.session)
         logger.info("Aggregators fetched")
         return jsonify(aggregators_dto), 200
     except Exception as e:
@@ -114,45 +163,115 @@ def get_aggregator():
                         "message": str(e)
                         }), 500
 
-@bp.route('/stock-symbols', methods=['GET'])
+# Bucketed statistics, e.g.
+# /api/aggregate?metric=CPU Percent&aggregator=<guid>&start=2025-01-01&bucket=1h&percentile=95
+@bp.route('/aggregate', methods=['GET'])
+def get_aggregate():
+    try:
+        metric_names = request.args.getlist('metric')
+        aggregators = request.args.getlist('aggregator')
+        start = parse_time(request.args.get('start'))
+        end = parse_time(request.args.get('end'))
+        bucket_seconds = parse_duration(request.args.get('bucket', '1h'))
+        percentiles = parse_percentiles(request.args.getlist('percentile'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        logger.info(f"Aggregating {metric_names} in {bucket_seconds}s buckets")
+        result = aggregate_metrics(db.session, metric_names, aggregators, start, end, bucket_seconds, percentiles)
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in aggregate route: {e}")
+        return jsonify({
+                        "status": "error",
+                        "message": str(e)
+                        }), 500
+
+# Alert events, newest first; ?active=1 lists the series currently firing
+@bp.route('/alerts', methods=['GET'])
+def get_alerts():
+    try:
+        since = parse_time(request.args.get('since'))
+        limit = min(int(request.args.get('limit', 100)), 1000)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        catalog.sync(db.session)
+        events = list_alert_events(
+            db.session,
+            rule=request.args.get('rule'),
+            state=request.args.get('state'),
+            since=since,
+            active=request.args.get('active', '').lower() in ('1', 'true', 'yes'),
+            limit=limit
+        )
+        return jsonify({"alerts": events}), 200
+    except Exception as e:
+        logger.error(f"Error in alerts route: {e}")
+        return jsonify({
+                        "status": "error",
+                        "message": str(e)
+                        }), 500
+
+@bp.route('/internal/figures', methods=['GET'])
+def get_figure_cache_status():
+    return jsonify(figure_cache.status()), 200
+
+@bp.route('/internal/metrics', methods=['GET'])
+def get_internal_metrics():
+    extra_lines = []
+    figures = figure_cache.status()
+    if figures:
+        extra_lines += render_gauge('figure_cache_age_seconds', "Age of each precomputed figure",
+                                    {key: status['age_seconds'] for key, status in figures.items()}, 'figure')
+        extra_lines += render_gauge('figure_cache_build_seconds', "Last build time of each precomputed figure",
+                                    {key: status['build_ms'] / 1000 for key, status in figures.items()}, 'figure')
+    queue_stats = get_queue_stats()
+    if queue_stats:
+        extra_lines += render_gauge('log_queue_depth', "Log records waiting for the listener", queue_stats['queued'])
+        extra_lines += render_counter('log_records_dropped_total', "Log records dropped on queue overflow",
+                                      queue_stats['dropped'], 'level')
+    return Response(render_metrics(extra_lines), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/stock-symbols', methods=['GET', 'POST'])
 def handle_stock_symbols():
-    if request.method == 'GET':
+    if request.method == 'POST':
+        return add_stock_symbols()
+    elif request.method == 'GET':
         return get_stock_symbols()
 
 def get_stock_symbols():
     try:
-        # Return the symbols from our cache
-        global STOCK_SYMBOLS_CACHE
-        logger.info(f"Returning stock symbols from cache: {STOCK_SYMBOLS_CACHE}")
-        return jsonify({"symbols": STOCK_SYMBOLS_CACHE}), 200
+        # Shared by all workers, only reloaded from the database when it changes
+        symbols = symbol_registry.get_symbols(db.session)
+        logger.info(f"Returning stock symbols from registry: {symbols}")
+        return jsonify({"symbols": symbols}), 200
     except Exception as e:
         logger.error(f"Error retrieving stock symbols: {e}")
         return jsonify({"error": str(e)}), 500
     
+def add_stock_symbols():
+    data = request.get_json(silent=True)
+    response_data, status_code = add_stock_symbols_internal(data)
+    return jsonify(response_data), status_code
+
 def add_stock_symbols_internal(data):
     try:
-        global STOCK_SYMBOLS_CACHE
         logger.info("Processing stock symbols internally")
         
         if not data or 'symbols' not in data:
             return {"error": "No symbols provided"}, 400
         
-        # Convert to uppercase and remove duplicates
-        input_symbols = [symbol.upper().strip() for symbol in data['symbols']]
-        input_symbols = list(set(input_symbols))  # Remove duplicates
+        if not isinstance(data['symbols'], list):
+            return {"error": "Symbols must be a list"}, 400
         
-        # Validate the symbols using reticker
-        extractor = TickerExtractor()
-        valid_symbols = []
-        invalid_symbols = []
-        
-        for symbol in input_symbols:
-            # Check if symbol is valid
-            extracted = extractor.extract(symbol)
-            if extracted and symbol in extracted:
-                valid_symbols.append(symbol)
-            else:
-                invalid_symbols.append(symbol)
+        # Symbols are uppercased and de-duplicated by the validator, which
+        # only runs reticker for symbols it hasn't seen before
+        valid_symbols, invalid_symbols = symbol_validator.validate(data['symbols'])
         
         logger.info(f"Valid symbols: {valid_symbols}")
         if invalid_symbols:
@@ -164,15 +283,15 @@ def add_stock_symbols_internal(data):
                 "invalid_symbols": invalid_symbols
             }, 400
         
-        # Replace the cache with the new symbols
-        STOCK_SYMBOLS_CACHE = valid_symbols
+        # Replace the registry with the new symbols
+        all_symbols = symbol_registry.replace_symbols(db.session, valid_symbols)
         
-        logger.info(f"Updated stock symbol cache: {STOCK_SYMBOLS_CACHE}")
+        logger.info(f"Updated stock symbol registry: {all_symbols}")
         
         response_data = {
             "message": f"{len(valid_symbols)} valid symbols received",
             "symbols": valid_symbols,
-            "all_symbols": STOCK_SYMBOLS_CACHE
+            "all_symbols": all_symbols
         }
         
         if invalid_symbols:
@@ -0,0 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor
+from metadata_catalog import catalog
+from models import db, Snapshot, Metric, MetricChunk, set_sqlite_pragmas
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+import heapq
+import logging
+import os
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Tables that live in the shards; everything else stays in the main database
+SHARDED_TABLES = [Snapshot.__table__, Metric.__table__, MetricChunk.__table__]
+META_SCHEMA = 'meta'
+
+
+class Shard:
+    def __init__(self, index, path, main_path, pragmas=None):
+        self.index = index
+        self.path = path
+        self._create_tables()
+        self.engine = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+        if pragmas:
+            set_sqlite_pragmas(self.engine, pragmas)
+
+        @event.listens_for(self.engine, 'connect')
+        def attach_main_database(dbapi_connection, connection_record):
+            # Unqualified table names resolve to the shard first, then to the
+            # main database, so the existing queries and models work unchanged
+            escaped = main_path.replace("'", "''")
+            dbapi_connection.execute(f"ATTACH DATABASE '{escaped}' AS {META_SCHEMA}")
+
+        self.sessionmaker = sessionmaker(bind=self.engine)
+
+    def _create_tables(self):
+        # With a plain engine: once the main database is attached its tables
+        # would make create_all think the shard's already exist
+        engine = create_engine(f'sqlite:///{self.path}')
+        try:
+            db.metadata.create_all(engine, tables=SHARDED_TABLES)
+        finally:
+            engine.dispose()
+
+    def session(self):
+        return self.sessionmaker()
+
+    def __repr__(self):
+        return f'<Shard {self.index} {self.path}>'
+
+
+class ShardRouter:
+    """Optional sharded storage: each aggregator's snapshots and metrics in their own SQLite file.
+
+    Aggregators, devices, metric types and everything else stay in the main
+    database, which every shard attaches, so ids are global and the
+    metadata catalog works as before. An aggregator goes to the shard given
+    in "assignments", otherwise to crc32(guid) % shards. Writes for
+    aggregators on different shards no longer wait for each other; reads
+    across aggregators are run on the shards in parallel and merged.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.shards = []
+        self.assignments = {}
+        self._pool = None
+
+    def configure(self, config, main_path, pragmas=None):
+        self.close()
+        if not config.get('enabled', False):
+            return
+        count = config.get('shards', 4)
+        if count < 1:
+            raise ValueError("sharding.shards must be at least 1")
+        # Relative paths are relative to the main database's directory
+        template = os.path.join(os.path.dirname(main_path), config.get('path_template', 'shards/shard_{index}.db'))
+        self.assignments = {str(guid): index for guid, index in config.get('assignments', {}).items()}
+        if any(not 0 <= index < count for index in self.assignments.values()):
+            raise ValueError("sharding.assignments refers to a shard that doesn't exist")
+
+        self.shards = []
+        for index in range(count):
+            path = os.path.abspath(template.format(index=index))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.shards.append(Shard(index, path, main_path, pragmas))
+        self._pool = ThreadPoolExecutor(max_workers=count, thread_name_prefix='shard-query')
+        self.enabled = True
+        logger.info(f"Sharded storage enabled with {count} shards")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        for shard in self.shards:
+            shard.engine.dispose()
+        self.shards = []
+        self.enabled = False
+
+    def dispose_after_fork(self):
+        # Connections must not be shared with the parent process, and the
+        # query threads don't survive the fork
+        for shard in self.shards:
+            shard.engine.dispose(close=False)
+        if self._pool is not None:
+            self._pool = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix='shard-query')
+
+    def clear(self):
+        """Delete every snapshot, metric and packed chunk in the shards"""
+        for shard in self.shards:
+            with shard.engine.begin() as connection:
+                for table in reversed(SHARDED_TABLES):
+                    connection.execute(table.delete())
+
+    def remap_metadata(self, device_ids, metric_type_ids):
+        """Point snapshots and metrics at merged devices and metric types ({old id: new id})"""
+        for shard in self.shards:
+            with shard.engine.begin() as connection:
+                if device_ids:
+                    connection.execute(text("UPDATE snapshots SET device_id = :new WHERE device_id = :old"),
+                                       [{'old': old, 'new': new} for old, new in device_ids.items()])
+                if metric_type_ids:
+                    for table in ('metrics', 'metric_chunks'):
+                        connection.execute(
+                            text(f"UPDATE {table} SET device_metric_type_id = :new WHERE device_metric_type_id = :old"),
+                            [{'old': old, 'new': new} for old, new in metric_type_ids.items()])
+
+    def shard_for(self, guid):
+        guid = str(guid)
+        index = self.assignments.get(guid)
+        if index is None:
+            index = zlib.crc32(guid.encode('utf-8')) % len(self.shards)
+        return self.shards[index]
+
+    def session_for(self, guid):
+        """A new session on the aggregator's shard; the caller closes it"""
+        return self.shard_for(guid).session()
+
+    def shards_for_metric_types(self, metric_type_ids):
+        """{shard: [metric type ids]} for the shards that hold these series"""
+        by_shard = {}
+        for metric_type_id in metric_type_ids:
+            metric_type = catalog.metric_types.get(metric_type_id)
+            aggregator = catalog.aggregators.get(metric_type.aggregator_id) if metric_type else None
+            if aggregator is None:
+                continue
+            by_shard.setdefault(self.shard_for(aggregator.guid), []).append(metric_type_id)
+        return by_shard
+
+    def fan_out(self, function, shard_arguments=None):
+        """Run function(session, *arguments) on every shard (or those in `shard_arguments`) in parallel.
+
+        `shard_arguments` maps a shard to the extra arguments for it.
+        Returns the results in shard order.
+        """
+        if shard_arguments is None:
+            shard_arguments = {shard: () for shard in self.shards}
+
+        def run(shard, arguments):
+            session = shard.session()
+            try:
+                return function(session, *arguments)
+            finally:
+                session.close()
+
+        shards = sorted(shard_arguments, key=lambda shard: shard.index)
+        if len(shards) == 1:
+            return [run(shards[0], shard_arguments[shards[0]])]
+        futures = [self._pool.submit(run, shard, shard_arguments[shard]) for shard in shards]
+        return [future.result() for future in futures]
+
+    def metric_rows(self, query_function, metric_type_ids, key, reverse=False, limit=None):
+        """Rows of query_function(session, ids) from every shard holding `metric_type_ids`.
+
+        Each shard's rows must already be sorted by `key`; they are merged
+        into one sorted list and cut to `limit`.
+        """
+        by_shard = self.shards_for_metric_types(metric_type_ids)
+        results = self.fan_out(query_function, {shard: (ids,) for shard, ids in by_shard.items()})
+        merged = heapq.merge(*results, key=key, reverse=reverse)
+        if limit:
+            return [row for _, row in zip(range(limit), merged)]
+        return list(merged)
+
+
+shard_router = ShardRouter()
@@ -0,0 +1,65 @@
+"""Report where startup time goes: module imports, then each create_app phase.
+
+Run it in a fresh interpreter (`python startup_profile.py` or
+`flask startup-profile`), otherwise already-imported modules show up as free.
+"""
+import importlib
+import sys
+import time
+
+# In dependency order so each line only shows its own cost
+IMPORT_PHASES = [
+    'flask',
+    'flask_sqlalchemy',
+    'dataclasses_json',
+    'models',
+    'routes',
+    'my_logging.logger',
+    'dash',
+    'dashboard',
+    'app',
+]
+
+def measure_imports():
+    timings = []
+    for name in IMPORT_PHASES:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        timings.append((f"import {name}", time.perf_counter() - started))
+    return timings
+
+def measure_heavy_imports():
+    from lazy_imports import warm_imports
+    return [(f"import {name} (lazy)", seconds) for name, seconds in warm_imports().items()]
+
+def print_report(sections):
+    total = 0.0
+    for title, timings in sections:
+        print(title)
+        for name, seconds in timings:
+            print(f"  {name:<40} {seconds * 1000:>9.1f} ms")
+            total += seconds
+    print(f"{'total':<42} {total * 1000:>9.1f} ms")
+
+def main():
+    import_timings = measure_imports()
+
+    from app import create_app
+    started = time.perf_counter()
+    app = create_app()
+    create_app_seconds = time.perf_counter() - started
+    phase_timings = app.extensions.get('startup_timings', [])
+    other = create_app_seconds - sum(seconds for _, seconds in phase_timings)
+    phase_timings = phase_timings + [('other', other)]
+
+    # Paid later by the first figure build or symbol validation
+    heavy_timings = measure_heavy_imports()
+
+    print_report([
+        ("Imports:", import_timings),
+        ("create_app phases:", phase_timings),
+        ("Deferred imports (first use):", heavy_timings),
+    ])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+from models import StockSymbol, RegistryVersion
+from sqlalchemy.exc import IntegrityError
+import logging
+import mmap
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYMBOLS = ["AAPL", "MSFT", "GOOGL", "AMZN"]
+REGISTRY_NAME = 'stock_symbols'
+
+
+class VersionStamp:
+    """Version counter in a small memory-mapped file shared by all worker processes.
+
+    Reading it is a plain memory access, so readers can check it on every
+    request and only go to the database when it has moved.
+    """
+
+    SIZE = 8
+
+    def __init__(self, path):
+        self.path = path
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._mmap is None:
+            with self._lock:
+                if self._mmap is None:
+                    with open(self.path, 'a+b') as f:
+                        if os.fstat(f.fileno()).st_size < self.SIZE:
+                            f.truncate(self.SIZE)
+                    with open(self.path, 'r+b') as f:
+                        self._mmap = mmap.mmap(f.fileno(), self.SIZE)
+        return self._mmap
+
+    def read(self):
+        return struct.unpack_from('<Q', self._open(), 0)[0]
+
+    def write(self, version):
+        struct.pack_into('<Q', self._open(), 0, version)
+
+
+class SymbolRegistry:
+    """Stock symbols served by /api/stock-symbols, shared by every worker.
+
+    The list lives in the stock_symbols table and its version in
+    registry_versions. Each process keeps a copy and reloads it only when the
+    version stamp file no longer matches the version it loaded.
+    """
+
+    def __init__(self, stamp_path='stock_symbols.version', defaults=DEFAULT_SYMBOLS):
+        self.defaults = list(defaults)
+        self._stamp = VersionStamp(stamp_path)
+        self._symbols = []
+        self._version = None
+        self._lock = threading.RLock()
+
+    def configure(self, stamp_path):
+        with self._lock:
+            self._stamp = VersionStamp(stamp_path)
+            self._version = None
+
+    def get_symbols(self, session):
+        if self._version is not None and self._stamp.read() == self._version:
+            return list(self._symbols)
+        with self._lock:
+            if self._version is None or self._stamp.read() != self._version:
+                self._reload(session)
+            return list(self._symbols)
+
+    def replace_symbols(self, session, symbols):
+        """Replace the whole list, returning it once committed"""
+        with self._lock:
+            try:
+                version = self._next_version(session)
+                session.query(StockSymbol).delete()
+                session.add_all([
+                    StockSymbol(symbol=symbol, position=position)
+                    for position, symbol in enumerate(symbols)
+                ])
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            self._symbols = list(symbols)
+            self._version = version
+            self._stamp.write(version)
+            logger.info(f"Stock symbol registry updated to version {version}")
+            return list(self._symbols)
+
+    def _next_version(self, session):
+        updated = session.query(RegistryVersion)\
+            .filter_by(name=REGISTRY_NAME)\
+            .update({RegistryVersion.version: RegistryVersion.version + 1})
+        if not updated:
+            session.add(RegistryVersion(name=REGISTRY_NAME, version=1))
+            session.flush()
+        return session.query(RegistryVersion.version).filter_by(name=REGISTRY_NAME).scalar()
+
+    def _reload(self, session):
+        version = session.query(RegistryVersion.version).filter_by(name=REGISTRY_NAME).scalar()
+        if version is None:
+            logger.info("Stock symbol registry is empty, seeding defaults")
+            try:
+                self.replace_symbols(session, self.defaults)
+                return
+            except IntegrityError:
+                # Another process seeded it first
+                version = session.query(RegistryVersion.version).filter_by(name=REGISTRY_NAME).scalar()
+        self._symbols = [
+            row[0] for row in session.query(StockSymbol.symbol).order_by(StockSymbol.position)
+        ]
+        self._version = version
+        # Stamps written by two writers can land out of order, so whoever
+        # reads the database settles the stamp on the committed version
+        if self._stamp.read() != version:
+            self._stamp.write(version)
+        logger.debug(f"Stock symbol registry loaded version {version}: {self._symbols}")
+
+
+symbol_registry = SymbolRegistry()
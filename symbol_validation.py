@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_symbols(symbols):
+    """Uppercase and strip symbols, dropping blanks and duplicates but keeping order"""
+    normalized = OrderedDict()
+    for symbol in symbols:
+        symbol = str(symbol).upper().strip()
+        if symbol:
+            normalized.setdefault(symbol, None)
+    return list(normalized)
+
+
+class SymbolValidator:
+    """Validates stock symbols with reticker.
+
+    The extractor is built once and verdicts are memoized in a bounded LRU
+    cache, so only symbols never seen before reach reticker, and those are
+    checked together in a single extract() call.
+    """
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self._extractor = None
+        self._verdicts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def extractor(self):
+        if self._extractor is None:
+            # reticker is slow to import, so only load it once it is needed
+            from reticker import TickerExtractor
+            self._extractor = TickerExtractor()
+        return self._extractor
+
+    def validate(self, symbols):
+        """Split symbols into (valid, invalid) lists, in input order"""
+        symbols = normalize_symbols(symbols)
+        verdicts = {}
+        unknown = []
+        with self._lock:
+            for symbol in symbols:
+                if symbol in self._verdicts:
+                    self._verdicts.move_to_end(symbol)
+                    verdicts[symbol] = self._verdicts[symbol]
+                    self.hits += 1
+                else:
+                    unknown.append(symbol)
+                    self.misses += 1
+
+        if unknown:
+            # Symbols are whitespace separated words, so one pass over the
+            # joined batch gives the same answer as one extract() per symbol
+            extracted = set(self.extractor.extract(" ".join(unknown)))
+            with self._lock:
+                for symbol in unknown:
+                    verdicts[symbol] = symbol in extracted
+                    self._verdicts[symbol] = verdicts[symbol]
+                while len(self._verdicts) > self.cache_size:
+                    self._verdicts.popitem(last=False)
+            logger.debug(f"Validated {len(unknown)} new symbols, {len(symbols) - len(unknown)} from cache")
+
+        valid_symbols = [symbol for symbol in symbols if verdicts[symbol]]
+        invalid_symbols = [symbol for symbol in symbols if not verdicts[symbol]]
+        return valid_symbols, invalid_symbols
+
+
+symbol_validator = SymbolValidator()
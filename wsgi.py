@@ -0,0 +1,14 @@
+"""WSGI entry point for multi-worker servers, e.g.
+
+    gunicorn --preload --workers 4 wsgi:app
+
+With --preload the app is created once in the master: the schema check and
+the heavy imports happen there and the workers inherit them on fork.
+Background threads and database connections are set up per worker (see
+create_app in app.py).
+"""
+from lazy_imports import warm_imports
+from app import create_app
+
+warm_imports()
+app = create_app()